@@ -0,0 +1,100 @@
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+import transporte
+
+
+# ==============================================================
+# SNAPSHOT VERSIONADO DA MATRIZ DE CADA USUÁRIO (MongoDB)
+# ==============================================================
+
+MAX_TENTATIVAS_TROCA = 5
+
+_LER = object()
+_MANTER = object()
+
+
+class ArmazemMatrizes:
+    """Matriz densa de cada usuário em um único documento (_id = usuario_id).
+
+    Os documentos por MP continuam sendo a fonte editável; este documento guarda a matriz já
+    montada (valores float64 em binário), lida em uma única busca pelo _id. A troca de versão é
+    um replace condicionado à versão lida (atômico por documento), então a versão só cresce e
+    quem lê nunca vê uma matriz pela metade.
+
+    Edições pontuais (/mp) só incrementam "alteracoes": a matriz é remontada na próxima leitura,
+    e a gravação também é condicionada a esse contador para não apagar edições concorrentes.
+
+    "importacao" aponta quais documentos por MP estão vigentes: uma importação grava os seus
+    com uma marca nova e só passa a valer quando o snapshot é trocado para essa marca (None:
+    documentos sem marca, anteriores ao versionamento).
+    """
+
+    def __init__(self, colecao):
+        self.colecao = colecao
+
+    async def carregar(self, usuario_id):
+        return await self.colecao.find_one({"_id": usuario_id})
+
+    @staticmethod
+    def atualizado(doc):
+        return doc.get("alteracoes", 0) == doc.get("alteracoes_incluidas", 0)
+
+    @staticmethod
+    def matriz_do_documento(doc):
+        return transporte.matriz_de_compacta(doc)
+
+    async def cabecalho(self, usuario_id):
+        # Só os campos de versão: confere uma cópia em cache sem trazer a matriz
+        return await self.colecao.find_one(
+            {"_id": usuario_id}, {"versao": 1, "alteracoes": 1, "alteracoes_incluidas": 1}
+        )
+
+    async def importacao_atual(self, usuario_id):
+        doc = await self.colecao.find_one({"_id": usuario_id}, {"importacao": 1})
+        return doc.get("importacao") if doc else None
+
+    async def marcar_alteracao(self, usuario_id):
+        await self.colecao.update_one({"_id": usuario_id}, {"$inc": {"alteracoes": 1}})
+
+    async def gravar(self, usuario_id, matriz, anterior=_LER, importacao=_MANTER):
+        """Grava a matriz como versão seguinte e retorna o número da versão.
+
+        anterior: documento usado como base (ou None se não havia). Se ele mudou desde a leitura,
+        nada é gravado e retorna None. Sem anterior, relê e tenta de novo em caso de corrida.
+        importacao: nova marca dos documentos vigentes; por padrão mantém a atual.
+        """
+        tentativas = MAX_TENTATIVAS_TROCA if anterior is _LER else 1
+        for _ in range(tentativas):
+            base = anterior
+            if base is _LER:
+                base = await self.colecao.find_one(
+                    {"_id": usuario_id}, {"versao": 1, "alteracoes": 1, "importacao": 1}
+                )
+
+            alteracoes = base.get("alteracoes", 0) if base else 0
+            doc = {
+                "_id": usuario_id,
+                "versao": (base["versao"] if base else 0) + 1,
+                "assinatura": matriz.assinatura(),
+                "alteracoes": alteracoes,
+                "alteracoes_incluidas": alteracoes,
+                "importacao": (base.get("importacao") if base else None) if importacao is _MANTER else importacao,
+                "atualizado_em": time.time(),
+                **transporte.matriz_compacta(matriz, binario=True),
+            }
+
+            if base is None:
+                try:
+                    await self.colecao.insert_one(doc)
+                    return doc["versao"]
+                except DuplicateKeyError:
+                    continue
+
+            resultado = await self.colecao.replace_one(
+                {"_id": usuario_id, "versao": base["versao"], "alteracoes": alteracoes}, doc
+            )
+            if resultado.matched_count:
+                return doc["versao"]
+        return None
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from optimization_engine import MatrizNutricional
+
+
+# ==============================================================
+# BASE LOCAL: PLANILHA → SNAPSHOT BINÁRIO (carregamento sob demanda)
+# ==============================================================
+
+def _hash_arquivo(caminho, bloco=1 << 20):
+    h = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        while True:
+            dados = f.read(bloco)
+            if not dados:
+                break
+            h.update(dados)
+    return h.hexdigest()
+
+
+class BaseLocal:
+    """Matriz da planilha local, lida só no primeiro uso.
+
+    O DataFrame lido do Excel é gravado em um .npz ao lado da planilha. Nas próximas
+    inicializações o snapshot é usado se o mtime e o tamanho da planilha não mudaram ou,
+    caso mudem, se o sha256 do conteúdo ainda for o mesmo; senão o Excel é relido.
+    """
+
+    def __init__(self, caminho_excel, caminho_snapshot=None):
+        self.caminho_excel = caminho_excel
+        raiz, _ = os.path.splitext(caminho_excel)
+        self.caminho_snapshot = caminho_snapshot or f"{raiz}.snapshot.npz"
+        self._dataframe = None
+        self._matriz = None
+        self.origem = None  # "snapshot" | "excel"
+        self._lock = threading.Lock()
+
+    @property
+    def carregada(self):
+        return self._matriz is not None
+
+    def dataframe(self):
+        self._carregar()
+        return self._dataframe
+
+    def matriz(self):
+        self._carregar()
+        return self._matriz
+
+    def _carregar(self):
+        if self._matriz is not None:
+            return
+        with self._lock:
+            if self._matriz is not None:
+                return
+            info = os.stat(self.caminho_excel)
+            df, origem = self._ler_snapshot(info), "snapshot"
+            if df is None:
+                df, origem = self._ler_excel(), "excel"
+                self._gravar_snapshot(df, info)
+            self._dataframe = df
+            self._matriz = MatrizNutricional.de_dataframe(df)
+            self.origem = origem
+
+    def _ler_excel(self):
+        df = pd.read_excel(self.caminho_excel, index_col=0)
+        df.columns = df.columns.str.strip()
+        df.index = df.index.str.strip()
+        return df
+
+    def _ler_snapshot(self, info):
+        try:
+            with np.load(self.caminho_snapshot, allow_pickle=False) as snap:
+                dados = {k: snap[k] for k in snap.files}
+        except (OSError, ValueError):
+            return None
+
+        if (int(dados["mtime_ns"]), int(dados["tamanho"])) != (info.st_mtime_ns, info.st_size):
+            # Planilha tocada/copiada: o conteúdo decide
+            if str(dados["sha256"]) != _hash_arquivo(self.caminho_excel):
+                return None
+            self._gravar_arrays({**dados, "mtime_ns": info.st_mtime_ns, "tamanho": info.st_size})
+
+        return pd.DataFrame(dados["valores"], index=dados["linhas"].tolist(), columns=dados["colunas"].tolist())
+
+    def _gravar_snapshot(self, df, info):
+        # Só planilhas totalmente numéricas: o snapshot guarda os valores como float64
+        if not all(pd.api.types.is_numeric_dtype(t) for t in df.dtypes):
+            return
+        self._gravar_arrays({
+            "valores": df.to_numpy(dtype=float),
+            "linhas": np.array([str(i) for i in df.index]),
+            "colunas": np.array([str(c) for c in df.columns]),
+            "mtime_ns": info.st_mtime_ns,
+            "tamanho": info.st_size,
+            "sha256": _hash_arquivo(self.caminho_excel),
+        })
+
+    def _gravar_arrays(self, arrays):
+        # Escrita atômica; diretório somente leitura apenas desativa o snapshot
+        temporario = f"{self.caminho_snapshot}.{os.getpid()}.tmp"
+        try:
+            with open(temporario, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(temporario, self.caminho_snapshot)
+        except OSError as e:
+            print("⚠️ Não foi possível gravar o snapshot da base local:", e)
+            try:
+                os.remove(temporario)
+            except OSError:
+                pass
@@ -0,0 +1,529 @@
+"""Benchmark do motor de otimização e da API.
+
+Gera matrizes sintéticas (MPs × nutrientes, esparsidade e aperto das metas configuráveis),
+mede separadamente montagem, solve e serialização para cada backend de solver e faz um
+teste de carga em processo dos endpoints contra um MongoDB simulado (mongomock).
+
+    python benchmark.py --mps 50,200,1000 --nutrientes 30 --saida bench.json
+    python benchmark.py --comparar bench_anterior.json --saida bench.json
+
+Dependências extras só para a parte de API: mongomock e httpx.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from optimization_engine import (
+    MatrizNutricional, CUSTO_ROW_NAME, montar_lp, resolver_lp, montar_resultado,
+    otimizar_formula, solvers_disponiveis,
+)
+from armazem_matrizes import ArmazemMatrizes
+
+try:
+    import mongomock
+except ImportError:  # sem mongomock o teste de carga da API é pulado
+    mongomock = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+DIRETORIO = os.path.dirname(os.path.abspath(__file__))
+USUARIO_BENCH = "benchmark"
+
+
+# ==============================================================
+# GERADOR DE PROBLEMAS SINTÉTICOS
+# ==============================================================
+
+def gerar_matriz_sintetica(n_mps=100, n_nutrientes=30, densidade=0.3, semente=0):
+    rng = np.random.default_rng(semente)
+
+    # Macronutrientes (até 5): composição centesimal com soma <= 100 em cada MP
+    n_macro = min(5, n_nutrientes)
+    macro = rng.dirichlet(np.full(n_macro + 1, 0.5), size=n_mps).T[:n_macro] * 100
+
+    # Micronutrientes: valores pequenos (lognormal), presentes só em parte das MPs
+    micro = rng.lognormal(mean=-2.0, sigma=1.5, size=(n_nutrientes - n_macro, n_mps))
+    micro *= rng.random(micro.shape) < densidade
+    vazios = np.flatnonzero(~micro.any(axis=1))
+    micro[vazios, rng.integers(n_mps, size=len(vazios))] = rng.lognormal(-2.0, 1.5, size=len(vazios))
+
+    custos = rng.lognormal(mean=1.0, sigma=0.8, size=n_mps)
+    linhas = [CUSTO_ROW_NAME] + [f"Nutriente_{i:03d}" for i in range(n_nutrientes)]
+    colunas = [f"MP_{j:04d}" for j in range(n_mps)]
+    return MatrizNutricional(linhas, colunas, np.vstack([custos, macro, micro]))
+
+
+def gerar_problema(matriz, n_metas=10, aperto=0.5, rng=None):
+    """Metas e restrições sempre viáveis: todas são satisfeitas por uma mistura de referência.
+
+    aperto ∈ [0, 1]: 0 = faixas largas em torno da mistura, 1 = faixas justas (±1%).
+    """
+    rng = rng if rng is not None else np.random.default_rng(0)
+    n = len(matriz.colunas)
+
+    usadas = rng.choice(n, size=min(8, n), replace=False)
+    x0 = np.zeros(n)
+    x0[usadas] = rng.dirichlet(np.ones(len(usadas))) * 100
+    composicao = matriz.valores @ x0 / 100
+
+    folga = 0.01 + 0.5 * (1 - aperto)
+    nutrientes = [i for i, nome in enumerate(matriz.linhas) if nome != CUSTO_ROW_NAME]
+    escolhidos = rng.choice(nutrientes, size=min(n_metas, len(nutrientes)), replace=False)
+
+    metas = {}
+    for k, i in enumerate(escolhidos):
+        valor = float(composicao[i])
+        tipo = k % 4  # metade só mínimo, um quarto só máximo, um quarto faixa
+        minimo = round(valor * (1 - folga), 6) if tipo in (0, 1, 3) else None
+        maximo = round(valor * (1 + folga), 6) + 1e-6 if tipo in (2, 3) else None
+        metas[matriz.linhas[i]] = [minimo, maximo]
+
+    restricoes = {}
+    for j in rng.choice(n, size=max(1, n // 10), replace=False):
+        restricoes[matriz.colunas[j]] = [None, round(max(float(x0[j]), 5.0) * (1 + folga), 6)]
+
+    return metas, restricoes
+
+
+def matriz_para_dataframe(matriz):
+    return pd.DataFrame(matriz.valores, index=matriz.linhas, columns=matriz.colunas)
+
+
+def matriz_para_csv(matriz):
+    # Formato vertical aceito pela importação: uma MP por linha
+    df = matriz_para_dataframe(matriz).T
+    df.index.name = "nome"
+    return df.to_csv().encode("utf-8")
+
+
+# ==============================================================
+# ESTATÍSTICAS
+# ==============================================================
+
+def resumir(tempos):
+    ms = np.asarray(tempos, dtype=float) * 1000
+    if not len(ms):
+        return {"n": 0}
+    return {
+        "n": int(len(ms)),
+        "media_ms": round(float(ms.mean()), 4),
+        "p50_ms": round(float(np.percentile(ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(ms, 95)), 4),
+        "max_ms": round(float(ms.max()), 4),
+    }
+
+
+def ambiente():
+    versoes = {}
+    for pacote in ("numpy", "scipy", "pandas", "pulp", "highspy", "fastapi", "pymongo"):
+        try:
+            modulo = __import__(pacote)
+            versoes[pacote] = getattr(modulo, "__version__", "?")
+        except ImportError:
+            versoes[pacote] = None
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=DIRETORIO,
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+
+    return {
+        "data": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "versoes": versoes,
+    }
+
+
+# ==============================================================
+# MOTOR: MONTAGEM × SOLVE × SERIALIZAÇÃO POR BACKEND
+# ==============================================================
+
+def medir_motor(matriz, metas, restricoes, solvers, repeticoes=5, incluir_original=True):
+    resultados = []
+    for solver in solvers:
+        montagem, solve, serializacao = [], [], []
+        status = custo = None
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            lp = montar_lp(matriz, restricoes, metas)
+            montagem.append(time.perf_counter() - inicio)
+
+            inicio = time.perf_counter()
+            solucao = resolver_lp(lp, solver)
+            solve.append(time.perf_counter() - inicio)
+
+            inicio = time.perf_counter()
+            resultado = montar_resultado(matriz, solucao)
+            json.dumps(resultado, ensure_ascii=False)
+            serializacao.append(time.perf_counter() - inicio)
+
+            status, custo = resultado["status"], resultado["custo_total"]
+
+        resultados.append({
+            "solver": solucao.solver,
+            "status": status,
+            "custo_total": custo,
+            "montagem": resumir(montagem),
+            "solve": resumir(solve),
+            "serializacao": resumir(serializacao),
+        })
+
+    if incluir_original:
+        # Caminho original (PuLP + pandas célula a célula): só o tempo total é separável
+        df = matriz_para_dataframe(matriz)
+        total = []
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            resultado = otimizar_formula(df, restricoes, metas)
+            json.dumps(resultado, ensure_ascii=False)
+            total.append(time.perf_counter() - inicio)
+        resultados.append({
+            "solver": "otimizar_formula",
+            "status": resultado["status"],
+            "custo_total": resultado["custo_total"],
+            "total": resumir(total),
+        })
+
+    return resultados
+
+
+# ==============================================================
+# MONGODB SIMULADO (mongomock com a interface assíncrona do pymongo)
+# ==============================================================
+
+class _CursorAssincrono:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._iterador = None
+
+    def batch_size(self, tamanho):
+        self._cursor = self._cursor.batch_size(tamanho)
+        return self
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    async def to_list(self, length=None):
+        return list(self._cursor)
+
+    def __aiter__(self):
+        self._iterador = iter(self._cursor)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterador)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class _OperacaoLote:
+    # Substitui ReplaceOne/UpdateOne do pymongo em main: atributos públicos para o bulk_write abaixo
+    metodo = None
+
+    def __init__(self, filtro, documento, upsert=False):
+        self.filtro = filtro
+        self.documento = documento
+        self.upsert = upsert
+
+
+class _ReplaceOne(_OperacaoLote):
+    metodo = "replace_one"
+
+
+class _UpdateOne(_OperacaoLote):
+    metodo = "update_one"
+
+
+class _ColecaoAssincrona:
+    def __init__(self, colecao):
+        self._colecao = colecao
+
+    def find(self, *args, **kwargs):
+        return _CursorAssincrono(self._colecao.find(*args, **kwargs))
+
+    async def aggregate(self, pipeline, **kwargs):
+        return _CursorAssincrono(self._colecao.aggregate(pipeline))
+
+    async def bulk_write(self, operacoes, ordered=True, **kwargs):
+        # As operações do pymongo atual não são compatíveis com o bulk_write do mongomock:
+        # simular_mongo troca as de main pelas do benchmark, aplicadas uma a uma
+        for op in operacoes:
+            if not isinstance(op, _OperacaoLote):
+                raise TypeError(f"Operação {type(op).__name__} não suportada no benchmark.")
+            getattr(self._colecao, op.metodo)(op.filtro, op.documento, upsert=op.upsert)
+
+    def __getattr__(self, nome):
+        metodo = getattr(self._colecao, nome)
+
+        async def assincrono(*args, **kwargs):
+            kwargs.pop("session", None)
+            return metodo(*args, **kwargs)
+
+        return assincrono
+
+
+class _BancoAssincrono:
+    def __init__(self, banco):
+        self._banco = banco
+
+    def __getitem__(self, nome):
+        return _ColecaoAssincrona(self._banco[nome])
+
+
+def simular_mongo(main, nome_banco="otimizador_bench"):
+    banco = _BancoAssincrono(mongomock.MongoClient()[nome_banco])
+    main.db = banco
+    main.mp_collection = banco["materias_primas"]
+    main.armazem_matrizes = ArmazemMatrizes(banco["matrizes"])
+    main.formulas_collection = banco["formulas"]
+    main.ReplaceOne, main.UpdateOne = _ReplaceOne, _UpdateOne
+    main.estado_mongo["ok"] = True
+    return banco
+
+
+def documentos_da_matriz(matriz, usuario_id):
+    valores = matriz.valores.T.tolist()
+    return [
+        {"usuario_id": usuario_id, "nome": mp, **dict(zip(matriz.linhas, linha))}
+        for mp, linha in zip(matriz.colunas, valores)
+    ]
+
+
+# ==============================================================
+# TESTE DE CARGA DA API (em processo, via ASGI)
+# ==============================================================
+
+def _tem_erro(resposta, corpo):
+    tipo = resposta.headers.get("content-type", "")
+    try:
+        if tipo.startswith("application/json"):
+            documentos = [json.loads(corpo)]
+        elif tipo.startswith("application/x-ndjson"):
+            documentos = [json.loads(linha) for linha in corpo.splitlines() if linha.strip()]
+        else:
+            return False
+    except ValueError:
+        return False
+    return any(isinstance(d, dict) and "erro" in d for d in documentos)
+
+
+async def _disparar(cliente, requisicoes, concorrencia):
+    # requisicoes: lista de funções cliente -> corrotina de resposta
+    semaforo = asyncio.Semaphore(concorrencia)
+    tempos, status = [], {}
+    erros = 0
+
+    async def uma(fazer):
+        nonlocal erros
+        async with semaforo:
+            inicio = time.perf_counter()
+            resposta = await fazer(cliente)
+            corpo = await resposta.aread()
+            tempos.append(time.perf_counter() - inicio)
+            status[resposta.status_code] = status.get(resposta.status_code, 0) + 1
+            # Alguns endpoints respondem 200 com {"erro": ...}: contam à parte
+            if _tem_erro(resposta, corpo):
+                erros += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(uma(fazer) for fazer in requisicoes))
+    duracao = time.perf_counter() - inicio
+
+    return {
+        **resumir(tempos),
+        "vazao_rps": round(len(requisicoes) / duracao, 2) if duracao else None,
+        "status": {str(k): v for k, v in sorted(status.items())},
+        "erros": erros,
+    }
+
+
+async def _medir_api(main, matriz, args, rng):
+    simular_mongo(main)
+    main.cache_matrizes.invalidar(USUARIO_BENCH)
+    await main.mp_collection.insert_many(documentos_da_matriz(matriz, USUARIO_BENCH))
+
+    problemas = [gerar_problema(matriz, args.metas, args.aperto, rng) for _ in range(args.requisicoes)]
+    formulacoes = []
+    for _ in range(args.requisicoes):
+        usadas = rng.choice(len(matriz.colunas), size=min(10, len(matriz.colunas)), replace=False)
+        formulacoes.append({matriz.colunas[j]: float(v) for j, v in zip(usadas, rng.dirichlet(np.ones(len(usadas))) * 100)})
+    csv_bytes = matriz_para_csv(matriz)
+
+    def otimizar(metas, restricoes):
+        corpo = {"usuario_id": USUARIO_BENCH, "metas": metas, "restricoes": restricoes}
+        return lambda c: c.post("/optimize", json=corpo)
+
+    def consultar(formulacao):
+        return lambda c: c.post("/consulta", json={"usuario_id": USUARIO_BENCH, "formulacao": formulacao})
+
+    def importar(c):
+        arquivo = {"file": ("bench.csv", io.BytesIO(csv_bytes), "text/csv")}
+        return c.post("/importar_materias_primas", data={"usuario_id": USUARIO_BENCH}, files=arquivo)
+
+    transporte = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transporte, base_url="http://bench", timeout=None) as cliente:
+        # Aquecimento: carrega a matriz do usuário no cache
+        await cliente.get("/data", params={"usuario_id": USUARIO_BENCH})
+
+        cenarios = {
+            "optimize_sem_cache": [otimizar(m, r) for m, r in problemas],
+            "optimize_com_cache": [otimizar(*problemas[0])] * args.requisicoes,
+            "consulta": [consultar(f) for f in formulacoes],
+            "consulta_lote": [
+                lambda c: c.post("/consulta", json={"usuario_id": USUARIO_BENCH, "formulacoes": formulacoes})
+            ] * max(1, args.requisicoes // 10),
+            "data": [lambda c: c.get("/data", params={"usuario_id": USUARIO_BENCH})] * args.requisicoes,
+            # A importação invalida o cache da matriz e regrava todos os documentos: sequencial
+            "importar_materias_primas": [importar] * args.importacoes,
+        }
+
+        resultados = {}
+        for nome, requisicoes in cenarios.items():
+            concorrencia = 1 if nome == "importar_materias_primas" else args.concorrencia
+            resultados[nome] = {"concorrencia": concorrencia, **await _disparar(cliente, requisicoes, concorrencia)}
+        return resultados
+
+
+def medir_api(matriz, args, rng):
+    if mongomock is None or httpx is None:
+        return {"erro": "mongomock e httpx são necessários para o teste de carga da API."}
+
+    import main
+
+    async def executar():
+        # Mesmo startup/shutdown do servidor (fila de jobs, cache de soluções)
+        async with main.app.router.lifespan_context(main.app):
+            return await _medir_api(main, matriz, args, rng)
+
+    return asyncio.run(executar())
+
+
+# ==============================================================
+# COMPARAÇÃO COM UMA EXECUÇÃO ANTERIOR
+# ==============================================================
+
+def _metricas(resultado):
+    # {(grupo, caso, etapa): p50_ms}
+    metricas = {}
+    for caso in resultado.get("casos", []):
+        tamanho = f'{caso["mps"]}x{caso["nutrientes"]}'
+        for motor in caso.get("motor", []):
+            for etapa in ("montagem", "solve", "serializacao", "total"):
+                if etapa in motor:
+                    metricas[("motor", tamanho, f'{motor["solver"]}.{etapa}')] = motor[etapa].get("p50_ms")
+        for endpoint, dados in (caso.get("api") or {}).items():
+            if isinstance(dados, dict) and "p50_ms" in dados:
+                metricas[("api", tamanho, endpoint)] = dados["p50_ms"]
+    return metricas
+
+
+def comparar(atual, anterior, limite=1.2):
+    base = _metricas(anterior)
+    comparacao = []
+    for chave, valor in _metricas(atual).items():
+        antes = base.get(chave)
+        if not antes or valor is None:
+            continue
+        razao = valor / antes
+        comparacao.append({
+            "grupo": chave[0], "caso": chave[1], "metrica": chave[2],
+            "anterior_ms": antes, "atual_ms": valor, "razao": round(razao, 3),
+            "regressao": razao > limite,
+        })
+    return comparacao
+
+
+# ==============================================================
+# LINHA DE COMANDO
+# ==============================================================
+
+def _lista_int(texto):
+    return [int(v) for v in texto.split(",") if v.strip()]
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do otimizador de formulações.")
+    parser.add_argument("--mps", type=_lista_int, default=[50, 200, 1000], help="ex.: 50,200,1000")
+    parser.add_argument("--nutrientes", type=_lista_int, default=[30], help="ex.: 30,100")
+    parser.add_argument("--densidade", type=float, default=0.3, help="fração de micronutrientes não nulos")
+    parser.add_argument("--metas", type=int, default=10, help="metas nutricionais por problema")
+    parser.add_argument("--aperto", type=float, default=0.5, help="0 = metas folgadas, 1 = justas")
+    parser.add_argument("--solvers", default=",".join(solvers_disponiveis()))
+    parser.add_argument("--repeticoes", type=int, default=5)
+    parser.add_argument("--sem-original", action="store_true", help="não mede otimizar_formula (PuLP original)")
+    parser.add_argument("--sem-api", action="store_true", help="pula o teste de carga dos endpoints")
+    parser.add_argument("--requisicoes", type=int, default=100, help="requisições por endpoint")
+    parser.add_argument("--concorrencia", type=int, default=8)
+    parser.add_argument("--importacoes", type=int, default=3)
+    parser.add_argument("--semente", type=int, default=0)
+    # O CBC escreve no stdout do processo: os resultados vão sempre para arquivo
+    parser.add_argument("--saida", default="benchmark.json", help="arquivo JSON de resultados")
+    parser.add_argument("--comparar", help="JSON de uma execução anterior")
+    parser.add_argument("--limite-regressao", type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    solvers = [s for s in args.solvers.split(",") if s]
+    casos = []
+    for n_mps in args.mps:
+        for n_nutrientes in args.nutrientes:
+            rng = np.random.default_rng(args.semente)
+            matriz = gerar_matriz_sintetica(n_mps, n_nutrientes, args.densidade, args.semente)
+            metas, restricoes = gerar_problema(matriz, args.metas, args.aperto, rng)
+            print(f"▶ {n_mps} MPs × {n_nutrientes} nutrientes", file=sys.stderr)
+
+            caso = {
+                "mps": n_mps,
+                "nutrientes": n_nutrientes,
+                "motor": medir_motor(
+                    matriz, metas, restricoes, solvers, args.repeticoes, incluir_original=not args.sem_original
+                ),
+            }
+            if not args.sem_api:
+                caso["api"] = medir_api(matriz, args, rng)
+            casos.append(caso)
+
+    resultado = {
+        "ambiente": ambiente(),
+        "parametros": {k: v for k, v in vars(args).items() if k not in ("saida", "comparar")},
+        "casos": casos,
+    }
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            resultado["comparacao"] = comparar(resultado, json.load(f), args.limite_regressao)
+        for item in resultado["comparacao"]:
+            if item["regressao"]:
+                print(
+                    f'⚠️ {item["grupo"]} {item["caso"]} {item["metrica"]}: '
+                    f'{item["anterior_ms"]} → {item["atual_ms"]} ms (×{item["razao"]})',
+                    file=sys.stderr,
+                )
+
+    with open(args.saida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"✅ Resultados gravados em {args.saida}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,99 @@
+import itertools
+import threading
+from collections import OrderedDict
+
+
+# ==============================================================
+# IDENTIFICADOR DE VERSÃO ("usuario:vN" persistida | "usuario:N" local)
+# ==============================================================
+
+def separar_versao(versao):
+    # "usuario:v7" → ("usuario", 7); versões locais de um processo → None
+    usuario_id, _, numero = str(versao).rpartition(":v")
+    if not usuario_id or not numero.isdigit():
+        return None
+    return usuario_id, int(numero)
+
+
+# ==============================================================
+# CACHE DE MATRIZES POR USUÁRIO (LRU por quantidade e por tamanho)
+# ==============================================================
+
+class CacheMatrizes:
+    def __init__(self, max_usuarios=128, max_bytes=256 * 1024 * 1024):
+        self.max_usuarios = max_usuarios
+        self.max_bytes = max_bytes
+        self._entradas = OrderedDict()  # usuario_id -> (versao, matriz, tamanho)
+        self._versoes = {}              # versao -> usuario_id
+        self._bytes = 0
+        self._contador = itertools.count(1)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _tamanho(matriz):
+        nomes = sum(len(str(n)) for n in matriz.linhas) + sum(len(str(n)) for n in matriz.colunas)
+        return matriz.valores.nbytes + nomes
+
+    def _remover(self, usuario_id):
+        versao, _, tamanho = self._entradas.pop(usuario_id)
+        self._versoes.pop(versao, None)
+        self._bytes -= tamanho
+
+    def obter(self, usuario_id):
+        with self._lock:
+            entrada = self._entradas.get(usuario_id)
+            if entrada is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entradas.move_to_end(usuario_id)
+            return entrada[0], entrada[1]
+
+    def obter_por_versao(self, versao):
+        with self._lock:
+            usuario_id = self._versoes.get(versao)
+            if usuario_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entradas.move_to_end(usuario_id)
+            return self._entradas[usuario_id][1]
+
+    def guardar(self, usuario_id, matriz, versao_persistida=None):
+        # Com a versão do snapshot no Mongo o identificador vale em todos os processos;
+        # sem ela, contador local
+        tamanho = self._tamanho(matriz)
+        with self._lock:
+            if usuario_id in self._entradas:
+                self._remover(usuario_id)
+
+            if versao_persistida is not None:
+                versao = f"{usuario_id}:v{versao_persistida}"
+            else:
+                versao = f"{usuario_id}:{next(self._contador)}"
+            self._entradas[usuario_id] = (versao, matriz, tamanho)
+            self._versoes[versao] = usuario_id
+            self._bytes += tamanho
+
+            # Despeja os menos usados recentemente (a entrada nova sempre fica)
+            while len(self._entradas) > 1 and (
+                len(self._entradas) > self.max_usuarios or self._bytes > self.max_bytes
+            ):
+                self._remover(next(iter(self._entradas)))
+            return versao
+
+    def invalidar(self, usuario_id):
+        with self._lock:
+            if usuario_id in self._entradas:
+                self._remover(usuario_id)
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                "usuarios": len(self._entradas),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
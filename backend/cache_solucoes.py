@@ -0,0 +1,177 @@
+import copy
+import hashlib
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# ==============================================================
+# CHAVE CANÔNICA DO PROBLEMA
+# ==============================================================
+
+def _limites_canonicos(limites):
+    canon = {}
+    for nome, par in (limites or {}).items():
+        min_val, max_val = par
+        canon[str(nome)] = [
+            None if min_val is None else float(min_val),
+            None if max_val is None else float(max_val),
+        ]
+    return canon
+
+
+def chave_problema(matriz, metas, restricoes, **opcoes):
+    # Mesma matriz numérica + mesmas metas/restrições (em qualquer ordem) → mesma chave
+    payload = json.dumps(
+        {
+            "metas": _limites_canonicos(metas),
+            "restricoes": _limites_canonicos(restricoes),
+            "opcoes": opcoes,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    h = hashlib.sha256(matriz.assinatura().encode())
+    h.update(payload.encode())
+    return h.hexdigest()
+
+
+# ==============================================================
+# CACHE DE SOLUÇÕES (LRU + TTL, persistência opcional em SQLite)
+# ==============================================================
+
+class CacheSolucoes:
+    """LRU em memória; com caminho_sqlite as entradas também vão para o disco.
+
+    A gravação no SQLite fica com uma thread própria (guardar só enfileira). A leitura do disco
+    acontece em obter quando a chave não está na memória: com persistente=True, quem chama de
+    dentro do loop de eventos deve rodar obter fora dele.
+    """
+
+    def __init__(self, max_entradas=1024, ttl=3600, caminho_sqlite=None):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._entradas = OrderedDict()  # chave -> (criado_em, resultado)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._db = None
+        self._lock_db = threading.Lock()
+        self._fila = queue.Queue()
+        self._escritor = None
+        if caminho_sqlite:
+            self._db = sqlite3.connect(caminho_sqlite, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS solucoes ("
+                "chave TEXT PRIMARY KEY, criado_em REAL NOT NULL, resultado TEXT NOT NULL)"
+            )
+            self._db.execute("DELETE FROM solucoes WHERE criado_em < ?", (time.time() - ttl,))
+            self._db.commit()
+            self._escritor = threading.Thread(
+                target=self._gravar_sqlite, args=(caminho_sqlite,), name="cache-solucoes-sqlite", daemon=True
+            )
+            self._escritor.start()
+
+    @property
+    def persistente(self):
+        return self._db is not None
+
+    def _gravar_sqlite(self, caminho_sqlite):
+        # Conexão própria da thread; junta o que estiver na fila em uma única transação
+        db = sqlite3.connect(caminho_sqlite)
+        try:
+            while True:
+                itens = [self._fila.get()]
+                while True:
+                    try:
+                        itens.append(self._fila.get_nowait())
+                    except queue.Empty:
+                        break
+                linhas = [item for item in itens if item is not None]
+                if linhas:
+                    try:
+                        db.executemany(
+                            "INSERT OR REPLACE INTO solucoes (chave, criado_em, resultado) VALUES (?, ?, ?)",
+                            [(chave, criado_em, json.dumps(resultado, ensure_ascii=False))
+                             for chave, criado_em, resultado in linhas],
+                        )
+                        db.commit()
+                    except Exception as e:
+                        print("⚠️ Falha ao persistir soluções no SQLite:", e)
+                if len(linhas) < len(itens):
+                    return
+        finally:
+            db.close()
+
+    def encerrar(self):
+        # Grava o que ainda está na fila antes de sair
+        if self._escritor is not None:
+            self._fila.put(None)
+            self._escritor.join(timeout=10)
+            self._escritor = None
+
+    def _expirado(self, criado_em):
+        return time.time() - criado_em > self.ttl
+
+    def _ler_sqlite(self, chave):
+        if self._db is None:
+            return None
+        with self._lock_db:
+            linha = self._db.execute(
+                "SELECT criado_em, resultado FROM solucoes WHERE chave = ?", (chave,)
+            ).fetchone()
+        if linha is None or self._expirado(linha[0]):
+            return None
+        return linha[0], json.loads(linha[1])
+
+    def _inserir_memoria(self, chave, criado_em, resultado):
+        self._entradas[chave] = (criado_em, resultado)
+        self._entradas.move_to_end(chave)
+        while len(self._entradas) > self.max_entradas:
+            self._entradas.popitem(last=False)
+
+    def obter(self, chave):
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is not None and self._expirado(entrada[0]):
+                del self._entradas[chave]
+                entrada = None
+            if entrada is not None:
+                self._entradas.move_to_end(chave)
+
+        # Disco fora do lock: consultas em memória não esperam o SQLite
+        if entrada is None:
+            entrada = self._ler_sqlite(chave)
+
+        with self._lock:
+            if entrada is not None and chave not in self._entradas:
+                self._inserir_memoria(chave, *entrada)
+            if entrada is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return copy.deepcopy(entrada[1])
+
+    def guardar(self, chave, resultado):
+        criado_em = time.time()
+        resultado = copy.deepcopy(resultado)
+        with self._lock:
+            self._inserir_memoria(chave, criado_em, resultado)
+        if self._escritor is not None:
+            self._fila.put((chave, criado_em, resultado))
+
+    def estatisticas(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entradas": len(self._entradas),
+                "hits": self.hits,
+                "misses": self.misses,
+                "taxa_acerto": round(self.hits / total, 4) if total else 0.0,
+                "persistente": self._db is not None,
+            }
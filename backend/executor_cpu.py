@@ -0,0 +1,75 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+import metricas
+
+
+# ==============================================================
+# EXECUTOR LIMITADO PARA TRABALHO BLOQUEANTE (solver, pandas)
+# ==============================================================
+
+def _apos_fila(chamada, enfileirado):
+    metricas.registrar_etapa("fila_cpu", time.perf_counter() - enfileirado)
+    return chamada()
+
+
+class ExecutorLimitado:
+    """Pool de threads com fila limitada: acima de workers + fila responde 503."""
+
+    def __init__(self, max_workers=4, max_fila=32):
+        self.max_workers = max_workers
+        self.max_fila = max_fila
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cpu")
+        # Liberado quando a tarefa termina no thread (não quando quem espera é cancelado)
+        self._ocupados = 0
+        self._lock = threading.Lock()
+
+    def _liberar(self, _futuro):
+        with self._lock:
+            self._ocupados -= 1
+
+    async def executar(self, fn, *args, **kwargs):
+        with self._lock:
+            lotado = self._ocupados >= self.max_workers + self.max_fila
+            if not lotado:
+                self._ocupados += 1
+        if lotado:
+            raise HTTPException(
+                status_code=503,
+                detail="Servidor sobrecarregado. Tente novamente em instantes.",
+                headers={"Retry-After": "1"},
+            )
+
+        chamada = functools.partial(fn, *args, **kwargs)
+        if metricas.ATIVO:
+            chamada = functools.partial(_apos_fila, chamada, time.perf_counter())
+
+        # O contexto da requisição segue para o thread (etapas do Server-Timing)
+        contexto = contextvars.copy_context()
+        try:
+            futuro = self._pool.submit(contexto.run, chamada)
+        except BaseException:
+            self._liberar(None)
+            raise
+        # Cliente desconectado cancela a espera, mas o thread segue ocupado até terminar
+        futuro.add_done_callback(self._liberar)
+        return await asyncio.wrap_future(futuro)
+
+    def estatisticas(self):
+        with self._lock:
+            ocupados = self._ocupados
+        return {
+            "workers": self.max_workers,
+            "fila_max": self.max_fila,
+            "em_execucao": min(ocupados, self.max_workers),
+            "na_fila": max(ocupados - self.max_workers, 0),
+        }
+
+    def encerrar(self):
+        self._pool.shutdown(cancel_futures=True)
@@ -0,0 +1,165 @@
+import csv
+import io
+import tempfile
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow é opcional: sem ele o formato parquet fica indisponível
+    pa = pq = None
+
+
+COLUNAS_INICIAIS = ["nome", "usuario_id", "Custo"]
+COLUNAS_TEXTO = {"nome", "usuario_id"}
+# Campos aninhados (variabilidade do modo robusto) não cabem em uma tabela; "importacao" é interno
+CAMPOS_IGNORADOS = {"_id", "importacao", "desvios", "amostras"}
+TAMANHO_BLOCO_ARQUIVO = 64 * 1024
+
+MEDIA_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def formatos_disponiveis():
+    formatos = ["csv"]
+    if Workbook is not None:
+        formatos.append("xlsx")
+    if pq is not None:
+        formatos.append("parquet")
+    return formatos
+
+
+# ==============================================================
+# COLUNAS E LEITURA DO CURSOR EM LOTES
+# ==============================================================
+
+async def colunas_exportacao(colecao, filtro):
+    # União das chaves calculada no servidor: o cabeçalho é conhecido antes da primeira linha
+    primeiro = await colecao.find_one(filtro, {"_id": 0})
+    if primeiro is None:
+        return []
+
+    cursor = await colecao.aggregate([
+        {"$match": filtro},
+        {"$project": {"_id": 0, "k": {"$objectToArray": "$$ROOT"}}},
+        {"$unwind": "$k"},
+        {"$group": {"_id": "$k.k"}},
+    ])
+    chaves = {d["_id"] async for d in cursor} - CAMPOS_IGNORADOS
+
+    # nome, usuario_id e Custo primeiro; depois a ordem do primeiro documento e o restante
+    colunas = [c for c in COLUNAS_INICIAIS if c in chaves]
+    colunas += [c for c in primeiro if c in chaves and c not in colunas]
+    colunas += sorted(chaves - set(colunas))
+    return colunas
+
+
+async def lotes_cursor(cursor, tamanho_lote):
+    lote = []
+    async for doc in cursor:
+        lote.append(doc)
+        if len(lote) >= tamanho_lote:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+# ==============================================================
+# GERADORES POR FORMATO
+# ==============================================================
+
+async def gerar_csv(cursor, colunas, tamanho_lote):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+
+    escritor.writerow(colunas)
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+
+    async for lote in lotes_cursor(cursor, tamanho_lote):
+        buffer.seek(0)
+        buffer.truncate()
+        escritor.writerows([doc.get(c, "") for c in colunas] for doc in lote)
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _BufferDrenavel(io.RawIOBase):
+    """Destino de escrita cujo conteúdo é repassado (e descartado) a cada row group."""
+
+    def __init__(self):
+        self._partes = []
+        self._posicao = 0
+
+    def writable(self):
+        return True
+
+    def write(self, dados):
+        self._partes.append(bytes(dados))
+        self._posicao += len(dados)
+        return len(dados)
+
+    def tell(self):
+        return self._posicao
+
+    def drenar(self):
+        dados = b"".join(self._partes)
+        self._partes = []
+        return dados
+
+
+def _tabela_parquet(lote, colunas, schema):
+    dados = {}
+    for c in colunas:
+        valores = [doc.get(c) for doc in lote]
+        if c in COLUNAS_TEXTO:
+            dados[c] = [None if v is None else str(v) for v in valores]
+        else:
+            dados[c] = [v if isinstance(v, (int, float)) and not isinstance(v, bool) else None for v in valores]
+    return pa.Table.from_pydict(dados, schema=schema)
+
+
+async def gerar_parquet(cursor, colunas, tamanho_lote):
+    # Nutrientes como float64; valores não numéricos ficam nulos
+    schema = pa.schema([(c, pa.string() if c in COLUNAS_TEXTO else pa.float64()) for c in colunas])
+    destino = _BufferDrenavel()
+    escritor = pq.ParquetWriter(destino, schema)
+
+    async for lote in lotes_cursor(cursor, tamanho_lote):
+        escritor.write_table(_tabela_parquet(lote, colunas, schema))
+        dados = destino.drenar()
+        if dados:
+            yield dados
+
+    escritor.close()
+    yield destino.drenar()
+
+
+async def gerar_xlsx(cursor, colunas, tamanho_lote, executar):
+    # O XLSX é um zip finalizado só no save(): o modo write-only mantém a memória limitada
+    # (linhas vão para arquivo temporário) e o resultado é enviado em blocos
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("MateriasPrimas")
+    ws.append(colunas)
+
+    def anexar(lote):
+        for doc in lote:
+            ws.append([doc.get(c) for c in colunas])
+
+    async for lote in lotes_cursor(cursor, tamanho_lote):
+        await executar(anexar, lote)
+
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as arquivo:
+        await executar(wb.save, arquivo)
+        arquivo.seek(0)
+        while True:
+            bloco = arquivo.read(TAMANHO_BLOCO_ARQUIVO)
+            if not bloco:
+                break
+            yield bloco
@@ -0,0 +1,357 @@
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from optimization_engine import (
+    otimizar_formula_matricial,
+    otimizar_formula_mip,
+    otimizar_formula_robusta,
+    analisar_sensibilidade,
+    otimizar_cenario,
+)
+import transporte
+
+
+# ==============================================================
+# JOBS DE OTIMIZAÇÃO (executados em processo separado)
+# ==============================================================
+
+def _json_padrao(valor):
+    # Escalares numpy que sobram nos resultados do motor
+    if hasattr(valor, "item"):
+        return valor.item()
+    if hasattr(valor, "tolist"):
+        return valor.tolist()
+    raise TypeError(f"Tipo não serializável: {type(valor).__name__}")
+
+
+def executar_otimizacao(parametros):
+    """parametros: corpo do /optimize (ou do /optimize/batch) com a matriz já em forma compacta."""
+    matriz = transporte.matriz_de_compacta(parametros["matriz"])
+    solver = parametros.get("solver")
+    metas = parametros.get("metas", {})
+    restricoes = parametros.get("restricoes", {})
+
+    if parametros.get("cenarios"):
+        resultados = []
+        for indice, cenario in enumerate(parametros["cenarios"]):
+            try:
+                resultado = otimizar_cenario(matriz, cenario, solver)
+            except Exception as e:
+                resultado = {"erro": str(e)}
+            resultados.append({"indice": indice, "id": cenario.get("id", indice), **resultado})
+        return {"resultados": resultados}
+
+    if parametros.get("robusto"):
+        return otimizar_formula_robusta(
+            matriz, restricoes=restricoes, metas=metas,
+            variabilidade=parametros.get("variabilidade") or {}, opcoes=parametros["robusto"], solver=solver,
+        )
+    if parametros.get("mip"):
+        return otimizar_formula_mip(matriz, restricoes=restricoes, metas=metas, opcoes=parametros["mip"], solver=solver)
+    rotina = analisar_sensibilidade if parametros.get("sensibilidade") else otimizar_formula_matricial
+    return rotina(matriz, restricoes=restricoes, metas=metas, solver=solver)
+
+
+def _processo_job(funcao, parametros, conexao):
+    try:
+        conexao.send(("ok", json.dumps(funcao(parametros), ensure_ascii=False, default=_json_padrao)))
+    except Exception as e:
+        conexao.send(("erro", str(e)))
+    finally:
+        conexao.close()
+
+
+# ==============================================================
+# FILA PERSISTENTE EM SQLITE (sem broker externo)
+# ==============================================================
+
+TERMINAIS = ("concluido", "erro", "cancelado", "tempo_esgotado")
+
+INTERVALO_VERIFICACAO = 0.25  # s entre checagens de cancelamento/tempo de um job em execução
+INTERVALO_OCIOSO = 1.0  # s entre buscas por jobs novos (submetidos por outros processos)
+INTERVALO_HEARTBEAT = 5.0
+ORFAO_APOS = 30.0  # job "executando" sem heartbeat há mais que isso: dono morreu
+MAX_TENTATIVAS = 3
+
+_CAMPOS = (
+    "id", "status", "criado_em", "iniciado_em", "concluido_em", "tempo_limite",
+    "tentativas", "cancelar", "erro",
+)
+
+
+def contexto_processos():
+    # fork direto não é seguro (o servidor tem threads: event loop, executor, HiGHS).
+    # forkserver parte de um processo limpo com o motor já importado: cada job começa em
+    # milissegundos em vez de reimportar pandas/scipy como no spawn
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    contexto = multiprocessing.get_context("forkserver")
+    contexto.set_forkserver_preload([__name__])
+    return contexto
+
+
+class FilaJobs:
+    """Jobs persistidos em SQLite; cada um roda em um processo próprio, que pode ser
+    encerrado ao estourar o tempo limite ou ao ser cancelado.
+
+    Vários processos do servidor podem compartilhar o mesmo arquivo: a reserva de um job
+    é atômica (BEGIN IMMEDIATE) e o total de jobs em execução respeita max_workers entre
+    todos eles. Jobs cujo dono parou de mandar heartbeat voltam para a fila.
+    """
+
+    def __init__(self, caminho_sqlite, funcao=executar_otimizacao, max_workers=2,
+                 tempo_limite=600, max_fila=100, retencao=86400):
+        self.caminho_sqlite = caminho_sqlite
+        self.funcao = funcao
+        self.max_workers = max_workers
+        self.tempo_limite = tempo_limite
+        self.max_fila = max_fila
+        self.retencao = retencao
+        self.dono = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._contexto = contexto_processos()
+        self._aviso = threading.Event()
+        self._parar = threading.Event()
+        self._threads = []
+        self._ultima_limpeza = 0.0
+
+        with self._conectar() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, parametros TEXT NOT NULL, "
+                "resultado TEXT, erro TEXT, criado_em REAL NOT NULL, iniciado_em REAL, "
+                "concluido_em REAL, tempo_limite REAL NOT NULL, tentativas INTEGER NOT NULL DEFAULT 0, "
+                "cancelar INTEGER NOT NULL DEFAULT 0, dono TEXT, heartbeat REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, criado_em)")
+
+    def _conectar(self):
+        # Uma conexão por operação: usada por vários threads e processos
+        db = sqlite3.connect(self.caminho_sqlite, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return _Conexao(db)
+
+    # ----------------------------------------------------------
+    # API usada pelos endpoints
+    # ----------------------------------------------------------
+
+    def submeter(self, parametros, tempo_limite=None):
+        tempo_limite = min(float(tempo_limite or self.tempo_limite), self.tempo_limite)
+        job_id = uuid.uuid4().hex
+        with self._conectar() as db:
+            db.execute("BEGIN IMMEDIATE")
+            na_fila = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'na_fila'").fetchone()[0]
+            if na_fila >= self.max_fila:
+                db.execute("ROLLBACK")
+                raise HTTPException(
+                    status_code=503,
+                    detail="Fila de jobs cheia. Tente novamente mais tarde.",
+                    headers={"Retry-After": "30"},
+                )
+            db.execute(
+                "INSERT INTO jobs (id, status, parametros, criado_em, tempo_limite) VALUES (?, 'na_fila', ?, ?, ?)",
+                (job_id, json.dumps(parametros, ensure_ascii=False), time.time(), tempo_limite),
+            )
+            db.execute("COMMIT")
+        self._aviso.set()
+        return self.obter(job_id, com_resultado=False)
+
+    def obter(self, job_id, com_resultado=True):
+        colunas = ", ".join(_CAMPOS + (("resultado",) if com_resultado else ()))
+        with self._conectar() as db:
+            linha = db.execute(f"SELECT {colunas} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if linha is None:
+            return None
+        job = dict(linha)
+        job["cancelar"] = bool(job["cancelar"])
+        if com_resultado:
+            job["resultado"] = json.loads(job["resultado"]) if job["resultado"] else None
+        return job
+
+    def cancelar(self, job_id):
+        # Na fila: cancelado na hora. Em execução: o dono encerra o processo na próxima checagem
+        with self._conectar() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(
+                "UPDATE jobs SET status = 'cancelado', concluido_em = ? WHERE id = ? AND status = 'na_fila'",
+                (time.time(), job_id),
+            )
+            db.execute("UPDATE jobs SET cancelar = 1 WHERE id = ? AND status = 'executando'", (job_id,))
+            db.execute("COMMIT")
+        return self.obter(job_id, com_resultado=False)
+
+    def estatisticas(self):
+        with self._conectar() as db:
+            contagens = dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {
+            "workers": self.max_workers,
+            "fila_max": self.max_fila,
+            **{status: contagens.get(status, 0) for status in ("na_fila", "executando") + TERMINAIS},
+        }
+
+    # ----------------------------------------------------------
+    # Workers
+    # ----------------------------------------------------------
+
+    def iniciar(self):
+        self._parar.clear()
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self._laco, name=f"job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def encerrar(self):
+        # Jobs interrompidos voltam para a fila (sem contar tentativa) e rodam no próximo start
+        self._parar.set()
+        self._aviso.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _laco(self):
+        while not self._parar.is_set():
+            try:
+                job = self._reservar()
+            except sqlite3.Error as e:
+                print("⚠️ Erro na fila de jobs:", e)
+                job = None
+            if job is None:
+                self._aviso.wait(INTERVALO_OCIOSO)
+                self._aviso.clear()
+                continue
+            self._executar(job)
+
+    def _reservar(self):
+        agora = time.time()
+        with self._conectar() as db:
+            db.execute("BEGIN IMMEDIATE")
+            # Donos sem heartbeat: o job volta para a fila ou falha após MAX_TENTATIVAS
+            db.execute(
+                "UPDATE jobs SET status = CASE WHEN tentativas >= ? THEN 'erro' ELSE 'na_fila' END, "
+                "erro = CASE WHEN tentativas >= ? THEN 'Worker interrompido repetidamente.' END, "
+                "concluido_em = CASE WHEN tentativas >= ? THEN ? END, dono = NULL "
+                "WHERE status = 'executando' AND heartbeat < ?",
+                (MAX_TENTATIVAS, MAX_TENTATIVAS, MAX_TENTATIVAS, agora, agora - ORFAO_APOS),
+            )
+            if agora - self._ultima_limpeza > 600:
+                self._ultima_limpeza = agora
+                db.execute(
+                    "DELETE FROM jobs WHERE status IN (?, ?, ?, ?) AND concluido_em < ?",
+                    TERMINAIS + (agora - self.retencao,),
+                )
+
+            em_execucao = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'executando'").fetchone()[0]
+            linha = None
+            if em_execucao < self.max_workers:
+                linha = db.execute(
+                    "SELECT id, parametros, tempo_limite FROM jobs WHERE status = 'na_fila' "
+                    "ORDER BY criado_em LIMIT 1"
+                ).fetchone()
+            if linha is not None:
+                db.execute(
+                    "UPDATE jobs SET status = 'executando', dono = ?, iniciado_em = ?, heartbeat = ?, "
+                    "tentativas = tentativas + 1 WHERE id = ?",
+                    (self.dono, agora, agora, linha["id"]),
+                )
+            db.execute("COMMIT")
+        return dict(linha) if linha is not None else None
+
+    def _finalizar(self, job_id, status, resultado=None, erro=None):
+        # Só o dono atual grava: um job dado como órfão e reservado por outro não é sobrescrito
+        with self._conectar() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, resultado = ?, erro = ?, concluido_em = ?, dono = NULL "
+                "WHERE id = ? AND dono = ? AND status = 'executando'",
+                (status, resultado, erro, time.time(), job_id, self.dono),
+            )
+
+    def _devolver(self, job_id):
+        with self._conectar() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'na_fila', dono = NULL, tentativas = tentativas - 1 "
+                "WHERE id = ? AND dono = ? AND status = 'executando'",
+                (job_id, self.dono),
+            )
+
+    def _executar(self, job):
+        job_id = job["id"]
+        parametros = json.loads(job["parametros"])
+        # MIP: o solver para um pouco antes do limite e devolve a melhor solução encontrada
+        if parametros.get("mip"):
+            mip = parametros["mip"]
+            mip["tempo_limite"] = min(float(mip.get("tempo_limite") or job["tempo_limite"]), 0.9 * job["tempo_limite"])
+
+        receptor, emissor = self._contexto.Pipe(duplex=False)
+        processo = self._contexto.Process(
+            target=_processo_job, args=(self.funcao, parametros, emissor), daemon=True
+        )
+        processo.start()
+        emissor.close()
+
+        inicio = time.monotonic()
+        ultimo_heartbeat = inicio
+        try:
+            while True:
+                if receptor.poll(INTERVALO_VERIFICACAO):
+                    try:
+                        tipo, conteudo = receptor.recv()
+                    except EOFError:
+                        self._finalizar(job_id, "erro", erro=f"Processo do job terminou com código {processo.exitcode}.")
+                        return
+                    if tipo == "ok":
+                        self._finalizar(job_id, "concluido", resultado=conteudo)
+                    else:
+                        self._finalizar(job_id, "erro", erro=conteudo)
+                    return
+
+                agora = time.monotonic()
+                if self._parar.is_set():
+                    self._devolver(job_id)
+                    return
+                if agora - inicio > job["tempo_limite"]:
+                    self._finalizar(job_id, "tempo_esgotado", erro=f"Tempo limite de {job['tempo_limite']:g} s excedido.")
+                    return
+
+                with self._conectar() as db:
+                    if agora - ultimo_heartbeat >= INTERVALO_HEARTBEAT:
+                        ultimo_heartbeat = agora
+                        db.execute(
+                            "UPDATE jobs SET heartbeat = ? WHERE id = ? AND dono = ?",
+                            (time.time(), job_id, self.dono),
+                        )
+                    linha = db.execute("SELECT cancelar, dono FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if linha is None or linha["dono"] != self.dono:
+                    return  # removido ou reassumido por outro worker
+                if linha["cancelar"]:
+                    self._finalizar(job_id, "cancelado")
+                    return
+        finally:
+            if processo.is_alive():
+                processo.terminate()
+            processo.join(5)
+            if processo.is_alive():
+                processo.kill()
+                processo.join()
+            receptor.close()
+
+
+class _Conexao:
+    # sqlite3.Connection como context manager só faz commit/rollback; aqui também fecha
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, tipo, *exc):
+        if tipo is not None and self.db.in_transaction:
+            self.db.rollback()
+        self.db.close()
+        return False
@@ -0,0 +1,163 @@
+import codecs
+import csv
+import io
+from itertools import chain, islice
+
+import pandas as pd
+
+try:
+    from openpyxl import load_workbook
+except ImportError:  # sem openpyxl apenas CSV (e .xls via pandas) são aceitos
+    load_workbook = None
+
+
+COLUNAS_NOME = ["nome", "Nome", "MATÉRIA-PRIMA", "Matéria-Prima", "Matéria prima", "matéria-prima"]
+COLUNAS_CUSTO = ["Custo", "custo", "Cost", "Preço"]
+
+
+class FormatoInvalido(ValueError):
+    pass
+
+
+# ==============================================================
+# LEITURA EM UMA ÚNICA PASSAGEM (linhas como listas de valores)
+# ==============================================================
+
+def _bytes_latin1(erro):
+    # Byte inválido em UTF-8 depois da amostra (arquivo com trechos em latin1): lê como latin1
+    return erro.object[erro.start:erro.end].decode("latin1"), erro.end
+
+
+codecs.register_error("importacao_latin1", _bytes_latin1)
+
+
+def _detectar_encoding(arquivo, amostra=1 << 20):
+    # UTF-8 quando a amostra inicial decodifica sem erro, senão latin1. Como a amostra não
+    # cobre o arquivo todo, o UTF-8 é lido com o tratador "importacao_latin1" (ver iterar_linhas)
+    inicio = arquivo.read(amostra)
+    arquivo.seek(0)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(inicio, final=False)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "latin1"
+
+
+def iterar_linhas(arquivo, filename):
+    nome = filename.lower()
+
+    if nome.endswith(".csv"):
+        texto = io.TextIOWrapper(
+            arquivo, encoding=_detectar_encoding(arquivo), errors="importacao_latin1", newline=""
+        )
+        for linha in csv.reader(texto):
+            yield [v if v != "" else None for v in linha]
+
+    elif nome.endswith(".xlsx") and load_workbook is not None:
+        # Modo somente-leitura: as linhas são lidas do XML sob demanda
+        wb = load_workbook(arquivo, read_only=True, data_only=True)
+        try:
+            for linha in wb.worksheets[0].iter_rows(values_only=True):
+                yield list(linha)
+        finally:
+            wb.close()
+
+    elif nome.endswith(".xls"):
+        df = pd.read_excel(arquivo, header=None)
+        for linha in df.itertuples(index=False, name=None):
+            yield [None if pd.isna(v) else v for v in linha]
+
+    else:
+        raise FormatoInvalido("Formato não suportado. Use .xlsx ou .csv")
+
+
+def _vazia(linha):
+    return all(v is None or (isinstance(v, str) and not v.strip()) for v in linha)
+
+
+def _texto(valor):
+    return "" if valor is None else str(valor).strip()
+
+
+# ==============================================================
+# MONTAGEM DOS DOCUMENTOS EM LOTES (sem iterrows)
+# ==============================================================
+
+def _valores_numericos(bloco):
+    # Igual ao float() célula a célula: vazio → 0.0, não numérico mantém o valor original
+    numerico = bloco.apply(pd.to_numeric, errors="coerce").astype(float)
+    return numerico.where(numerico.notna(), bloco.where(bloco.notna(), 0.0))
+
+
+def _lotes_vertical(cabecalho, linhas, usuario_id, tamanho_lote):
+    colunas = [str(c).strip() if c is not None else f"coluna_{i}" for i, c in enumerate(cabecalho)]
+
+    # Algumas planilhas usam 'nome' ou 'Matéria-Prima' etc; fallback: primeira coluna
+    name_col = next((c for c in COLUNAS_NOME if c in colunas), colunas[0])
+    custo_col = next((c for c in COLUNAS_CUSTO if c in colunas), None)
+    outras = [c for c in colunas if c not in (name_col, custo_col)]
+
+    while True:
+        bloco = list(islice(linhas, tamanho_lote))
+        if not bloco:
+            return
+        largura = len(colunas)
+        bloco = [(l + [None] * largura)[:largura] for l in bloco if not _vazia(l)]
+        if not bloco:
+            continue
+
+        df = pd.DataFrame(bloco, columns=colunas, dtype=object)
+        nomes = df[name_col].map(_texto)
+        if custo_col:
+            custos = pd.to_numeric(df[custo_col], errors="coerce").fillna(0.0)
+        else:
+            custos = pd.Series(0.0, index=df.index)
+        nutrientes = _valores_numericos(df[outras]).to_dict("records") if outras else [{}] * len(df)
+
+        yield [
+            {"usuario_id": usuario_id, "nome": nome, "Custo": float(custo), **nutr}
+            for nome, custo, nutr in zip(nomes, custos, nutrientes)
+            if nome
+        ]
+
+
+def _lotes_transposto(cabecalho, linhas, usuario_id, tamanho_lote):
+    # linha0: [blank, MP1, MP2, ...] / linha1: [Custo, c1, c2, ...] / linha2+: [Nutriente, v1, v2, ...]
+    # As MPs estão nas colunas, então o corpo inteiro precisa ser lido antes de montar os documentos
+    nomes_mp = [_texto(v) for v in cabecalho[1:]]
+    largura = len(cabecalho)
+    corpo = [(l + [None] * largura)[:largura] for l in linhas if not _vazia(l)]
+    if not corpo:
+        return
+
+    dados = pd.DataFrame(corpo, dtype=object)
+    custos = pd.to_numeric(dados.iloc[0, 1:], errors="coerce").fillna(0.0).to_numpy()
+    nutrientes = dados.iloc[1:, 0].map(_texto).to_numpy()
+    valores = dados.iloc[1:, 1:].apply(pd.to_numeric, errors="coerce").fillna(0.0).to_numpy(dtype=float)
+
+    validos = nutrientes != ""
+    nutrientes = nutrientes[validos].tolist()
+    valores = valores[validos]
+
+    colunas_validas = [j for j, nome in enumerate(nomes_mp) if nome]
+    for inicio in range(0, len(colunas_validas), tamanho_lote):
+        lote = []
+        for j in colunas_validas[inicio:inicio + tamanho_lote]:
+            doc = {"usuario_id": usuario_id, "nome": nomes_mp[j], "Custo": float(custos[j])}
+            doc.update(zip(nutrientes, valores[:, j].tolist()))
+            lote.append(doc)
+        yield lote
+
+
+def gerar_lotes_documentos(arquivo, filename, usuario_id, tamanho_lote=500):
+    linhas = iterar_linhas(arquivo, filename)
+    primeiras = list(islice(linhas, 2))
+    if not primeiras:
+        return iter(())
+
+    # Heurística: a primeira célula da segunda linha contém 'custo' → formato transposto
+    transposto = len(primeiras) > 1 and "custo" in _texto(primeiras[1][0]).lower()
+    if transposto:
+        return _lotes_transposto(primeiras[0], [primeiras[1]] + list(linhas), usuario_id, tamanho_lote)
+
+    return _lotes_vertical(primeiras[0], chain(primeiras[1:], linhas), usuario_id, tamanho_lote)
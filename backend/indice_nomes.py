@@ -0,0 +1,71 @@
+import difflib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+# ==============================================================
+# FUNÇÃO DE NORMALIZAÇÃO
+# ==============================================================
+
+def normalizar_nome(nome):
+    nome = ''.join(
+        c for c in unicodedata.normalize("NFD", str(nome))
+        if unicodedata.category(c) != 'Mn'
+    )
+    return nome.strip().lower().replace("_", " ")
+
+
+# ==============================================================
+# ÍNDICE DE NOMES (exato → normalizado → alias → aproximado)
+# ==============================================================
+
+class IndiceNomes:
+    def __init__(self, nomes, versao=None, aliases=None, corte_aproximado=0.85, max_aproximados=1024):
+        self.versao = versao
+        self.corte_aproximado = corte_aproximado
+        self.max_aproximados = max_aproximados
+        self._exato = {nome: i for i, nome in enumerate(nomes)}
+        self._normalizado = {}
+        for i, nome in enumerate(nomes):
+            self._normalizado.setdefault(normalizar_nome(nome), i)
+
+        # aliases: {"apelido": "nome na matriz"}; ignorados se o destino não existir
+        self._aliases = {}
+        for apelido, destino in (aliases or {}).items():
+            i = self._exato.get(destino, self._normalizado.get(normalizar_nome(destino)))
+            if i is not None:
+                self._aliases[normalizar_nome(apelido)] = i
+
+        self._chaves_aproximadas = list(self._normalizado)
+        self._memo_aproximado = OrderedDict()  # LRU: nomes vêm do cliente, sem limite cresceria à vontade
+        self._lock = threading.Lock()
+
+    def resolver(self, nome):
+        """Retorna (posição, tipo de correspondência) ou (None, None)."""
+        i = self._exato.get(nome)
+        if i is not None:
+            return i, "exato"
+
+        chave = normalizar_nome(nome)
+        i = self._normalizado.get(chave)
+        if i is not None:
+            return i, "normalizado"
+
+        i = self._aliases.get(chave)
+        if i is not None:
+            return i, "alias"
+
+        # Busca aproximada é O(n), mas o resultado fica memorizado por nome (LRU)
+        with self._lock:
+            if chave in self._memo_aproximado:
+                self._memo_aproximado.move_to_end(chave)
+            else:
+                proximos = difflib.get_close_matches(
+                    chave, self._chaves_aproximadas, n=1, cutoff=self.corte_aproximado
+                )
+                self._memo_aproximado[chave] = self._normalizado[proximos[0]] if proximos else None
+                while len(self._memo_aproximado) > self.max_aproximados:
+                    self._memo_aproximado.popitem(last=False)
+            i = self._memo_aproximado[chave]
+        return (i, "aproximado") if i is not None else (None, None)
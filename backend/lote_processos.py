@@ -0,0 +1,58 @@
+import pickle
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+from optimization_engine import otimizar_cenario
+import transporte
+
+
+# ==============================================================
+# MATRIZ COMPARTILHADA COM OS WORKERS DO /optimize/batch
+# ==============================================================
+
+# Matrizes já montadas em cada worker (LRU por assinatura)
+MATRIZES_POR_WORKER = 4
+
+_matrizes = OrderedDict()
+
+
+@contextmanager
+def publicar_matriz(matriz):
+    """Copia a matriz (forma compacta) para memória compartilhada durante o lote.
+
+    Os cenários levam só a referência: cada worker lê a matriz uma única vez e a reaproveita
+    nos cenários seguintes, em vez de receber uma cópia serializada por cenário.
+    """
+    dados = pickle.dumps(transporte.matriz_compacta(matriz, binario=True), protocol=pickle.HIGHEST_PROTOCOL)
+    memoria = shared_memory.SharedMemory(create=True, size=len(dados))
+    try:
+        memoria.buf[: len(dados)] = dados
+        yield {"assinatura": matriz.assinatura(), "nome": memoria.name, "tamanho": len(dados)}
+    finally:
+        memoria.close()
+        memoria.unlink()
+
+
+def _matriz_publicada(referencia):
+    assinatura = referencia["assinatura"]
+    if assinatura in _matrizes:
+        _matrizes.move_to_end(assinatura)
+        return _matrizes[assinatura]
+
+    memoria = shared_memory.SharedMemory(name=referencia["nome"])
+    try:
+        dados = pickle.loads(bytes(memoria.buf[: referencia["tamanho"]]))
+    finally:
+        memoria.close()
+    matriz = transporte.matriz_de_compacta(dados)
+
+    _matrizes[assinatura] = matriz
+    while len(_matrizes) > MATRIZES_POR_WORKER:
+        _matrizes.popitem(last=False)
+    return matriz
+
+
+def otimizar_cenario_publicado(referencia, cenario, solver=None):
+    # Ponto de entrada dos workers do lote (ver publicar_matriz)
+    return otimizar_cenario(_matriz_publicada(referencia), cenario, solver)
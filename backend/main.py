@@ -1,15 +1,41 @@
 from fastapi import FastAPI, Request, HTTPException, File, UploadFile, Form
 from fastapi.middleware.cors import CORSMiddleware
+import numpy as np
 import pandas as pd
-from optimization_engine import otimizar_formula, CUSTO_ROW_NAME 
+from optimization_engine import (
+    otimizar_formula_matricial, analisar_sensibilidade, varrer_preco, fronteira_pareto,
+    avaliar_formulacoes, otimizar_conjunto, otimizar_formula_mip, otimizar_formula_robusta, ModeloCompilado,
+    preparar_formula, recalcular_formulas, MatrizNutricional, CUSTO_ROW_NAME,
+)
+from cache_matrizes import CacheMatrizes, separar_versao
+from armazem_matrizes import ArmazemMatrizes
+from cache_solucoes import CacheSolucoes, chave_problema
+from executor_cpu import ExecutorLimitado
+from sessoes_modelo import RegistroSessoes
+from fila_jobs import FilaJobs, TERMINAIS as STATUS_TERMINAIS_JOB, contexto_processos
+from lote_processos import publicar_matriz, otimizar_cenario_publicado
+import metricas
+from metricas import medir, MiddlewareMetricas
+from importacao import gerar_lotes_documentos, FormatoInvalido
+from base_local import BaseLocal
+import transporte
+from transporte import FormatoNaoSuportado
+from exportacao import (
+    colunas_exportacao, formatos_disponiveis, gerar_csv, gerar_parquet, gerar_xlsx, MEDIA_TYPES,
+)
 import sys
-import unicodedata
-from pymongo import MongoClient
+import json
+import time
+import hashlib
+import uuid
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from pymongo import AsyncMongoClient, ReplaceOne, UpdateOne
 from bson import ObjectId
 from dotenv import load_dotenv
 import os
-import io
-from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse, Response
 
 sys.stdout.reconfigure(encoding='utf-8')
 
@@ -20,6 +46,63 @@ sys.stdout.reconfigure(encoding='utf-8')
 load_dotenv()
 app = FastAPI(title="Otimizador de Formulações API com MongoDB")
 
+# Caminhos padrão relativos a este arquivo, não ao diretório de onde o servidor é iniciado
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Métricas por etapa em /metrics (METRICAS=0 desliga) e cabeçalho Server-Timing opcional
+METRICAS = os.getenv("METRICAS", "1") == "1"
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+metricas.configurar(METRICAS)
+
+# Backend do solver LP: "highs" (scipy, em processo) ou "cbc" (PuLP, subprocesso)
+SOLVER_BACKEND = os.getenv("SOLVER_BACKEND", "highs")
+
+# Pool de processos do /optimize/batch
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", os.cpu_count() or 1))
+BATCH_MAX_CENARIOS = int(os.getenv("BATCH_MAX_CENARIOS", 500))
+
+# Fronteira de Pareto: threads por requisição e limite de pontos da grade ε
+PARETO_WORKERS = int(os.getenv("PARETO_WORKERS", 4))
+PARETO_MAX_PONTOS = int(os.getenv("PARETO_MAX_PONTOS", 400))
+
+# Fórmulas salvas: variação de custo (fração) que as sinaliza no recálculo após importações
+FORMULAS_LIMITE_CUSTO = float(os.getenv("FORMULAS_LIMITE_CUSTO", 0.05))
+
+# Executor das tarefas bloqueantes (solver, leitura de planilhas, pandas)
+executor_cpu = ExecutorLimitado(
+    max_workers=int(os.getenv("CPU_WORKERS", os.cpu_count() or 1)),
+    max_fila=int(os.getenv("CPU_FILA_MAX", 32)),
+)
+
+# Documentos gravados por bulk_write na importação de planilhas
+IMPORT_TAMANHO_LOTE = int(os.getenv("IMPORT_TAMANHO_LOTE", 500))
+
+# Documentos lidos do cursor por lote na exportação
+EXPORT_TAMANHO_LOTE = int(os.getenv("EXPORT_TAMANHO_LOTE", 1000))
+
+# Sessões de modelos compilados (/modelos)
+sessoes_modelo = RegistroSessoes(
+    max_sessoes=int(os.getenv("MODELO_SESSOES_MAX", 256)),
+    ttl_inativo=float(os.getenv("MODELO_SESSAO_TTL", 1800)),
+)
+
+# Apelidos de MPs para a /consulta: arquivo JSON {"apelido": "nome na matriz"} (opcional)
+ALIASES_MP = {}
+if os.getenv("ALIASES_MP"):
+    with open(os.getenv("ALIASES_MP"), encoding="utf-8") as f:
+        ALIASES_MP = json.load(f)
+
+# Cache em memória das matrizes de cada usuário
+cache_matrizes = CacheMatrizes(
+    max_usuarios=int(os.getenv("MATRIZ_CACHE_MAX_USUARIOS", 128)),
+    max_bytes=int(os.getenv("MATRIZ_CACHE_MAX_MB", 256)) * 1024 * 1024,
+)
+
+# Cache de soluções do /optimize e fila de jobs (/jobs): criados no startup, já que abrem
+# arquivos SQLite; importar o módulo (ferramentas, benchmark) não grava nada em disco
+cache_solucoes = None
+fila_jobs = None
+
 # ============================================================== 
 # CORS
 # ==============================================================
@@ -36,46 +119,323 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+if METRICAS:
+    app.add_middleware(MiddlewareMetricas, server_timing=SERVER_TIMING)
 
 # ============================================================== 
 # CONEXÃO COM MONGODB ATLAS
 # ==============================================================
 
 MONGO_URI = os.getenv("MONGO_URI")
+MONGO_MAX_POOL = int(os.getenv("MONGO_MAX_POOL", 50))
+# Timeout curto de seleção de servidor: Atlas lento não trava requisições nem o health check
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", 5000))
+MONGO_HEALTH_INTERVALO = float(os.getenv("MONGO_HEALTH_INTERVALO", 30))
+client = None
 db = None
 mp_collection = None
+# Snapshot versionado da matriz de cada usuário (coleção "matrizes", _id = usuario_id)
+armazem_matrizes = None
+formulas_collection = None
+
+# ok: None = ainda não verificado, True/False = resultado do último ping
+estado_mongo = {"ok": None, "erro": None, "latencia_ms": None, "verificado_em": None, "indices": False}
+_tarefa_mongo = None
+
+if not MONGO_URI:
+    print("⚠️ Nenhuma variável MONGO_URI definida. Usando base local Excel.")
+
 
-if MONGO_URI:
+def mongo_disponivel():
+    # Antes do primeiro ping o banco é considerado disponível (as operações têm timeout curto)
+    return mp_collection is not None and estado_mongo["ok"] is not False
+
+
+async def verificar_mongo():
+    inicio = time.perf_counter()
     try:
-        client = MongoClient(MONGO_URI)
-        client.admin.command("ping")
-        db = client["otimizador_db"]
-        mp_collection = db["materias_primas"]
-        print("✅ Conectado ao MongoDB Atlas com sucesso!")
+        await client.admin.command("ping")
+        if not estado_mongo["indices"]:
+            # Índice usado pelos upserts da importação e pelas buscas por usuário/importação vigente
+            await mp_collection.create_index([("usuario_id", 1), ("importacao", 1), ("nome", 1)])
+            await formulas_collection.create_index("usuario_id")
+            estado_mongo["indices"] = True
+        if estado_mongo["ok"] is not True:
+            print("✅ Conectado ao MongoDB Atlas com sucesso!")
+        estado_mongo.update(ok=True, erro=None, latencia_ms=round((time.perf_counter() - inicio) * 1000, 3))
     except Exception as e:
-        print("❌ Erro ao conectar ao MongoDB:", e)
-else:
-    print("⚠️ Nenhuma variável MONGO_URI definida. Usando base local Excel.")
+        if estado_mongo["ok"] is not False:
+            print("❌ Erro ao conectar ao MongoDB:", e)
+        estado_mongo.update(ok=False, erro=str(e), latencia_ms=None)
+    estado_mongo["verificado_em"] = time.time()
+
+
+async def monitorar_mongo():
+    while True:
+        await verificar_mongo()
+        await asyncio.sleep(MONGO_HEALTH_INTERVALO)
+
+
+@app.on_event("startup")
+async def iniciar_mongo():
+    global client, db, mp_collection, armazem_matrizes, formulas_collection, _tarefa_mongo
+    if not MONGO_URI:
+        return
+    # Nada de I/O na importação do módulo nem bloqueio do startup: o ping roda em segundo plano
+    client = AsyncMongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL, serverSelectionTimeoutMS=MONGO_TIMEOUT_MS)
+    db = client["otimizador_db"]
+    mp_collection = db["materias_primas"]
+    armazem_matrizes = ArmazemMatrizes(db["matrizes"])
+    formulas_collection = db["formulas"]
+    _tarefa_mongo = asyncio.create_task(monitorar_mongo())
+
+
+@app.on_event("shutdown")
+async def encerrar_mongo():
+    if _tarefa_mongo is not None:
+        _tarefa_mongo.cancel()
+    if client is not None:
+        await client.close()
 
 # ============================================================== 
-# FUNÇÃO DE NORMALIZAÇÃO
+# BASE LOCAL (caso MongoDB indisponível)
 # ==============================================================
 
-def normalizar_nome(nome):
-    nome = ''.join(
-        c for c in unicodedata.normalize("NFD", str(nome))
-        if unicodedata.category(c) != 'Mn'
+# Lida no primeiro uso a partir do snapshot binário (refeito só quando a planilha muda)
+base_local = BaseLocal(os.path.join(BASE_DIR, "data", "MPs_data.xlsx"), os.getenv("BASE_LOCAL_SNAPSHOT") or None)
+
+
+def _carregar_base_local():
+    try:
+        base_local.matriz()
+        print(f"✅ Base local carregada ({base_local.origem}).")
+    except Exception as e:
+        print("❌ Erro ao carregar a base local:", e)
+
+
+@app.on_event("startup")
+async def aquecer_base_local():
+    # Carrega em segundo plano: o servidor aceita conexões (e responde /saude) antes disso
+    asyncio.get_running_loop().run_in_executor(None, _carregar_base_local)
+
+
+async def obter_matriz_local():
+    if base_local.carregada:
+        return base_local.matriz()
+    return await executor_cpu.executar(base_local.matriz)
+
+
+# Campos opcionais dos documentos de MP usados só pelo modo robusto:
+# "desvios": {nutriente: desvio padrão}, "amostras": [{nutriente: valor}, ...] (um por lote)
+CAMPOS_VARIABILIDADE = ("desvios", "amostras")
+
+
+def matriz_de_documentos(mps):
+    with medir("dataframe_matriz"):
+        df = pd.DataFrame(mps).set_index("nome").T
+    return MatrizNutricional.de_dataframe(df)
+
+
+def matriz_de_dict(matriz_dict):
+    with medir("dataframe_matriz"):
+        df = pd.DataFrame(matriz_dict).T
+    return MatrizNutricional.de_dataframe(df)
+
+
+async def ler_corpo(request):
+    # JSON por padrão; Content-Type msgpack/Arrow → corpo binário com a matriz já decodificada
+    with medir("corpo_entrada"):
+        formato = transporte.formato_do_conteudo(request.headers.get("content-type"))
+        if formato == "json":
+            return await request.json()
+        try:
+            return transporte.decodificar(formato, await request.body())
+        except FormatoNaoSuportado as e:
+            raise HTTPException(status_code=415, detail=str(e))
+
+
+def responder(request, conteudo):
+    # Accept: application/x-msgpack → mesmo conteúdo em msgpack; demais clientes recebem JSON
+    formato = transporte.negociar(request.headers.get("accept"), permitidos=("json", "msgpack"))
+    if formato == "json":
+        return conteudo
+    return Response(
+        transporte.codificar(formato, conteudo),
+        media_type=transporte.MEDIA_TYPES[formato],
+        headers={"Vary": "Accept"},
     )
-    return nome.strip().lower().replace("_", " ")
+
+
+def _obter_solucoes(chaves):
+    return [cache_solucoes.obter(chave) for chave in chaves]
+
+
+async def obter_solucoes(chaves):
+    # Com SOLUCAO_CACHE_SQLITE a consulta pode ler o disco: roda no pool de threads de I/O
+    # (não no executor de CPU, cuja fila limitada é reservada aos solves), uma vez para todas as chaves
+    if cache_solucoes.persistente:
+        return await run_in_threadpool(_obter_solucoes, chaves)
+    return _obter_solucoes(chaves)
+
+
+async def obter_solucao(chave):
+    return (await obter_solucoes([chave]))[0]
+
+
+async def filtro_mps(usuario_id):
+    # Só os documentos da importação vigente (None casa os documentos sem marca)
+    return {"usuario_id": usuario_id, "importacao": await armazem_matrizes.importacao_atual(usuario_id)}
+
+
+async def reconstruir_snapshot(usuario_id, anterior):
+    # Monta a matriz a partir dos documentos por MP e grava como nova versão do snapshot.
+    # Só os campos numéricos interessam: _id, usuario_id, marca e variabilidade ficam de fora da projeção
+    filtro = {"usuario_id": usuario_id, "importacao": anterior.get("importacao") if anterior else None}
+    with medir("mongo_documentos"):
+        mps = await mp_collection.find(
+            filtro, {"_id": 0, "usuario_id": 0, "importacao": 0, **{c: 0 for c in CAMPOS_VARIABILIDADE}}
+        ).to_list(None)
+    if not mps:
+        raise ValueError("Nenhuma MP encontrada no banco do usuário.")
+
+    matriz = await executor_cpu.executar(matriz_de_documentos, mps)
+    # None: alguém alterou o snapshot no meio do caminho; a matriz serve, mas sem versão persistida
+    versao = await armazem_matrizes.gravar(usuario_id, matriz, anterior)
+    return versao, matriz
+
+
+async def carregar_matriz_usuario(usuario_id):
+    # Retorna (versao, matriz) do cache; em caso de falta uma única busca pelo _id no Mongo.
+    # Snapshot ausente (dados anteriores ao versionamento) ou desatualizado → remonta dos documentos
+    em_cache = cache_matrizes.obter(usuario_id)
+    if em_cache is not None:
+        # Outro processo do servidor pode ter trocado o snapshot: confere a versão antes de usar
+        with medir("mongo_versao"):
+            cabecalho = await armazem_matrizes.cabecalho(usuario_id)
+        persistida = separar_versao(em_cache[0])
+        if (
+            persistida and cabecalho is not None
+            and cabecalho["versao"] == persistida[1] and ArmazemMatrizes.atualizado(cabecalho)
+        ):
+            return em_cache
+        cache_matrizes.invalidar(usuario_id)
+
+    with medir("mongo_matriz"):
+        doc = await armazem_matrizes.carregar(usuario_id)
+    if doc is not None and ArmazemMatrizes.atualizado(doc):
+        versao, matriz = doc["versao"], ArmazemMatrizes.matriz_do_documento(doc)
+    else:
+        versao, matriz = await reconstruir_snapshot(usuario_id, doc)
+    return cache_matrizes.guardar(usuario_id, matriz, versao), matriz
+
+
+async def obter_matriz(body):
+    # Prioridade: matriz enviada ({nutriente: {mp: valor}}, compacta ou binária) → versão em cache
+    # → usuário → base local
+    matriz_dict = body.get("matriz", None)
+    if isinstance(matriz_dict, MatrizNutricional):
+        return matriz_dict
+    if transporte.eh_compacta(matriz_dict):
+        # {"linhas", "colunas", "valores"}: sem DataFrame intermediário
+        return await executor_cpu.executar(transporte.matriz_de_compacta, matriz_dict)
+    if matriz_dict:
+        return await executor_cpu.executar(matriz_de_dict, matriz_dict)
+
+    versao = body.get("versao_matriz")
+    if versao:
+        matriz = cache_matrizes.obter_por_versao(versao)
+        persistida = separar_versao(versao)
+        if matriz is None and persistida and mongo_disponivel():
+            # Versão gravada no Mongo por outro processo: vale se ainda for a atual do usuário
+            versao_atual, matriz = await carregar_matriz_usuario(persistida[0])
+            if versao_atual != versao:
+                matriz = None
+        if matriz is None:
+            raise ValueError("Versão da matriz desconhecida ou expirada. Recarregue /data.")
+        return matriz
+
+    usuario_id = body.get("usuario_id")
+    if usuario_id:
+        # Sem o banco não há como montar as MPs do usuário: a base local daria outra fórmula
+        if not mongo_disponivel():
+            raise HTTPException(
+                status_code=503,
+                detail="Banco de dados indisponível para carregar as matérias-primas do usuário.",
+                headers={"Retry-After": "5"},
+            )
+        return (await carregar_matriz_usuario(usuario_id))[1]
+
+    return await obter_matriz_local()
+
+
+async def obter_variabilidade(body):
+    # Variabilidade enviada ({mp: {"desvios", "amostras"}}) → documentos do usuário no Mongo
+    variabilidade = body.get("variabilidade")
+    if variabilidade is not None:
+        return variabilidade
+
+    usuario_id = body.get("usuario_id")
+    if not usuario_id or not mongo_disponivel():
+        return {}
+
+    filtro = {**await filtro_mps(usuario_id), "$or": [{c: {"$exists": True}} for c in CAMPOS_VARIABILIDADE]}
+    projecao = {"_id": 0, "nome": 1, **{c: 1 for c in CAMPOS_VARIABILIDADE}}
+    return {
+        doc["nome"]: {c: doc.get(c) for c in CAMPOS_VARIABILIDADE}
+        async for doc in mp_collection.find(filtro, projecao)
+    }
 
 # ============================================================== 
-# BASE LOCAL (caso MongoDB indisponível)
+# POOL DE PROCESSOS (criado sob demanda)
 # ==============================================================
 
-materias_primas_local = pd.read_excel("data/MPs_data.xlsx", index_col=0)
-materias_primas_local.columns = materias_primas_local.columns.str.strip()
-materias_primas_local.index = materias_primas_local.index.str.strip()
+_pool_processos = None
+
+
+def obter_pool_processos():
+    global _pool_processos
+    if _pool_processos is None:
+        # Mesmo contexto da fila de jobs: fork não é seguro com as threads do servidor
+        _pool_processos = ProcessPoolExecutor(max_workers=BATCH_WORKERS, mp_context=contexto_processos())
+    return _pool_processos
+
+
+@app.on_event("shutdown")
+def encerrar_pool_processos():
+    if _pool_processos is not None:
+        _pool_processos.shutdown(cancel_futures=True)
+    executor_cpu.encerrar()
+    if cache_solucoes is not None:
+        cache_solucoes.encerrar()
+
+
+@app.on_event("startup")
+def iniciar_fila_jobs():
+    global cache_solucoes, fila_jobs
+    # SOLUCAO_CACHE_SQLITE → o cache de soluções persiste entre reinícios
+    cache_solucoes = CacheSolucoes(
+        max_entradas=int(os.getenv("SOLUCAO_CACHE_MAX", 1024)),
+        ttl=float(os.getenv("SOLUCAO_CACHE_TTL", 3600)),
+        caminho_sqlite=os.getenv("SOLUCAO_CACHE_SQLITE") or None,
+    )
+    # Fila em SQLite compartilhada entre processos do servidor; JOBS_WORKERS é o total de
+    # jobs simultâneos, JOBS_TEMPO_LIMITE o máximo por job (s)
+    fila_jobs = FilaJobs(
+        os.getenv("JOBS_SQLITE") or os.path.join(BASE_DIR, "data", "jobs.sqlite3"),
+        max_workers=int(os.getenv("JOBS_WORKERS", 2)),
+        tempo_limite=float(os.getenv("JOBS_TEMPO_LIMITE", 600)),
+        max_fila=int(os.getenv("JOBS_FILA_MAX", 100)),
+        retencao=float(os.getenv("JOBS_RETENCAO", 86400)),
+    )
+    fila_jobs.iniciar()
+
+
+@app.on_event("shutdown")
+def encerrar_fila_jobs():
+    if fila_jobs is not None:
+        fila_jobs.encerrar()
 
 # ============================================================== 
 # ENDPOINTS
@@ -86,35 +446,94 @@ def root():
     return {"message": "API do Otimizador de Formulações rodando com sucesso!"}
 
 
+# --------------------------------------------------------------
+# /saude → Liveness: o processo responde (não depende de Mongo nem da base local)
+# /prontidao → Readiness: base local carregada e, se configurado, MongoDB respondendo
+# --------------------------------------------------------------
+@app.get("/saude")
+def saude():
+    return {"status": "vivo"}
+
+
+@app.get("/prontidao")
+def prontidao():
+    componentes = {
+        "base_local": {"carregada": base_local.carregada, "origem": base_local.origem},
+        "mongo": (
+            {k: v for k, v in estado_mongo.items() if k != "indices"}
+            if MONGO_URI else {"configurado": False}
+        ),
+    }
+    pronto = base_local.carregada and (not MONGO_URI or estado_mongo["ok"] is True)
+    return JSONResponse(
+        status_code=200 if pronto else 503,
+        content={"pronto": pronto, "componentes": componentes},
+    )
+
+
 # --------------------------------------------------------------
 # /data → Retorna MPs e nutrientes (Mongo ou local)
+# - ETag por conteúdo da matriz: If-None-Match igual → 304 sem corpo
+# - Accept: application/x-msgpack | application/vnd.apache.arrow.stream → matriz binária
 # --------------------------------------------------------------
+def etag_matriz(matriz, versao, formato):
+    # Conteúdo + versão entregue + representação: 304 só quando a resposta seria idêntica
+    chave = f"{matriz.assinatura()}|{versao}|{formato}"
+    return '"' + hashlib.sha256(chave.encode()).hexdigest()[:32] + '"'
+
+
+def etag_confere(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidatos = [c.strip().removeprefix("W/") for c in if_none_match.split(",")]
+    return "*" in candidatos or etag in candidatos
+
+
 @app.get("/data")
-def get_data(usuario_id: str = None):
+async def get_data(request: Request, usuario_id: str = None):
     try:
-        if db is not None and usuario_id:
-            mps = list(mp_collection.find({"usuario_id": usuario_id}))
-            if not mps:
-                raise ValueError("Nenhuma MP encontrada no banco do usuário.")
-
-            df = pd.DataFrame(mps).set_index("nome")
-            matriz_dict = df.to_dict()
-            materias = list(df.index)
-            nutrientes = [c for c in df.columns if c not in ["_id", "usuario_id", "nome"]]
-
-            return {
-                "materias_primas": materias,
+        # Accept: application/x-msgpack ou application/vnd.apache.arrow.stream → matriz binária
+        formato = transporte.negociar(request.headers.get("accept"))
+
+        if mongo_disponivel() and usuario_id:
+            versao, matriz = await carregar_matriz_usuario(usuario_id)
+        else:
+            versao, matriz = None, await obter_matriz_local()
+
+        etag = etag_matriz(matriz, versao, formato)
+        cabecalhos = {"ETag": etag, "Vary": "Accept", "Cache-Control": "no-cache"}
+        if etag_confere(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=cabecalhos)
+
+        # Custo é linha da matriz, não nutriente: fica fora da lista em todas as representações
+        nutrientes = [nome for nome in matriz.linhas if nome != CUSTO_ROW_NAME]
+        if formato != "json":
+            conteudo = {"materias_primas": matriz.colunas, "nutrientes": nutrientes, "versao_matriz": versao}
+            return Response(
+                await executor_cpu.executar(transporte.codificar, formato, conteudo, matriz),
+                media_type=transporte.MEDIA_TYPES[formato],
+                headers=cabecalhos,
+            )
+
+        if versao is not None:
+            conteudo = {
+                "materias_primas": matriz.colunas,
                 "nutrientes": nutrientes,
-                "matriz": matriz_dict,
+                "matriz": matriz.para_dict(),
+                "versao_matriz": versao,
             }
+        else:
+            # fallback
+            materias_primas_local = base_local.dataframe()
+            conteudo = {
+                "materias_primas": list(materias_primas_local.columns),
+                "nutrientes": [i for i in materias_primas_local.index if i != CUSTO_ROW_NAME],
+                "matriz": materias_primas_local.to_dict(),
+            }
+        return JSONResponse(conteudo, headers=cabecalhos)
 
-        # fallback
-        return {
-            "materias_primas": list(materias_primas_local.columns),
-            "nutrientes": [i for i in materias_primas_local.index if i != CUSTO_ROW_NAME],
-            "matriz": materias_primas_local.to_dict(),
-        }
-
+    except HTTPException:
+        raise
     except Exception as e:
         print("❌ Erro ao carregar dados:", e)
         raise HTTPException(status_code=500, detail=str(e))
@@ -122,210 +541,167 @@ def get_data(usuario_id: str = None):
 
 # --------------------------------------------------------------
 # CRUD de Matérias-Primas (MongoDB)
+# - alterações pontuais só marcam o snapshot da matriz; ele é remontado na próxima leitura
 # --------------------------------------------------------------
+async def invalidar_matriz(usuario_id):
+    if usuario_id is None:
+        return
+    cache_matrizes.invalidar(usuario_id)
+    await armazem_matrizes.marcar_alteracao(usuario_id)
+
+
 @app.post("/mp")
 async def adicionar_mp(request: Request):
-    if db is None:
-        raise HTTPException(status_code=503, detail="MongoDB não configurado.")
+    if not mongo_disponivel():
+        raise HTTPException(status_code=503, detail="MongoDB não configurado ou indisponível.")
     try:
-        body = await request.json()
-        result = mp_collection.insert_one(body)
+        body = await ler_corpo(request)
+        body.pop("importacao", None)
+        if body.get("usuario_id") is not None:
+            # Entra na importação vigente para ser vista junto com as demais MPs
+            importacao = await armazem_matrizes.importacao_atual(body["usuario_id"])
+            if importacao is not None:
+                body["importacao"] = importacao
+        result = await mp_collection.insert_one(body)
+        await invalidar_matriz(body.get("usuario_id"))
         return {"id": str(result.inserted_id)}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/mp/{usuario_id}")
-def listar_mps(usuario_id: str):
-    if db is None:
-        raise HTTPException(status_code=503, detail="MongoDB não configurado.")
-    mps = list(mp_collection.find({"usuario_id": usuario_id}))
+async def listar_mps(usuario_id: str):
+    if not mongo_disponivel():
+        raise HTTPException(status_code=503, detail="MongoDB não configurado ou indisponível.")
+    mps = await mp_collection.find(await filtro_mps(usuario_id), {"importacao": 0}).to_list(None)
     for m in mps:
         m["_id"] = str(m["_id"])
     return mps
 
 
 @app.delete("/mp/{mp_id}")
-def deletar_mp(mp_id: str):
-    if db is None:
-        raise HTTPException(status_code=503, detail="MongoDB não configurado.")
-    result = mp_collection.delete_one({"_id": ObjectId(mp_id)})
-    if result.deleted_count == 0:
+async def deletar_mp(mp_id: str):
+    if not mongo_disponivel():
+        raise HTTPException(status_code=503, detail="MongoDB não configurado ou indisponível.")
+    removida = await mp_collection.find_one_and_delete({"_id": ObjectId(mp_id)}, {"usuario_id": 1})
+    if removida is None:
         raise HTTPException(status_code=404, detail="MP não encontrada.")
+    await invalidar_matriz(removida.get("usuario_id"))
     return {"status": "ok"}
 
 
 # --------------------------------------------------------------
 # /importar_materias_primas → Importar CSV/XLSX para MongoDB
-# - Suporta planilha transposta (como a sua imagem) e formato vertical
+# - recalcular=true → recalcula as fórmulas salvas com a nova matriz (ver /formulas);
+#   reotimizar=true → as sinalizadas vão para a fila de jobs
 # --------------------------------------------------------------
 @app.post("/importar_materias_primas")
 async def importar_materias_primas(
     usuario_id: str = Form(...),
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    progresso: bool = Form(False),
+    recalcular: bool = Form(False),
+    reotimizar: bool = Form(False),
 ):
-    if db is None:
-        raise HTTPException(status_code=503, detail="MongoDB não configurado.")
+    if not mongo_disponivel():
+        raise HTTPException(status_code=503, detail="MongoDB não configurado ou indisponível.")
 
+    # O arquivo é lido uma única vez, em lotes, direto do upload (sem carregar tudo em memória)
     try:
-        content = await file.read()
-
-        # lê sem header para inspecionar conteúdo
-        if file.filename.lower().endswith(".xlsx") or file.filename.lower().endswith(".xls"):
-            df_raw = pd.read_excel(io.BytesIO(content), header=None)
-        elif file.filename.lower().endswith(".csv"):
-            # tenta UTF-8 primeiro, cai para latin1 se der problema
+        lotes = await executor_cpu.executar(
+            gerar_lotes_documentos, file.file, file.filename, usuario_id, IMPORT_TAMANHO_LOTE
+        )
+    except FormatoInvalido as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Não foi possível ler o arquivo: {e}")
+
+    async def importar():
+        # Os documentos novos são gravados com uma marca própria e ignorados pelas leituras até a
+        # troca do snapshot para essa marca; os anteriores seguem vigentes até lá
+        importacao = uuid.uuid4().hex
+        documentos = {}  # nome -> documento gravado (o último vence, como no upsert)
+        versao = None
+        try:
+            while True:
+                lote = await executor_cpu.executar(next, lotes, None)
+                if lote is None:
+                    break
+                if not lote:
+                    continue
+
+                await mp_collection.bulk_write(
+                    [
+                        ReplaceOne(
+                            {"usuario_id": usuario_id, "nome": doc["nome"], "importacao": importacao},
+                            {**doc, "importacao": importacao},
+                            upsert=True,
+                        )
+                        for doc in lote
+                    ],
+                    ordered=True,
+                )
+                documentos.update((doc["nome"], doc) for doc in lote)
+                yield {"processados": len(documentos)}
+
+            if not documentos:
+                raise HTTPException(status_code=400, detail="A planilha não contém dados válidos para importação.")
+
+            # Troca atômica: um único replace do snapshot passa a apontar para os documentos novos
+            matriz = await executor_cpu.executar(matriz_de_documentos, list(documentos.values()))
+            anterior = await armazem_matrizes.importacao_atual(usuario_id)
+            numero = await armazem_matrizes.gravar(usuario_id, matriz, importacao=importacao)
+            if numero is None:
+                raise RuntimeError("Atualizações concorrentes da matriz; tente importar novamente.")
+            versao = cache_matrizes.guardar(usuario_id, matriz, numero)
+
+            # Os documentos da importação anterior já não são lidos por ninguém
             try:
-                df_raw = pd.read_csv(io.BytesIO(content), header=None, encoding="utf-8")
-            except Exception:
-                df_raw = pd.read_csv(io.BytesIO(content), header=None, encoding="latin1")
-        else:
-            raise HTTPException(status_code=400, detail="Formato não suportado. Use .xlsx ou .csv")
+                await mp_collection.delete_many({"usuario_id": usuario_id, "importacao": anterior})
+            except Exception as e:
+                print("⚠️ Não foi possível remover as MPs da importação anterior:", e)
+            evento = {"mensagem": f"{len(documentos)} registros importados com sucesso!", "versao_matriz": versao}
 
-        # Normaliza strings das primeiras células para decisão
-        first_cell = ""
-        try:
-            first_cell = str(df_raw.iat[0, 0]).strip().lower()
-        except Exception:
-            first_cell = ""
-
-        # Heurística: se a célula (0,0) estiver vazia ou não for 'nome' e a célula (1,0) contém 'custo',
-        # assumimos estrutura transposta conforme sua imagem:
-        # linha0: [blank, MP1, MP2, ...]
-        # linha1: [Custo,  cost1, cost2, ...]
-        # linha2+: [Nutriente, val_mp1, val_mp2, ...]
-        transposto = False
-        try:
-            second_cell_first_col = str(df_raw.iat[1, 0]).strip().lower()
-            if ("custo" in second_cell_first_col) or (first_cell == "" and df_raw.shape[1] > 1 and df_raw.shape[0] >= 2):
-                # We'll do a more precise check below, but mark as possible transposed
-                transposto = True
-        except Exception:
-            transposto = False
-
-        materias_primas_docs = []
-
-        if transposto:
-            # Tratamento específico para o formato transposto mostrado
-            # nomes das MPs: primeira linha, colunas a partir de 1
-            col_names = df_raw.iloc[0, 1:].astype(str).tolist()
-
-            # custos: segunda linha, colunas a partir de 1
-            custos = df_raw.iloc[1, 1:].tolist()
-
-            # nutrientes: a partir da linha 3
-            dados = df_raw.iloc[2:, :].copy()
-            # define cabeçalho: primeira coluna -> 'Nutriente', resto -> nomes das MPs
-            header = ["Nutriente"] + col_names
-            dados.columns = header
-            dados = dados.reset_index(drop=True)
-
-            # transforma coluna "Nutriente" em índice para fácil lookup
-            nutr_df = dados.set_index("Nutriente")
-
-            # monta documentos por MP
-            for i, mp in enumerate(col_names):
+            if recalcular or reotimizar:
+                # A importação já está concluída: falha no recálculo só é informada
                 try:
-                    custo_val = float(custos[i]) if pd.notna(custos[i]) else 0.0
-                except Exception:
-                    custo_val = 0.0
-
-                # pega série de valores nutricionais daquela coluna (pode ter NaN)
-                nutric_dict = {}
-                if mp in nutr_df.columns:
-                    serie = nutr_df[mp]
-                    # convert to numeric where possible
-                    serie = pd.to_numeric(serie, errors="coerce")
-                    nutric_dict = {str(k): (float(v) if pd.notna(v) else 0.0) for k, v in serie.to_dict().items()}
-                else:
-                    # se nome da coluna tem algum caracter estranho, tenta buscar com aproximação
-                    # (fall back: tentar col index)
-                    col_index = i + 1
-                    if col_index < df_raw.shape[1]:
-                        serie = dados.iloc[:, col_index]
-                        serie.index = dados["Nutriente"]
-                        serie = pd.to_numeric(serie, errors="coerce")
-                        nutric_dict = {str(k): (float(v) if pd.notna(v) else 0.0) for k, v in serie.to_dict().items()}
-
-                doc = {
-                    "usuario_id": usuario_id,
-                    "nome": mp,
-                    "Custo": custo_val,
-                }
-                # junta nutrientes como campos separados (mantive chave separada)
-                # Se preferir, pode usar "nutrientes": nutric_dict
-                # Aqui vou inserir todos os nutrientes como campos (compatível com o resto do app)
-                for nutr_name, nutr_val in nutric_dict.items():
-                    doc[str(nutr_name)] = nutr_val
-
-                materias_primas_docs.append(doc)
+                    recalculo = await recalcular_formulas_usuario(usuario_id, reotimizar=reotimizar)
+                    evento["formulas"] = {
+                        "total": recalculo["total"],
+                        "sinalizadas": [f["id"] for f in recalculo["formulas"] if f["sinalizada"]],
+                        "job_ids": recalculo.get("job_ids", []),
+                    }
+                except Exception as e:
+                    evento["formulas"] = {"erro": str(e)}
+            yield evento
+        finally:
+            if versao is None:
+                # Importação interrompida: descarta só o que ela gravou; a matriz anterior segue valendo
+                try:
+                    await mp_collection.delete_many({"usuario_id": usuario_id, "importacao": importacao})
+                except Exception as e:
+                    print("⚠️ Não foi possível descartar as MPs da importação interrompida:", e)
 
-        else:
-            # Formato vertical / normal: assumimos que há header na primeira linha com col 'nome' e 'Custo'
-            # Ler novamente com header=0 (primeira linha como colunas)
+    # progresso=true → NDJSON com {"processados": n} a cada lote e a mensagem final
+    if progresso:
+        async def gerar_linhas():
             try:
-                if file.filename.lower().endswith(".csv"):
-                    try:
-                        df = pd.read_csv(io.BytesIO(content), header=0, encoding="utf-8")
-                    except Exception:
-                        df = pd.read_csv(io.BytesIO(content), header=0, encoding="latin1")
-                else:
-                    df = pd.read_excel(io.BytesIO(content), header=0)
+                async for evento in importar():
+                    yield json.dumps(evento, ensure_ascii=False) + "\n"
+            except HTTPException as e:
+                yield json.dumps({"erro": e.detail}, ensure_ascii=False) + "\n"
             except Exception as e:
-                raise HTTPException(status_code=400, detail=f"Não foi possível ler o arquivo: {e}")
+                yield json.dumps({"erro": f"Erro ao processar planilha: {e}"}, ensure_ascii=False) + "\n"
 
-            # normalizar nomes de colunas
-            df.columns = [str(c).strip() for c in df.columns]
-
-            # Algumas planilhas podem usar 'nome' ou 'Matéria-Prima' etc; tentamos detectar coluna com nomes
-            name_col = None
-            for possible in ["nome", "Nome", "MATÉRIA-PRIMA", "Matéria-Prima", "Matéria prima", "matéria-prima"]:
-                if possible in df.columns:
-                    name_col = possible
-                    break
-            # fallback: primeira coluna
-            if name_col is None:
-                name_col = df.columns[0]
-
-            # garantir que existe coluna Custo (pode estar com variações)
-            custo_col = None
-            for possible in ["Custo", "custo", "Cost", "Preço"]:
-                if possible in df.columns:
-                    custo_col = possible
-                    break
+        return StreamingResponse(gerar_linhas(), media_type="application/x-ndjson")
 
-            # monta docs direto dos registros
-            for _, row in df.iterrows():
-                nome_mp = str(row[name_col])
-                try:
-                    custo_val = float(row[custo_col]) if custo_col and pd.notna(row[custo_col]) else 0.0
-                except Exception:
-                    custo_val = 0.0
-
-                doc = {"usuario_id": usuario_id, "nome": nome_mp, "Custo": custo_val}
-                # adiciona demais colunas (nutrientes)
-                for col in df.columns:
-                    if col == name_col or col == custo_col:
-                        continue
-                    val = row[col]
-                    try:
-                        doc[str(col)] = float(val) if pd.notna(val) else 0.0
-                    except Exception:
-                        doc[str(col)] = val
-                materias_primas_docs.append(doc)
-
-        # Se não encontrou nada válido
-        if not materias_primas_docs:
-            raise HTTPException(status_code=400, detail="A planilha não contém dados válidos para importação.")
-
-        # Insere no MongoDB: limpamos registros antigos do mesmo usuário antes (comportamento opcional)
-        try:
-            mp_collection.delete_many({"usuario_id": usuario_id})
-            mp_collection.insert_many(materias_primas_docs)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Erro ao salvar no MongoDB: {e}")
-
-        return {"mensagem": f"{len(materias_primas_docs)} registros importados com sucesso!"}
+    try:
+        evento = None
+        async for evento in importar():
+            pass
+        return evento
 
     except HTTPException:
         raise
@@ -338,45 +714,37 @@ async def importar_materias_primas(
 # /exportar_materias_primas → Exportar dados do usuário
 # --------------------------------------------------------------
 @app.get("/exportar_materias_primas")
-async def exportar_materias_primas(usuario_id: str):
-    if db is None:
-        raise HTTPException(status_code=503, detail="MongoDB não configurado.")
+async def exportar_materias_primas(usuario_id: str, formato: str = "xlsx"):
+    if not mongo_disponivel():
+        raise HTTPException(status_code=503, detail="MongoDB não configurado ou indisponível.")
+
+    formato = formato.lower()
+    if formato not in formatos_disponiveis():
+        raise HTTPException(
+            status_code=400,
+            detail=f"Formato não suportado. Use: {', '.join(formatos_disponiveis())}",
+        )
 
     try:
-        # Busca as MPs do usuário (sem o _id)
-        mps = list(mp_collection.find({"usuario_id": usuario_id}, {"_id": 0}))
-        if not mps:
+        filtro = await filtro_mps(usuario_id)
+        colunas = await colunas_exportacao(mp_collection, filtro)
+        if not colunas:
             raise HTTPException(status_code=404, detail="Nenhuma matéria-prima encontrada para este usuário.")
 
-        # Converte para DataFrame
-        df = pd.DataFrame(mps)
-
-        # Reordenar colunas para colocar 'nome' e 'usuario_id' no início (opcional)
-        cols = df.columns.tolist()
-        ordered = []
-        for c in ["nome", "usuario_id", "Custo"]:
-            if c in cols:
-                ordered.append(c)
-        for c in cols:
-            if c not in ordered:
-                ordered.append(c)
-        df = df[ordered]
-
-        # Converte em Excel (BytesIO)
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name="MateriasPrimas")
-        output.seek(0)
+        # Cursor lido em lotes (sem o _id); as linhas são escritas conforme chegam
+        cursor = mp_collection.find(filtro, {"_id": 0}).batch_size(EXPORT_TAMANHO_LOTE)
+        if formato == "csv":
+            conteudo = gerar_csv(cursor, colunas, EXPORT_TAMANHO_LOTE)
+        elif formato == "parquet":
+            conteudo = gerar_parquet(cursor, colunas, EXPORT_TAMANHO_LOTE)
+        else:
+            conteudo = gerar_xlsx(cursor, colunas, EXPORT_TAMANHO_LOTE, executor_cpu.executar)
 
         headers = {
-            "Content-Disposition": f"attachment; filename=materias_primas_{usuario_id}.xlsx"
+            "Content-Disposition": f"attachment; filename=materias_primas_{usuario_id}.{formato}"
         }
 
-        return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers=headers
-        )
+        return StreamingResponse(conteudo, media_type=MEDIA_TYPES[formato], headers=headers)
 
     except HTTPException:
         raise
@@ -386,71 +754,612 @@ async def exportar_materias_primas(usuario_id: str):
 
 # --------------------------------------------------------------
 # /optimize → Otimização de fórmula
+# - corpo JSON, msgpack ou Arrow (Content-Type); resposta em msgpack se Accept pedir
 # --------------------------------------------------------------
 @app.post("/optimize")
 async def optimize(request: Request):
     try:
-        body = await request.json()
+        body = await ler_corpo(request)
         metas = body.get("metas", {})
         restricoes = body.get("restricoes", {})
-        matriz_dict = body.get("matriz", None)
-
-        if matriz_dict:
-            mp_df = pd.DataFrame(matriz_dict).T
+        matriz = await obter_matriz(body)
+        sensibilidade = bool(body.get("sensibilidade"))
+        # "mip": {"max_ingredientes", "inclusao_minima", "incremento", "tempo_limite", "gap"}
+        mip = body.get("mip") or None
+        # "robusto": {"modo": "chance" | "cenarios", "nivel", "cenarios", "semente"}
+        robusto = body.get("robusto") or None
+        if robusto and (mip or sensibilidade):
+            raise HTTPException(status_code=400, detail="'robusto' não pode ser combinado com 'mip' ou 'sensibilidade'.")
+
+        extras = {}
+        if robusto:
+            variabilidade = await obter_variabilidade(body)
+            extras = {"robusto": robusto, "variabilidade": variabilidade}
+
+        chave = chave_problema(
+            matriz, metas, restricoes, solver=SOLVER_BACKEND, sensibilidade=sensibilidade, mip=mip, **extras
+        )
+        with medir("cache_solucao"):
+            resultado = await obter_solucao(chave)
+        if resultado is not None:
+            return responder(request, resultado)
+
+        if robusto:
+            resultado = await executor_cpu.executar(
+                otimizar_formula_robusta, matriz, restricoes=restricoes, metas=metas,
+                variabilidade=variabilidade, opcoes=robusto, solver=SOLVER_BACKEND,
+            )
+        elif mip:
+            resultado = await executor_cpu.executar(
+                otimizar_formula_mip, matriz, restricoes=restricoes, metas=metas,
+                opcoes=mip, solver=SOLVER_BACKEND,
+            )
         else:
-            mp_df = materias_primas_local
+            # "sensibilidade": true → inclui preços-sombra das metas e custos reduzidos das MPs
+            rotina = analisar_sensibilidade if sensibilidade else otimizar_formula_matricial
+            resultado = await executor_cpu.executar(
+                rotina, matriz, restricoes=restricoes, metas=metas, solver=SOLVER_BACKEND
+            )
 
-        mp_df = mp_df.apply(pd.to_numeric, errors="ignore").fillna(0)
-        resultado = otimizar_formula(mp_df, restricoes=restricoes, metas=metas)
-        return resultado
+        # Solução interrompida por limite de tempo não é guardada: outra tentativa pode melhorar
+        if resultado.get("status") != "Solution Found":
+            cache_solucoes.guardar(chave, resultado)
+        return responder(request, resultado)
 
+    except HTTPException:
+        raise
     except Exception as e:
         print("❌ ERRO NO BACKEND:", e)
         return {"erro": str(e)}
 
 
+# --------------------------------------------------------------
+# /optimize/cache → Contadores do cache de soluções
+# --------------------------------------------------------------
+@app.get("/optimize/cache")
+def optimize_cache():
+    return cache_solucoes.estatisticas()
+
+
+# --------------------------------------------------------------
+# /metrics → Métricas no formato do Prometheus
+# --------------------------------------------------------------
+@metricas.registro.coletor
+def _metricas_estado():
+    solucoes = cache_solucoes.estatisticas()
+    matrizes = cache_matrizes.estatisticas()
+    executor = executor_cpu.estatisticas()
+    jobs = fila_jobs.estatisticas()
+    return [
+        ("otimizador_cache_consultas_total", "counter", "Consultas aos caches por resultado.", [
+            ({"cache": "solucoes", "resultado": "hit"}, solucoes["hits"]),
+            ({"cache": "solucoes", "resultado": "miss"}, solucoes["misses"]),
+            ({"cache": "matrizes", "resultado": "hit"}, matrizes["hits"]),
+            ({"cache": "matrizes", "resultado": "miss"}, matrizes["misses"]),
+        ]),
+        ("otimizador_cache_entradas", "gauge", "Entradas em cada cache.", [
+            ({"cache": "solucoes"}, solucoes["entradas"]),
+            ({"cache": "matrizes"}, matrizes["usuarios"]),
+        ]),
+        ("otimizador_cache_matrizes_bytes", "gauge", "Memória ocupada pelo cache de matrizes.", [
+            ({}, matrizes["bytes"]),
+        ]),
+        ("otimizador_executor_tarefas", "gauge", "Tarefas no executor de CPU.", [
+            ({"estado": "em_execucao"}, executor["em_execucao"]),
+            ({"estado": "na_fila"}, executor["na_fila"]),
+        ]),
+        ("otimizador_sessoes_modelo", "gauge", "Sessões de modelos compilados abertas.", [
+            ({}, len(sessoes_modelo)),
+        ]),
+        ("otimizador_jobs", "gauge", "Jobs persistidos por status.", [
+            ({"status": status}, jobs[status]) for status in ("na_fila", "executando") + STATUS_TERMINAIS_JOB
+        ]),
+    ]
+
+
+@app.get("/metrics")
+def metrics():
+    if not METRICAS:
+        raise HTTPException(status_code=404, detail="Métricas desativadas (METRICAS=0).")
+    return PlainTextResponse(
+        metricas.registro.renderizar(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+# --------------------------------------------------------------
+# /optimize/batch → Vários cenários sobre a mesma matriz (NDJSON)
+# - body: {"matriz" | "versao_matriz" | "usuario_id"?, "cenarios": [{"id"?, "metas", "restricoes"}, ...]}
+# - cada linha da resposta é enviada assim que o cenário termina
+# --------------------------------------------------------------
+@app.post("/optimize/batch")
+async def optimize_batch(request: Request):
+    body = await ler_corpo(request)
+    cenarios = body.get("cenarios", [])
+
+    if not isinstance(cenarios, list) or not cenarios:
+        raise HTTPException(status_code=400, detail="Informe ao menos um cenário em 'cenarios'.")
+    if len(cenarios) > BATCH_MAX_CENARIOS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Máximo de {BATCH_MAX_CENARIOS} cenários por lote.",
+        )
+
+    # Matriz convertida uma única vez e compartilhada por todos os cenários
+    try:
+        matriz = await obter_matriz(body)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Matriz inválida: {e}")
+
+    loop = asyncio.get_running_loop()
+    pool = obter_pool_processos()
+
+    # Chaves e consultas ao cache de todos os cenários de uma vez, antes de abrir a resposta
+    chaves = []
+    for cenario in cenarios:
+        try:
+            chaves.append(chave_problema(
+                matriz, cenario.get("metas", {}), cenario.get("restricoes", {}),
+                solver=SOLVER_BACKEND, sensibilidade=False, mip=None,
+            ))
+        except Exception as e:
+            chaves.append(e)
+    em_cache = await obter_solucoes([c for c in chaves if isinstance(c, str)])
+    em_cache = dict(zip((c for c in chaves if isinstance(c, str)), em_cache))
+
+    async def executar(indice, cenario, chave, referencia):
+        try:
+            if isinstance(chave, Exception):
+                raise chave
+            resultado = em_cache[chave]
+            if resultado is None:
+                resultado = await loop.run_in_executor(
+                    pool, otimizar_cenario_publicado, referencia, cenario, SOLVER_BACKEND
+                )
+                cache_solucoes.guardar(chave, resultado)
+        except HTTPException:
+            raise
+        except Exception as e:
+            resultado = {"erro": str(e)}
+        return {"indice": indice, "id": cenario.get("id", indice), **resultado}
+
+    async def gerar_linhas():
+        # Matriz publicada uma vez por lote; cada worker a lê uma única vez
+        with publicar_matriz(matriz) as referencia:
+            tarefas = [executar(i, c, k, referencia) for i, (c, k) in enumerate(zip(cenarios, chaves))]
+            for tarefa in asyncio.as_completed(tarefas):
+                resultado = await tarefa
+                yield json.dumps(resultado, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(gerar_linhas(), media_type="application/x-ndjson")
+
+
+# --------------------------------------------------------------
+# /optimize/varredura_preco → Varia o preço de uma MP e resolve cada ponto
+# - body: {"matriz" | "versao_matriz" | "usuario_id"?, "metas", "restricoes", "materia_prima",
+#          "precos": [...] ou {"inicio", "fim", "pontos"}}
+# --------------------------------------------------------------
+@app.post("/optimize/varredura_preco")
+async def optimize_varredura_preco(request: Request):
+    try:
+        body = await ler_corpo(request)
+        precos = body.get("precos", [])
+        if isinstance(precos, dict):
+            precos = np.linspace(
+                float(precos["inicio"]), float(precos["fim"]), int(precos.get("pontos", 50))
+            )
+
+        return await executor_cpu.executar(
+            varrer_preco,
+            await obter_matriz(body),
+            restricoes=body.get("restricoes", {}),
+            metas=body.get("metas", {}),
+            mp=body.get("materia_prima"),
+            precos=precos,
+            solver=SOLVER_BACKEND,
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print("❌ ERRO NA VARREDURA:", e)
+        return {"erro": str(e)}
+
+
+# --------------------------------------------------------------
+# /optimize/pareto → Fronteira custo × nutriente(s) por ε-restrição
+# - body: {"matriz" | "versao_matriz" | "usuario_id"?, "metas", "restricoes", "pontos"?,
+#          "objetivos": [{"nutriente", "sentido": "max"|"min", "inicio"?, "fim"?, "pontos"?}] (1 ou 2)}
+# --------------------------------------------------------------
+@app.post("/optimize/pareto")
+async def optimize_pareto(request: Request):
+    try:
+        body = await ler_corpo(request)
+        objetivos = body.get("objetivos", [])
+        pontos = int(body.get("pontos", 20))
+
+        total = 1
+        for obj in objetivos:
+            total *= int(obj.get("pontos", pontos))
+        if total > PARETO_MAX_PONTOS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Máximo de {PARETO_MAX_PONTOS} pontos na grade (pedidos: {total}).",
+            )
+
+        return await executor_cpu.executar(
+            fronteira_pareto,
+            await obter_matriz(body),
+            restricoes=body.get("restricoes", {}),
+            metas=body.get("metas", {}),
+            objetivos=objetivos,
+            pontos=pontos,
+            solver=SOLVER_BACKEND,
+            workers=PARETO_WORKERS,
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print("❌ ERRO NA FRONTEIRA DE PARETO:", e)
+        return {"erro": str(e)}
+
+
+# --------------------------------------------------------------
+# /optimize/conjunto → Várias fórmulas em um único LP com estoque compartilhado
+# - body: {"matriz" | "versao_matriz" | "usuario_id"?,
+#          "formulas": [{"id"?, "metas", "restricoes", "tonelagem"}, ...],
+#          "estoques": {mp: quantidade disponível (mesma unidade da tonelagem)}}
+# --------------------------------------------------------------
+@app.post("/optimize/conjunto")
+async def optimize_conjunto(request: Request):
+    try:
+        body = await ler_corpo(request)
+        return await executor_cpu.executar(
+            otimizar_conjunto,
+            await obter_matriz(body),
+            formulas=body.get("formulas", []),
+            estoques=body.get("estoques", {}),
+            solver=SOLVER_BACKEND,
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print("❌ ERRO NA OTIMIZAÇÃO CONJUNTA:", e)
+        return {"erro": str(e)}
+
+
+# --------------------------------------------------------------
+# /modelos → Modelo compilado uma vez e re-resolvido após ajustes
+# - POST   /modelos                  body: {"matriz" | "versao_matriz" | "usuario_id"?, "metas", "restricoes"}
+# - PATCH  /modelos/{id}             body: {"metas"?, "restricoes"?, "precos"?: {mp: preço}, "resolver"?}
+# - POST   /modelos/{id}/resolver
+# - DELETE /modelos/{id}
+# --------------------------------------------------------------
+def obter_sessao_modelo(sessao_id):
+    modelo = sessoes_modelo.obter(sessao_id)
+    if modelo is None:
+        raise HTTPException(status_code=404, detail="Sessão de modelo não encontrada ou expirada.")
+    return modelo
+
+
+@app.post("/modelos")
+async def criar_modelo(request: Request):
+    body = await ler_corpo(request)
+    try:
+        modelo = await executor_cpu.executar(
+            ModeloCompilado,
+            await obter_matriz(body),
+            restricoes=body.get("restricoes", {}),
+            metas=body.get("metas", {}),
+            solver=SOLVER_BACKEND,
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {"sessao_id": sessoes_modelo.criar(modelo), **modelo.tamanho}
+
+
+@app.patch("/modelos/{sessao_id}")
+async def atualizar_modelo(sessao_id: str, request: Request):
+    modelo = obter_sessao_modelo(sessao_id)
+    body = await ler_corpo(request)
+    try:
+        # Fora do loop de eventos: atualizar espera o lock do modelo enquanto ele resolve
+        await executor_cpu.executar(
+            modelo.atualizar,
+            metas=body.get("metas"),
+            restricoes=body.get("restricoes"),
+            precos=body.get("precos"),
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if body.get("resolver"):
+        return await executor_cpu.executar(modelo.resolver)
+    return {"status": "ok"}
+
+
+@app.post("/modelos/{sessao_id}/resolver")
+async def resolver_modelo(sessao_id: str):
+    modelo = obter_sessao_modelo(sessao_id)
+    return await executor_cpu.executar(modelo.resolver)
+
+
+@app.delete("/modelos/{sessao_id}")
+def remover_modelo(sessao_id: str):
+    if not sessoes_modelo.remover(sessao_id):
+        raise HTTPException(status_code=404, detail="Sessão de modelo não encontrada ou expirada.")
+    return {"status": "ok"}
+
+
+# --------------------------------------------------------------
+# /jobs → Otimização em segundo plano (sobrevive a reinícios do servidor)
+# - POST body: o mesmo do /optimize, ou do /optimize/batch com "cenarios"; "tempo_limite"? (s)
+#   → 202 {"id", "status": "na_fila", ...}
+# - GET /jobs/{id} → status e, ao terminar, "resultado" | "erro"
+# - GET /jobs/{id}/eventos → mudanças de status via server-sent events
+# - DELETE /jobs/{id} → cancela (na fila ou em execução)
+# --------------------------------------------------------------
+@app.post("/jobs")
+async def submeter_job(request: Request):
+    body = await ler_corpo(request)
+    cenarios = body.get("cenarios")
+    robusto = body.get("robusto") or None
+    mip = body.get("mip") or None
+    sensibilidade = bool(body.get("sensibilidade"))
+
+    if cenarios is not None:
+        if not isinstance(cenarios, list) or not cenarios:
+            raise HTTPException(status_code=400, detail="Informe ao menos um cenário em 'cenarios'.")
+        if len(cenarios) > BATCH_MAX_CENARIOS:
+            raise HTTPException(status_code=400, detail=f"Máximo de {BATCH_MAX_CENARIOS} cenários por lote.")
+    if robusto and (mip or sensibilidade):
+        raise HTTPException(status_code=400, detail="'robusto' não pode ser combinado com 'mip' ou 'sensibilidade'.")
+
+    # Matriz e variabilidade resolvidas agora: o job não depende do Mongo nem de versões em cache
+    try:
+        matriz = await obter_matriz(body)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Matriz inválida: {e}")
+
+    parametros = {
+        "matriz": transporte.matriz_compacta(matriz),
+        "metas": body.get("metas", {}),
+        "restricoes": body.get("restricoes", {}),
+        "solver": SOLVER_BACKEND,
+    }
+    if cenarios is not None:
+        parametros["cenarios"] = cenarios
+    elif robusto:
+        parametros["robusto"] = robusto
+        parametros["variabilidade"] = await obter_variabilidade(body)
+    elif mip:
+        parametros["mip"] = mip
+    else:
+        parametros["sensibilidade"] = sensibilidade
+
+    job = await executor_cpu.executar(fila_jobs.submeter, parametros, body.get("tempo_limite"))
+    return JSONResponse(status_code=202, content=job, headers={"Location": f"/jobs/{job['id']}"})
+
+
+@app.get("/jobs/{job_id}")
+def obter_job(job_id: str):
+    job = fila_jobs.obter(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado ou expirado.")
+    return job
+
+
+@app.get("/jobs/{job_id}/eventos")
+async def eventos_job(job_id: str, request: Request):
+    # Leituras do SQLite no pool de threads de I/O: o loop de eventos atende todos os assinantes
+    if await run_in_threadpool(fila_jobs.obter, job_id, com_resultado=False) is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado ou expirado.")
+
+    async def gerar_eventos():
+        anterior = None
+        ultimo_envio = time.monotonic()
+        while not await request.is_disconnected():
+            job = await run_in_threadpool(fila_jobs.obter, job_id, com_resultado=False)
+            if job is None:
+                return
+            estado = (job["status"], job["cancelar"])
+            if estado != anterior:
+                anterior = estado
+                if job["status"] in STATUS_TERMINAIS_JOB:
+                    job = await run_in_threadpool(fila_jobs.obter, job_id)
+                ultimo_envio = time.monotonic()
+                yield f"event: status\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+                if job["status"] in STATUS_TERMINAIS_JOB:
+                    return
+            elif time.monotonic() - ultimo_envio > 15:
+                # Comentário SSE: mantém proxies sem fechar a conexão ociosa
+                ultimo_envio = time.monotonic()
+                yield ": ativo\n\n"
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(
+        gerar_eventos(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+@app.delete("/jobs/{job_id}")
+def cancelar_job(job_id: str):
+    job = fila_jobs.cancelar(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado ou expirado.")
+    if job["status"] in STATUS_TERMINAIS_JOB and job["status"] != "cancelado":
+        raise HTTPException(status_code=409, detail=f"Job já finalizado ({job['status']}).")
+    return job
+
+
 # --------------------------------------------------------------
 # /consulta → Avalia fórmula existente
+# - body: {"formulacao": {...}} ou {"formulacoes": [{...}, ...]}
+#   + opcional "matriz" | "versao_matriz" | "usuario_id" (padrão: base local)
+# - corpo JSON, msgpack ou Arrow (Content-Type); resposta em msgpack se Accept pedir
 # --------------------------------------------------------------
 @app.post("/consulta")
 async def consultar(request: Request):
     try:
-        body = await request.json()
-        formulacao = body.get("formulacao", body)
+        body = await ler_corpo(request)
+        matriz = await obter_matriz(body)
 
-        colunas_norm = {normalizar_nome(c): c for c in materias_primas_local.columns}
-        proporcoes_validas = {}
+        if "formulacoes" in body:
+            resultados = await executor_cpu.executar(
+                avaliar_formulacoes, matriz, body["formulacoes"], ALIASES_MP
+            )
+            return responder(request, {"resultados": resultados, "versao_indice": matriz.indice_colunas().versao})
 
-        for mp, valor in formulacao.items():
-            try:
-                valor_float = float(valor)
-                if valor_float > 0:
-                    nome_norm = normalizar_nome(mp)
-                    if nome_norm in colunas_norm:
-                        proporcoes_validas[colunas_norm[nome_norm]] = valor_float
-            except Exception:
-                continue
-
-        if not proporcoes_validas:
-            raise ValueError("Nenhuma MP válida foi informada.")
-
-        proporcoes = pd.Series(proporcoes_validas, dtype=float)
-        proporcoes = proporcoes / proporcoes.sum()
-
-        matriz_filtrada = materias_primas_local[proporcoes.index]
-        matriz_sem_custo = matriz_filtrada.drop(index=CUSTO_ROW_NAME, errors="ignore")
-
-        nutrientes = matriz_sem_custo.dot(proporcoes)
-        custo_por_mp = matriz_filtrada.loc[CUSTO_ROW_NAME] * proporcoes
-        custo_total = custo_por_mp.sum()
-
-        return {
-            "status": "OK",
-            "nutrientes": [{"Nutriente": n, "Valor Obtido": v} for n, v in nutrientes.items()],
-            "custos": [{"Matéria-Prima": mp, "Custo": custo} for mp, custo in custo_por_mp.items()],
-            "custo_total": custo_total,
-        }
+        formulacao = body.get("formulacao", body)
+        resultado = (await executor_cpu.executar(
+            avaliar_formulacoes, matriz, [formulacao], ALIASES_MP
+        ))[0]
+        if "erro" in resultado:
+            raise ValueError(resultado["erro"])
+        return responder(request, resultado)
 
+    except HTTPException:
+        raise
     except Exception as e:
         print("❌ ERRO NA CONSULTA:", e)
         return {"erro": str(e)}
+
+
+# --------------------------------------------------------------
+# /formulas → Fórmulas salvas por usuário (MongoDB)
+# - cada documento é uma coluna esparsa da matriz de inclusões: "mps" + "inclusoes" (%)
+# - POST body: {"usuario_id", "nome", "formulacao": {mp: valor}, "metas"?, "restricoes"?}
+# - POST /formulas/{usuario_id}/recalcular → custo e metas de todas em um único produto;
+#   body opcional: {"limite_custo", "perfis", "reotimizar", "atualizar_referencia"}
+# --------------------------------------------------------------
+async def recalcular_formulas_usuario(usuario_id, limite_custo=None, perfis=False,
+                                      reotimizar=False, atualizar_referencia=False):
+    projecao = {"nome": 1, "mps": 1, "inclusoes": 1, "metas": 1, "restricoes": 1, "custo_referencia": 1}
+    with medir("mongo_formulas"):
+        formulas = await formulas_collection.find({"usuario_id": usuario_id}, projecao).to_list(None)
+    if not formulas:
+        return {"total": 0, "sinalizadas": 0, "formulas": []}
+    for f in formulas:
+        f["id"] = str(f.pop("_id"))
+
+    versao, matriz = await carregar_matriz_usuario(usuario_id)
+    resultado = await executor_cpu.executar(
+        recalcular_formulas, matriz, formulas,
+        limite_custo=FORMULAS_LIMITE_CUSTO if limite_custo is None else float(limite_custo), perfis=perfis,
+    )
+    resultado["versao_matriz"] = versao
+
+    if atualizar_referencia:
+        # O custo atual passa a ser a referência dos próximos recálculos
+        operacoes = [
+            UpdateOne(
+                {"_id": ObjectId(r["id"])},
+                {"$set": {"custo_referencia": r["custo_atual"], "versao_referencia": versao}},
+            )
+            for r in resultado["formulas"] if r["custo_atual"] is not None
+        ]
+        # bulk_write recusa lista vazia (nenhuma fórmula com custo calculável)
+        if operacoes:
+            await formulas_collection.bulk_write(operacoes)
+
+    if reotimizar:
+        # Só as sinalizadas, como cenários de lote (uma cópia da matriz por job)
+        cenarios = [
+            {"id": f["id"], "metas": f.get("metas") or {}, "restricoes": f.get("restricoes") or {}}
+            for f, r in zip(formulas, resultado["formulas"]) if r["sinalizada"] and r["custo_atual"] is not None
+        ]
+        compacta = transporte.matriz_compacta(matriz)
+        resultado["job_ids"] = []
+        for inicio in range(0, len(cenarios), BATCH_MAX_CENARIOS):
+            job = await executor_cpu.executar(fila_jobs.submeter, {
+                "matriz": compacta,
+                "cenarios": cenarios[inicio:inicio + BATCH_MAX_CENARIOS],
+                "solver": SOLVER_BACKEND,
+            })
+            resultado["job_ids"].append(job["id"])
+    return resultado
+
+
+@app.post("/formulas")
+async def salvar_formula(request: Request):
+    if not mongo_disponivel():
+        raise HTTPException(status_code=503, detail="MongoDB não configurado ou indisponível.")
+    body = await ler_corpo(request)
+    usuario_id = body.get("usuario_id")
+    if not usuario_id or not isinstance(body.get("formulacao"), dict):
+        raise HTTPException(status_code=400, detail="Informe 'usuario_id' e 'formulacao'.")
+
+    try:
+        versao, matriz = await carregar_matriz_usuario(usuario_id)
+        formula = await executor_cpu.executar(preparar_formula, matriz, body["formulacao"], ALIASES_MP)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    nao_encontradas = formula.pop("nao_encontradas")
+    result = await formulas_collection.insert_one({
+        "usuario_id": usuario_id,
+        "nome": body.get("nome"),
+        **formula,
+        "metas": body.get("metas") or {},
+        "restricoes": body.get("restricoes") or {},
+        "versao_referencia": versao,
+        "criado_em": time.time(),
+    })
+    return {
+        "id": str(result.inserted_id),
+        "custo_referencia": formula["custo_referencia"],
+        "nao_encontradas": nao_encontradas,
+        "versao_matriz": versao,
+    }
+
+
+@app.get("/formulas/{usuario_id}")
+async def listar_formulas(usuario_id: str):
+    if not mongo_disponivel():
+        raise HTTPException(status_code=503, detail="MongoDB não configurado ou indisponível.")
+    formulas = await formulas_collection.find({"usuario_id": usuario_id}).to_list(None)
+    for f in formulas:
+        f["_id"] = str(f["_id"])
+    return formulas
+
+
+@app.delete("/formulas/{formula_id}")
+async def deletar_formula(formula_id: str):
+    if not mongo_disponivel():
+        raise HTTPException(status_code=503, detail="MongoDB não configurado ou indisponível.")
+    result = await formulas_collection.delete_one({"_id": ObjectId(formula_id)})
+    if not result.deleted_count:
+        raise HTTPException(status_code=404, detail="Fórmula não encontrada.")
+    return {"status": "ok"}
+
+
+@app.post("/formulas/{usuario_id}/recalcular")
+async def recalcular_formulas_endpoint(usuario_id: str, request: Request):
+    if not mongo_disponivel():
+        raise HTTPException(status_code=503, detail="MongoDB não configurado ou indisponível.")
+    body = await ler_corpo(request) if await request.body() else {}
+    try:
+        resultado = await recalcular_formulas_usuario(
+            usuario_id,
+            limite_custo=body.get("limite_custo"),
+            perfis=bool(body.get("perfis")),
+            reotimizar=bool(body.get("reotimizar")),
+            atualizar_referencia=bool(body.get("atualizar_referencia")),
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return responder(request, resultado)
@@ -0,0 +1,272 @@
+import contextvars
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+
+# ==============================================================
+# MÉTRICAS EM MEMÓRIA (formato texto do Prometheus)
+# ==============================================================
+
+BUCKETS_SEGUNDOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_TAMANHO = (10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000, 500000)
+BUCKETS_ITERACOES = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+
+
+def _rotulos(pares):
+    if not pares:
+        return ""
+    texto = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pares
+    )
+    return "{" + texto + "}"
+
+
+def _numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class Histograma:
+    tipo = "histogram"
+
+    def __init__(self, nome, ajuda, buckets):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.buckets = tuple(buckets)
+        self._series = {}  # rótulos -> [contagens por bucket, soma, total]
+        self._lock = threading.Lock()
+
+    def observar(self, valor, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        k = bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(chave)
+            if serie is None:
+                serie = self._series[chave] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            serie[0][k] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def linhas(self):
+        with self._lock:
+            series = [(chave, list(c), soma, total) for chave, (c, soma, total) in self._series.items()]
+        for chave, contagens, soma, total in sorted(series):
+            acumulado = 0
+            for limite, n in zip(self.buckets + (float("inf"),), contagens):
+                acumulado += n
+                yield f"{self.nome}_bucket{_rotulos(chave + (('le', _numero(limite)),))} {acumulado}"
+            yield f"{self.nome}_sum{_rotulos(chave)} {_numero(soma)}"
+            yield f"{self.nome}_count{_rotulos(chave)} {total}"
+
+
+class Contador:
+    tipo = "counter"
+
+    def __init__(self, nome, ajuda):
+        self.nome = nome
+        self.ajuda = ajuda
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, valor=1, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        with self._lock:
+            self._series[chave] = self._series.get(chave, 0) + valor
+
+    def linhas(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        for chave, valor in series:
+            yield f"{self.nome}{_rotulos(chave)} {_numero(valor)}"
+
+
+class RegistroMetricas:
+    def __init__(self):
+        self._metricas = {}
+        self._coletores = []
+        self._lock = threading.Lock()
+
+    def _obter(self, classe, nome, *args):
+        with self._lock:
+            metrica = self._metricas.get(nome)
+            if metrica is None:
+                metrica = self._metricas[nome] = classe(nome, *args)
+            return metrica
+
+    def histograma(self, nome, ajuda, buckets=BUCKETS_SEGUNDOS):
+        return self._obter(Histograma, nome, ajuda, buckets)
+
+    def contador(self, nome, ajuda):
+        return self._obter(Contador, nome, ajuda)
+
+    def coletor(self, funcao):
+        """funcao() → [(nome, tipo, ajuda, [(rotulos dict, valor), ...]), ...], lida a cada /metrics."""
+        self._coletores.append(funcao)
+        return funcao
+
+    def renderizar(self):
+        saida = []
+        with self._lock:
+            metricas = list(self._metricas.values())
+        for metrica in metricas:
+            saida.append(f"# HELP {metrica.nome} {metrica.ajuda}")
+            saida.append(f"# TYPE {metrica.nome} {metrica.tipo}")
+            saida.extend(metrica.linhas())
+        for coletor in self._coletores:
+            for nome, tipo, ajuda, amostras in coletor():
+                saida.append(f"# HELP {nome} {ajuda}")
+                saida.append(f"# TYPE {nome} {tipo}")
+                saida.extend(f"{nome}{_rotulos(sorted(r.items()))} {_numero(v)}" for r, v in amostras)
+        return "\n".join(saida) + "\n"
+
+
+registro = RegistroMetricas()
+
+# Desativado por padrão até configurar(): medir()/observar() viram chamadas vazias
+ATIVO = False
+
+_etapas = registro.histograma("otimizador_etapa_segundos", "Duração de cada etapa do processamento.")
+_valores = {}
+
+# Etapas da requisição corrente (para o cabeçalho Server-Timing); None fora de requisições
+_spans_requisicao = contextvars.ContextVar("spans_requisicao", default=None)
+
+
+def configurar(ativo):
+    global ATIVO
+    ATIVO = bool(ativo)
+
+
+# ==============================================================
+# SPANS DE ETAPA
+# ==============================================================
+
+class _Nulo:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULO = _Nulo()
+
+
+def registrar_etapa(etapa, duracao):
+    _etapas.observar(duracao, etapa=etapa)
+    spans = _spans_requisicao.get()
+    if spans is not None:
+        spans.append((etapa, duracao))
+
+
+class _Span:
+    __slots__ = ("etapa", "inicio")
+
+    def __init__(self, etapa):
+        self.etapa = etapa
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        registrar_etapa(self.etapa, time.perf_counter() - self.inicio)
+        return False
+
+
+def medir(etapa):
+    """with medir("montar_lp"): ... → histograma por etapa e entrada no Server-Timing."""
+    if not ATIVO:
+        return _NULO
+    return _Span(etapa)
+
+
+def etapa(nome):
+    """Decorador equivalente a envolver a função inteira em medir(nome)."""
+    def decorador(fn):
+        @functools.wraps(fn)
+        def medida(*args, **kwargs):
+            if not ATIVO:
+                return fn(*args, **kwargs)
+            with _Span(nome):
+                return fn(*args, **kwargs)
+        return medida
+    return decorador
+
+
+def observar(nome, valor, ajuda="", buckets=BUCKETS_TAMANHO, **rotulos):
+    # Grandezas que não são tempo (tamanho do modelo, iterações do solver)
+    if not ATIVO or valor is None:
+        return
+    histograma = _valores.get(nome)
+    if histograma is None:
+        histograma = _valores.setdefault(nome, registro.histograma(nome, ajuda, buckets))
+    histograma.observar(valor, **rotulos)
+
+
+def contar(nome, ajuda="", valor=1, **rotulos):
+    if not ATIVO:
+        return
+    registro.contador(nome, ajuda).incrementar(valor, **rotulos)
+
+
+# ==============================================================
+# MIDDLEWARE ASGI (latência por rota + Server-Timing)
+# ==============================================================
+
+_requisicoes = registro.histograma("otimizador_requisicao_segundos", "Latência das requisições HTTP por rota.")
+
+
+def _server_timing(spans, total):
+    # Etapas repetidas na mesma requisição são somadas
+    somas = {}
+    for etapa, duracao in spans:
+        somas[etapa] = somas.get(etapa, 0.0) + duracao
+    partes = [f"{etapa};dur={duracao * 1000:.3f}" for etapa, duracao in somas.items()]
+    partes.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(partes)
+
+
+class MiddlewareMetricas:
+    def __init__(self, app, server_timing=False):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ATIVO:
+            await self.app(scope, receive, send)
+            return
+
+        inicio = time.perf_counter()
+        spans = []
+        token = _spans_requisicao.set(spans)
+        status = 500
+
+        async def enviar(mensagem):
+            nonlocal status
+            if mensagem["type"] == "http.response.start":
+                status = mensagem["status"]
+                if self.server_timing:
+                    # Em respostas em streaming só entram as etapas concluídas até o cabeçalho
+                    valor = _server_timing(spans, time.perf_counter() - inicio)
+                    mensagem = {
+                        **mensagem,
+                        "headers": list(mensagem.get("headers", [])) + [(b"server-timing", valor.encode("latin-1"))],
+                    }
+            await send(mensagem)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            _spans_requisicao.reset(token)
+            # Modelo da rota ("/modelos/{sessao_id}") em vez do caminho: cardinalidade limitada
+            rota = getattr(scope.get("route"), "path", None) or "nao_encontrada"
+            _requisicoes.observar(
+                time.perf_counter() - inicio, rota=rota, metodo=scope["method"], status=status
+            )
@@ -1,5 +1,31 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from statistics import NormalDist
+
+import numpy as np
 import pandas as pd
-from pulp import LpProblem, LpVariable, LpMinimize, lpSum, LpStatus
+import metricas
+from indice_nomes import IndiceNomes
+from pulp import (
+    LpProblem, LpVariable, LpMinimize, lpSum, LpStatus,
+    LpAffineExpression, LpConstraint, LpConstraintLE, LpConstraintEQ,
+    PULP_CBC_CMD, LpSolutionOptimal, LpSolutionIntegerFeasible,
+)
+
+try:
+    from scipy.optimize import linprog
+    from scipy import sparse
+except ImportError:  # scipy é opcional: sem ele apenas o CBC (PuLP) fica disponível
+    linprog = sparse = None
+
+try:
+    import highspy
+except ImportError:  # highspy é opcional: habilita warm start nas varreduras paramétricas
+    highspy = None
 
 CUSTO_ROW_NAME = "Custo"
 
@@ -71,3 +97,1577 @@ def otimizar_formula(materias_primas, restricoes, metas):
         "custos_individuais": custos,
         "conferencia_nutricional": conferencia_nutricional,
     }
+
+
+# ==============================================================
+# MOTOR MATRICIAL (forma padrão: A_ub, b_ub, A_eq, bounds)
+# ==============================================================
+
+@dataclass
+class MatrizNutricional:
+    """Matriz numérica de MPs: linhas = Custo + nutrientes, colunas = MPs."""
+    linhas: list
+    colunas: list
+    valores: np.ndarray
+    _pos_linha: dict = field(init=False, repr=False)
+    _pos_coluna: dict = field(init=False, repr=False)
+    _assinatura: str = field(init=False, repr=False, default=None)
+    _indice_colunas: IndiceNomes = field(init=False, repr=False, default=None)
+
+    def __post_init__(self):
+        self.valores = np.asarray(self.valores, dtype=float)
+        self._pos_linha = {nome: i for i, nome in enumerate(self.linhas)}
+        self._pos_coluna = {nome: j for j, nome in enumerate(self.colunas)}
+
+    @classmethod
+    @metricas.etapa("conversao_matriz")
+    def de_dataframe(cls, df):
+        # Linhas sem nenhum valor numérico (ex.: "_id", "usuario_id" vindos do Mongo) são descartadas
+        numerico = df.apply(pd.to_numeric, axis=1, errors="coerce")
+        numerico = numerico.loc[numerico.notna().any(axis=1)].fillna(0)
+        colunas = [c for c in numerico.columns if c != CUSTO_ROW_NAME]
+        numerico = numerico[colunas]
+        if CUSTO_ROW_NAME not in numerico.index:
+            numerico.loc[CUSTO_ROW_NAME] = 0.0
+        return cls(list(numerico.index), colunas, numerico.to_numpy(dtype=float))
+
+    def assinatura(self):
+        # Hash do conteúdo (nomes + valores), calculado uma vez por matriz
+        if self._assinatura is None:
+            h = hashlib.sha256()
+            h.update("\x1f".join(map(str, self.linhas)).encode())
+            h.update(b"\x1e")
+            h.update("\x1f".join(map(str, self.colunas)).encode())
+            h.update(np.ascontiguousarray(self.valores).tobytes())
+            self._assinatura = h.hexdigest()
+        return self._assinatura
+
+    def indice_colunas(self, aliases=None):
+        # Índice de nomes das MPs construído uma vez por matriz (versão = assinatura do conteúdo)
+        if self._indice_colunas is None:
+            self._indice_colunas = IndiceNomes(
+                self.colunas, versao=self.assinatura()[:12], aliases=aliases
+            )
+        return self._indice_colunas
+
+    def para_dict(self):
+        # Mesmo formato de "matriz" usado pelo frontend: {nutriente: {mp: valor}}
+        return {
+            nome: dict(zip(self.colunas, linha))
+            for nome, linha in zip(self.linhas, self.valores.tolist())
+        }
+
+    def linha(self, nome):
+        return self._pos_linha.get(nome)
+
+    def coluna(self, nome):
+        return self._pos_coluna.get(nome)
+
+    @property
+    def custos(self):
+        return self.valores[self._pos_linha[CUSTO_ROW_NAME]]
+
+    @property
+    def nutrientes(self):
+        return [n for n in self.linhas if n != CUSTO_ROW_NAME]
+
+
+@dataclass
+class ProblemaLP:
+    """LP em forma padrão: min c·x  s.a.  A_ub x <= b_ub,  A_eq x = b_eq,  bounds."""
+    c: np.ndarray
+    A_ub: np.ndarray
+    b_ub: np.ndarray
+    A_eq: np.ndarray
+    b_eq: np.ndarray
+    bounds: np.ndarray
+    # (nutriente, "min" | "max") de cada linha de A_ub
+    linhas_ub: list
+    # 1 = variável inteira (MIP); None = LP contínuo
+    integralidade: np.ndarray = None
+
+
+@metricas.etapa("montar_lp")
+def montar_lp(matriz, restricoes, metas):
+    n = len(matriz.colunas)
+
+    # Inclusões em %: custo e nutrientes entram divididos por 100
+    c = matriz.custos / 100
+
+    bounds = np.tile([0.0, 100.0], (n, 1))
+    for mp, (min_val, max_val) in restricoes.items():
+        j = matriz.coluna(mp)
+        if j is None:
+            continue
+        if min_val is not None:
+            bounds[j, 0] = max(bounds[j, 0], float(min_val))
+        if max_val is not None:
+            bounds[j, 1] = min(bounds[j, 1], float(max_val))
+
+    idx, sinais, rhs, linhas_ub = [], [], [], []
+    for nutr, (min_val, max_val) in metas.items():
+        i = matriz.linha(nutr)
+        if i is None:
+            continue
+        if min_val is not None:
+            idx.append(i); sinais.append(-1.0); rhs.append(-float(min_val))
+            linhas_ub.append((nutr, "min"))
+        if max_val is not None:
+            idx.append(i); sinais.append(1.0); rhs.append(float(max_val))
+            linhas_ub.append((nutr, "max"))
+
+    A_ub = matriz.valores[idx] * np.asarray(sinais)[:, None] / 100 if idx else np.zeros((0, n))
+
+    return ProblemaLP(
+        c=c,
+        A_ub=A_ub,
+        b_ub=np.asarray(rhs, dtype=float),
+        A_eq=np.ones((1, n)),
+        b_eq=np.array([100.0]),
+        bounds=bounds,
+        linhas_ub=linhas_ub,
+    )
+
+
+def _expressao(variaveis, coeficientes):
+    nz = np.flatnonzero(coeficientes)
+    return LpAffineExpression([(variaveis[j], float(coeficientes[j])) for j in nz])
+
+
+def _linhas(A):
+    # (índices, valores) não nulos de cada linha, para matrizes densas ou esparsas
+    if sparse is not None and sparse.issparse(A):
+        A = A.tocsr()
+        for k in range(A.shape[0]):
+            inicio, fim = A.indptr[k], A.indptr[k + 1]
+            yield A.indices[inicio:fim], A.data[inicio:fim]
+    else:
+        for linha in A:
+            nz = np.flatnonzero(linha)
+            yield nz, linha[nz]
+
+
+def _expressao_linha(variaveis, indices, valores):
+    return LpAffineExpression([(variaveis[j], float(v)) for j, v in zip(indices, valores)])
+
+
+@dataclass
+class SolucaoLP:
+    status: str
+    x: np.ndarray
+    solver: str = ""
+    tempo: float = 0.0
+    # d(custo)/d(b_ub) de cada linha de A_ub e custo reduzido de cada variável (quando o backend fornece)
+    duais_ub: np.ndarray = None
+    custos_reduzidos: np.ndarray = None
+    # Informações do MIP (gap, limite inferior, nós, incumbente)
+    mip: dict = None
+    # Iterações simplex (HiGHS); o CBC via PuLP não informa
+    iteracoes: int = None
+
+
+def _modelo_pulp(lp):
+    model = LpProblem("Otimizador_de_Formulacoes", LpMinimize)
+
+    # Nomes posicionais evitam colisões/caracteres inválidos nos nomes das MPs
+    inteiras = lp.integralidade if lp.integralidade is not None else np.zeros(len(lp.c))
+    x = [
+        LpVariable(
+            f"x{j}",
+            lo if np.isfinite(lo) else None,
+            hi if np.isfinite(hi) else None,
+            cat="Integer" if inteira else "Continuous",
+        )
+        for j, ((lo, hi), inteira) in enumerate(zip(lp.bounds, inteiras))
+    ]
+
+    model += _expressao(x, lp.c), "Custo_Total"
+    for k, ((idx, val), rhs) in enumerate(zip(_linhas(lp.A_eq), lp.b_eq)):
+        model += LpConstraint(_expressao_linha(x, idx, val), LpConstraintEQ, f"eq{k}", rhs)
+    for k, ((idx, val), rhs) in enumerate(zip(_linhas(lp.A_ub), lp.b_ub)):
+        model += LpConstraint(_expressao_linha(x, idx, val), LpConstraintLE, f"ub{k}", rhs)
+    return model, x
+
+
+def resolver_lp_pulp(lp):
+    model, x = _modelo_pulp(lp)
+    model.solve()
+    valores = np.array([v.value() or 0.0 for v in x], dtype=float)
+    return SolucaoLP(
+        LpStatus[model.status],
+        valores,
+        duais_ub=np.array([model.constraints[f"ub{k}"].pi or 0.0 for k in range(len(lp.b_ub))]),
+        custos_reduzidos=np.array([v.dj or 0.0 for v in x]),
+    )
+
+
+# Códigos de retorno do linprog → mesmos textos de status do PuLP
+STATUS_LINPROG = {0: "Optimal", 1: "Not Solved", 2: "Infeasible", 3: "Unbounded", 4: "Undefined"}
+
+
+def resolver_lp_highs(lp):
+    res = linprog(
+        lp.c,
+        A_ub=lp.A_ub if len(lp.b_ub) else None,
+        b_ub=lp.b_ub if len(lp.b_ub) else None,
+        A_eq=lp.A_eq,
+        b_eq=lp.b_eq,
+        bounds=lp.bounds,
+        method="highs",
+    )
+    valores = res.x if res.x is not None else np.zeros(len(lp.c))
+    solucao = SolucaoLP(
+        STATUS_LINPROG.get(res.status, "Undefined"), np.asarray(valores, dtype=float), iteracoes=res.get("nit")
+    )
+    if res.status == 0:
+        solucao.duais_ub = res.ineqlin.marginals if len(lp.b_ub) else np.zeros(0)
+        solucao.custos_reduzidos = res.lower.marginals + res.upper.marginals
+    return solucao
+
+
+# ==============================================================
+# BACKENDS DE SOLVER
+# ==============================================================
+
+SOLVERS = {
+    "highs": resolver_lp_highs,
+    "cbc": resolver_lp_pulp,
+}
+SOLVER_PADRAO = "highs"
+
+
+def solvers_disponiveis():
+    return [nome for nome in SOLVERS if nome != "highs" or linprog is not None]
+
+
+def resolver_lp(lp, solver=None):
+    nome = (solver or SOLVER_PADRAO).lower()
+    if nome not in solvers_disponiveis():
+        # HiGHS indisponível (scipy ausente) ou nome desconhecido → CBC
+        nome = "cbc"
+
+    inicio = time.perf_counter()
+    with metricas.medir(f"solver_{nome}"):
+        solucao = SOLVERS[nome](lp)
+    solucao.solver = nome
+    solucao.tempo = time.perf_counter() - inicio
+    _registrar_solucao(lp, solucao)
+    return solucao
+
+
+def _registrar_solucao(lp, solucao, tipo="lp"):
+    if not metricas.ATIVO:
+        return
+    metricas.observar("otimizador_modelo_variaveis", len(lp.c), "Variáveis por modelo resolvido.", tipo=tipo)
+    metricas.observar(
+        "otimizador_modelo_restricoes", len(lp.b_ub) + len(lp.b_eq), "Restrições por modelo resolvido.", tipo=tipo
+    )
+    metricas.observar(
+        "otimizador_solver_iteracoes", solucao.iteracoes, "Iterações simplex por solve.",
+        metricas.BUCKETS_ITERACOES, solver=solucao.solver
+    )
+    metricas.contar(
+        "otimizador_solves_total", "Solves por backend e status.", solver=solucao.solver, status=solucao.status, tipo=tipo
+    )
+
+
+# ==============================================================
+# EXTENSÕES INTEIRAS (MIP)
+# ==============================================================
+
+# Códigos do scipy.optimize.milp → textos do PuLP (LpStatus / LpSolution)
+STATUS_MILP = {0: "Optimal", 1: "Not Solved", 2: "Infeasible", 3: "Unbounded", 4: "Undefined"}
+
+
+def _por_mp(matriz, valor):
+    # Valor único para todas as MPs ou dicionário {mp: valor}; NaN = não se aplica
+    v = np.full(len(matriz.colunas), np.nan)
+    if isinstance(valor, dict):
+        for mp, x in valor.items():
+            j = matriz.coluna(mp)
+            if j is not None and x is not None:
+                v[j] = float(x)
+    elif valor is not None:
+        v[:] = float(valor)
+    return v
+
+
+@metricas.etapa("montar_mip")
+def montar_mip(matriz, restricoes, metas, opcoes):
+    """Acrescenta ao LP: y_j binária (MP usada) e z_j inteira (unidades de incremento)."""
+    lp = montar_lp(matriz, restricoes, metas)
+    n = len(matriz.colunas)
+    lo, hi = lp.bounds[:, 0], lp.bounds[:, 1]
+
+    max_ingredientes = opcoes.get("max_ingredientes")
+    minimo = _por_mp(matriz, opcoes.get("inclusao_minima"))
+    passo = _por_mp(matriz, opcoes.get("incremento"))
+    passo[passo <= 0] = np.nan
+
+    usa_y = max_ingredientes is not None or np.isfinite(minimo).any()
+    js_passo = np.flatnonzero(np.isfinite(passo))
+    n_y = n if usa_y else 0
+    total = n + n_y + len(js_passo)
+
+    def expandir(A):
+        return np.hstack([A, np.zeros((A.shape[0], total - n))])
+
+    A_ub, b_ub, linhas_ub = [expandir(lp.A_ub)], [lp.b_ub], list(lp.linhas_ub)
+    A_eq, b_eq = [expandir(lp.A_eq)], [lp.b_eq]
+    bounds = [lp.bounds]
+    integralidade = [np.zeros(n)]
+
+    if usa_y:
+        eye = np.eye(n)
+        # x_j <= hi_j · y_j  (MP só entra se y_j = 1)
+        A_ub.append(np.hstack([eye, -np.diag(hi), np.zeros((n, len(js_passo)))]))
+        b_ub.append(np.zeros(n))
+        linhas_ub += [(mp, "uso") for mp in matriz.colunas]
+
+        # x_j >= mínimo_j · y_j  (se usada, inclui pelo menos o mínimo)
+        js_min = np.flatnonzero(np.isfinite(minimo))
+        if len(js_min):
+            bloco = np.zeros((len(js_min), total))
+            bloco[np.arange(len(js_min)), js_min] = -1.0
+            bloco[np.arange(len(js_min)), n + js_min] = minimo[js_min]
+            A_ub.append(bloco)
+            b_ub.append(np.zeros(len(js_min)))
+            linhas_ub += [(matriz.colunas[j], "minimo_se_usada") for j in js_min]
+
+        # Σ y_j <= máximo de ingredientes
+        if max_ingredientes is not None:
+            linha = np.zeros((1, total))
+            linha[0, n:n + n] = 1.0
+            A_ub.append(linha)
+            b_ub.append(np.array([float(max_ingredientes)]))
+            linhas_ub.append(("ingredientes", "max"))
+
+        y_lo = (lo > 0).astype(float)  # MPs com mínimo obrigatório já estão usadas
+        bounds.append(np.column_stack([y_lo, np.ones(n)]))
+        integralidade.append(np.ones(n))
+
+    if len(js_passo):
+        # x_j = passo_j · z_j  (inclusão em múltiplos do incremento da balança)
+        bloco = np.zeros((len(js_passo), total))
+        bloco[np.arange(len(js_passo)), js_passo] = 1.0
+        bloco[np.arange(len(js_passo)), n + n_y + np.arange(len(js_passo))] = -passo[js_passo]
+        A_eq.append(bloco)
+        b_eq.append(np.zeros(len(js_passo)))
+        bounds.append(np.column_stack([
+            np.ceil(lo[js_passo] / passo[js_passo] - 1e-9),
+            np.floor(hi[js_passo] / passo[js_passo] + 1e-9),
+        ]))
+        integralidade.append(np.ones(len(js_passo)))
+
+    return ProblemaLP(
+        c=np.concatenate([lp.c, np.zeros(total - n)]),
+        A_ub=np.vstack(A_ub),
+        b_ub=np.concatenate(b_ub),
+        A_eq=np.vstack(A_eq),
+        b_eq=np.concatenate(b_eq),
+        bounds=np.vstack(bounds),
+        linhas_ub=linhas_ub,
+        integralidade=np.concatenate(integralidade),
+    )
+
+
+def resolver_mip_highs(lp, tempo_limite=None, gap=None):
+    from scipy.optimize import milp, LinearConstraint, Bounds
+
+    restricoes = [LinearConstraint(lp.A_eq, lp.b_eq, lp.b_eq)]
+    if len(lp.b_ub):
+        restricoes.append(LinearConstraint(lp.A_ub, -np.inf, lp.b_ub))
+    opcoes = {"disp": False}
+    if tempo_limite is not None:
+        opcoes["time_limit"] = float(tempo_limite)
+    if gap is not None:
+        opcoes["mip_rel_gap"] = float(gap)
+
+    res = milp(
+        lp.c,
+        integrality=lp.integralidade,
+        bounds=Bounds(lp.bounds[:, 0], lp.bounds[:, 1]),
+        constraints=restricoes,
+        options=opcoes,
+    )
+    incumbente = res.x is not None
+    status = STATUS_MILP.get(res.status, "Undefined")
+    if res.status == 1 and incumbente:
+        status = "Solution Found"  # limite de tempo/gap atingido com solução viável
+    return SolucaoLP(
+        status,
+        np.asarray(res.x if incumbente else np.zeros(len(lp.c)), dtype=float),
+        mip={
+            "incumbente": incumbente,
+            "gap": None if getattr(res, "mip_gap", None) is None else float(res.mip_gap),
+            "limite_inferior": None if getattr(res, "mip_dual_bound", None) is None else float(res.mip_dual_bound),
+            "nos": getattr(res, "mip_node_count", None),
+        },
+    )
+
+
+def resolver_mip_pulp(lp, tempo_limite=None, gap=None):
+    model, x = _modelo_pulp(lp)
+    model.solve(PULP_CBC_CMD(msg=False, timeLimit=tempo_limite, gapRel=gap))
+    incumbente = model.sol_status in (LpSolutionOptimal, LpSolutionIntegerFeasible)
+    status = LpStatus[model.status]
+    if model.sol_status == LpSolutionIntegerFeasible:
+        status = "Solution Found"
+    return SolucaoLP(
+        status,
+        np.array([v.value() or 0.0 for v in x], dtype=float),
+        mip={"incumbente": incumbente, "gap": None, "limite_inferior": None, "nos": None},
+    )
+
+
+SOLVERS_MIP = {
+    "highs": resolver_mip_highs,
+    "cbc": resolver_mip_pulp,
+}
+
+
+def resolver_mip(lp, solver=None, tempo_limite=None, gap=None):
+    nome = (solver or SOLVER_PADRAO).lower()
+    if nome not in solvers_disponiveis():
+        nome = "cbc"
+
+    inicio = time.perf_counter()
+    with metricas.medir(f"solver_mip_{nome}"):
+        solucao = SOLVERS_MIP[nome](lp, tempo_limite=tempo_limite, gap=gap)
+    solucao.solver = nome
+    solucao.tempo = time.perf_counter() - inicio
+    _registrar_solucao(lp, solucao, tipo="mip")
+    return solucao
+
+
+def otimizar_formula_mip(materias_primas, restricoes, metas, opcoes, solver=None):
+    matriz = materias_primas
+    if not isinstance(matriz, MatrizNutricional):
+        matriz = MatrizNutricional.de_dataframe(materias_primas)
+
+    lp = montar_mip(matriz, restricoes or {}, metas or {}, opcoes)
+    solucao = resolver_mip(lp, solver, opcoes.get("tempo_limite"), opcoes.get("gap"))
+
+    n = len(matriz.colunas)
+    resultado = montar_resultado(matriz, replace(solucao, x=solucao.x[:n]))
+    resultado["mip"] = {
+        **solucao.mip,
+        # Das inclusões já zeradas quando não há solução viável
+        "ingredientes_usados": sum(v > 0 for v in resultado["inclusoes"].values()),
+    }
+    return resultado
+
+
+@metricas.etapa("montar_resultado")
+def montar_resultado(matriz, solucao):
+    # Sem solução viável não há fórmula a mostrar (o CBC devolve valores sem sentido)
+    x = solucao.x if solucao.status in ("Optimal", "Solution Found") else np.zeros_like(solucao.x)
+    inclusoes = np.round(x, 4)
+
+    # Um único produto matriz-vetor fornece custo total e conferência nutricional
+    composicao = matriz.valores @ inclusoes / 100
+    custos = matriz.custos * inclusoes / 100
+    i_custo = matriz.linha(CUSTO_ROW_NAME)
+
+    return {
+        "status": solucao.status,
+        "custo_total": round(float(composicao[i_custo]), 4),
+        "inclusoes": dict(zip(matriz.colunas, inclusoes.tolist())),
+        "custos_individuais": dict(zip(matriz.colunas, np.round(custos, 4).tolist())),
+        "conferencia_nutricional": {
+            nome: round(float(v), 4)
+            for nome, v in zip(matriz.linhas, composicao)
+            if nome != CUSTO_ROW_NAME
+        },
+        "solver": solucao.solver,
+        "tempo_solver": round(solucao.tempo, 6),
+    }
+
+
+# ==============================================================
+# DIAGNÓSTICO DE INVIABILIDADE (relaxação elástica)
+# ==============================================================
+
+def montar_lp_elastico(matriz, restricoes, metas):
+    """Cada limite do usuário vira linha com folga e_k >= 0; minimiza Σ e_k.
+
+    Físico (não relaxado): 0 <= x_j <= 100 e Σ x_j = 100.
+    """
+    base = montar_lp(matriz, {}, metas)
+    n = len(matriz.colunas)
+
+    linhas, rhs, nomes = [base.A_ub], [base.b_ub], [("nutriente", nutr, lado) for nutr, lado in base.linhas_ub]
+    for mp, (min_val, max_val) in restricoes.items():
+        j = matriz.coluna(mp)
+        if j is None:
+            continue
+        for valor, sinal, lado in ((min_val, -1.0, "min"), (max_val, 1.0, "max")):
+            if valor is None:
+                continue
+            linha = np.zeros((1, n))
+            linha[0, j] = sinal
+            linhas.append(linha)
+            rhs.append(np.array([sinal * float(valor)]))
+            nomes.append(("materia_prima", mp, lado))
+
+    A_soft = np.vstack(linhas)
+    m = A_soft.shape[0]
+    # Custo com peso ínfimo: entre as soluções de violação mínima fica a mais barata
+    escala = np.abs(base.c).max() if n and np.abs(base.c).max() > 0 else 1.0
+    lp = ProblemaLP(
+        c=np.concatenate([1e-6 * base.c / escala, np.ones(m)]),
+        A_ub=np.hstack([A_soft, -np.eye(m)]),
+        b_ub=np.concatenate(rhs),
+        A_eq=np.hstack([base.A_eq, np.zeros((1, m))]),
+        b_eq=base.b_eq,
+        bounds=np.vstack([base.bounds, np.column_stack([np.zeros(m), np.full(m, np.inf)])]),
+        linhas_ub=nomes,
+    )
+    return lp
+
+
+# Filtro de remoção do conflito: limite de linhas do certificado e orçamento de tempo (s).
+# Lidos do ambiente aqui (e não em main) para valerem também nos processos de jobs e lotes
+MAX_FILTRO_CONFLITO = int(os.getenv("DIAGNOSTICO_MAX_LINHAS", 200))
+TEMPO_FILTRO_CONFLITO = float(os.getenv("DIAGNOSTICO_TEMPO", 2.0))
+
+
+def _subconjunto_inviavel(lp, n, linhas, solver):
+    # Fase 1 só com as linhas escolhidas: inviável se a violação mínima for positiva
+    sub = ProblemaLP(
+        c=np.concatenate([np.zeros(n), np.ones(len(linhas))]),
+        A_ub=np.hstack([lp.A_ub[linhas, :n], -np.eye(len(linhas))]),
+        b_ub=lp.b_ub[linhas],
+        A_eq=np.hstack([lp.A_eq[:, :n], np.zeros((1, len(linhas)))]),
+        b_eq=lp.b_eq,
+        bounds=np.vstack([lp.bounds[:n], np.column_stack([np.zeros(len(linhas)), np.full(len(linhas), np.inf)])]),
+        linhas_ub=[],
+    )
+    solucao = resolver_lp(sub, solver)
+    return solucao.status == "Optimal" and solucao.x[n:].sum() > 1e-7
+
+
+def _filtrar_conflito(lp, n, suporte, solver, tempo_limite):
+    """Filtro de remoção sobre o suporte do certificado, na ordem dada (menor |dual| primeiro).
+
+    Retorna (conflito, minimo): estourado o tempo, o conjunto ainda é inviável, mas pode não
+    ser mínimo.
+    """
+    fim = time.perf_counter() + tempo_limite
+    conflito = list(suporte)
+    for k in list(suporte):
+        if time.perf_counter() > fim:
+            return conflito, False
+        restante = [r for r in conflito if r != k]
+        if restante and _subconjunto_inviavel(lp, n, restante, solver):
+            conflito = restante
+    return conflito, True
+
+
+@metricas.etapa("diagnostico")
+def diagnosticar_inviabilidade(matriz, restricoes, metas, solver=None, max_linhas=None, tempo_limite=None):
+    max_linhas = MAX_FILTRO_CONFLITO if max_linhas is None else max_linhas
+    tempo_limite = TEMPO_FILTRO_CONFLITO if tempo_limite is None else tempo_limite
+    lp = montar_lp_elastico(matriz, restricoes or {}, metas or {})
+    n = len(matriz.colunas)
+    solucao = resolver_lp(lp, solver)
+    if solucao.status != "Optimal":
+        return {"status": solucao.status}
+
+    folgas = solucao.x[n:]
+    duais = solucao.duais_ub if solucao.duais_ub is not None else np.zeros(len(folgas))
+
+    def descrever(k):
+        tipo, nome, lado = lp.linhas_ub[k]
+        valor = -lp.b_ub[k] if lado == "min" else lp.b_ub[k]
+        return {
+            "tipo": tipo,
+            "nome": nome,
+            "limite": lado,
+            "valor": round(float(valor), 6),
+            "violacao": round(float(folgas[k]), 6),
+        }
+
+    # Linhas com dual não nulo formam o certificado de inviabilidade (Farkas):
+    # juntas (com 0 <= x <= 100 e Σx = 100) não podem ser satisfeitas. O filtro tenta remover
+    # primeiro as de menor peso no certificado, mantendo as que mais pesam no conflito
+    suporte = sorted(np.flatnonzero(np.abs(duais) > 1e-9), key=lambda k: abs(duais[k]))
+    minimo = False
+    if len(suporte) <= max_linhas:
+        suporte, minimo = _filtrar_conflito(lp, n, suporte, solver, tempo_limite)
+    suporte = sorted(suporte)
+    conflito = [descrever(k) for k in suporte]
+    violacoes = [descrever(k) for k in np.flatnonzero(folgas > 1e-7)]
+
+    relaxada = montar_resultado(matriz, SolucaoLP("Optimal", solucao.x[:n], solucao.solver, solucao.tempo))
+    return {
+        "conflito": conflito,
+        "conflito_minimo": minimo,
+        "violacao_total": round(float(folgas.sum()), 6),
+        "violacoes": violacoes,
+        "solucao_relaxada": relaxada,
+    }
+
+
+def _com_diagnostico(resultado, matriz, restricoes, metas, solver):
+    if resultado["status"] == "Infeasible":
+        resultado["diagnostico"] = diagnosticar_inviabilidade(matriz, restricoes, metas, solver)
+    return resultado
+
+
+def otimizar_formula_matricial(materias_primas, restricoes, metas, solver=None):
+    matriz = materias_primas
+    if not isinstance(matriz, MatrizNutricional):
+        matriz = MatrizNutricional.de_dataframe(materias_primas)
+
+    lp = montar_lp(matriz, restricoes or {}, metas or {})
+    solucao = resolver_lp(lp, solver)
+    return _com_diagnostico(montar_resultado(matriz, solucao), matriz, restricoes, metas, solver)
+
+
+# ==============================================================
+# SENSIBILIDADE E VARREDURA PARAMÉTRICA DE PREÇO
+# ==============================================================
+
+@metricas.etapa("sensibilidade")
+def montar_sensibilidade(matriz, lp, solucao):
+    if solucao.duais_ub is None or solucao.custos_reduzidos is None:
+        return None
+
+    # Preço-sombra: variação do custo da fórmula por unidade no limite da meta.
+    # Nas linhas "min" o RHS é -min, por isso o sinal é invertido.
+    precos_sombra = {}
+    for (nutr, lado), dual in zip(lp.linhas_ub, solucao.duais_ub):
+        precos_sombra.setdefault(nutr, {})[lado] = round(float(-dual if lado == "min" else dual), 6) + 0.0
+
+    # Custo reduzido em unidades de preço (c = preço/100): quanto o preço da MP
+    # precisa cair para ela entrar (ou subir para sair) da fórmula
+    custos_reduzidos = np.round(solucao.custos_reduzidos * 100, 6) + 0.0
+
+    return {
+        "precos_sombra": precos_sombra,
+        "custos_reduzidos": dict(zip(matriz.colunas, custos_reduzidos.tolist())),
+    }
+
+
+def analisar_sensibilidade(materias_primas, restricoes, metas, solver=None):
+    matriz = materias_primas
+    if not isinstance(matriz, MatrizNutricional):
+        matriz = MatrizNutricional.de_dataframe(materias_primas)
+
+    lp = montar_lp(matriz, restricoes or {}, metas or {})
+    solucao = resolver_lp(lp, solver)
+    resultado = montar_resultado(matriz, solucao)
+    resultado["sensibilidade"] = montar_sensibilidade(matriz, lp, solucao)
+    return _com_diagnostico(resultado, matriz, restricoes, metas, solver)
+
+
+def _highs_modelo(c, col_lo, col_hi, A, row_lo, row_hi):
+    # Modelo highspy a partir de arrays densos; linhas sem limite usam ±kHighsInf
+    inf = highspy.kHighsInf
+    linhas, colunas = np.nonzero(A)
+    inicios = np.searchsorted(linhas, np.arange(A.shape[0])).astype(np.int32)
+
+    h = highspy.Highs()
+    h.setOptionValue("output_flag", False)
+    h.addCols(
+        len(c), c, col_lo, col_hi,
+        0, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0),
+    )
+    h.addRows(
+        A.shape[0],
+        np.nan_to_num(row_lo, neginf=-inf, posinf=inf),
+        np.nan_to_num(row_hi, neginf=-inf, posinf=inf),
+        len(linhas), inicios, colunas.astype(np.int32), A[linhas, colunas],
+    )
+    return h
+
+
+def _highs_de_lp(lp):
+    # Linhas do modelo: primeiro A_eq, depois A_ub (mesma ordem de b_ub)
+    return _highs_modelo(
+        lp.c, lp.bounds[:, 0], lp.bounds[:, 1],
+        np.vstack([lp.A_eq, lp.A_ub]),
+        np.concatenate([lp.b_eq, np.full(len(lp.b_ub), -np.inf)]),
+        np.concatenate([lp.b_eq, lp.b_ub]),
+    )
+
+
+def _highs_resolver(h, n):
+    # Re-solves sobre um modelo persistente (partem da base anterior)
+    with metricas.medir("solver_highs_incremental"):
+        h.run()
+    status = h.getModelStatus()
+    otimo = status == highspy.HighsModelStatus.kOptimal
+    x = np.asarray(h.getSolution().col_value, dtype=float) if otimo else np.zeros(n)
+    if otimo:
+        nome = "Optimal"
+    elif status == highspy.HighsModelStatus.kInfeasible:
+        nome = "Infeasible"
+    elif status == highspy.HighsModelStatus.kUnbounded:
+        nome = "Unbounded"
+    else:
+        nome = "Not Solved"
+    iteracoes = h.getInfo().simplex_iteration_count
+    metricas.observar(
+        "otimizador_solver_iteracoes", iteracoes, "Iterações simplex por solve.",
+        metricas.BUCKETS_ITERACOES, solver="highs_incremental"
+    )
+    return SolucaoLP(nome, x, solver="highs", iteracoes=iteracoes)
+
+
+def _resolvedor_por_custo(lp, solver):
+    # Com highspy o mesmo modelo é mantido e só o vetor de custos muda:
+    # cada re-solve parte da base ótima anterior (warm start)
+    if highspy is not None and (solver or SOLVER_PADRAO).lower() == "highs":
+        n = len(lp.c)
+        h = _highs_de_lp(lp)
+        todas = np.arange(n, dtype=np.int32)
+
+        def resolver(c):
+            h.changeColsCost(n, todas, c)
+            return _highs_resolver(h, n)
+
+        return resolver
+
+    return lambda c: resolver_lp(replace(lp, c=c), solver)
+
+
+def varrer_preco(materias_primas, restricoes, metas, mp, precos, solver=None):
+    matriz = materias_primas
+    if not isinstance(matriz, MatrizNutricional):
+        matriz = MatrizNutricional.de_dataframe(materias_primas)
+
+    j = matriz.coluna(mp)
+    if j is None:
+        raise ValueError(f"MP '{mp}' não encontrada na matriz.")
+
+    inicio = time.perf_counter()
+    lp = montar_lp(matriz, restricoes or {}, metas or {})
+    precos = np.unique(np.asarray(precos, dtype=float))
+    resolver = _resolvedor_por_custo(lp, solver)
+
+    def custos(preco):
+        c = lp.c.copy()
+        c[j] = preco / 100
+        return c
+
+    solucoes = [None] * len(precos)
+    resolucoes = 0
+
+    def resolver_ponto(k):
+        nonlocal resolucoes
+        if solucoes[k] is None:
+            solucoes[k] = resolver(custos(precos[k]))
+            resolucoes += 1
+
+    # O custo ótimo é côncavo no preço: se a solução de um extremo também é ótima
+    # no outro, ela é ótima em todo o intervalo e os pontos internos não precisam de solve
+    def preencher(a, b):
+        if b - a < 2:
+            return
+        sa, sb = solucoes[a], solucoes[b]
+        if sa.status == "Optimal" and sb.status == "Optimal":
+            c_b = custos(precos[b])
+            if c_b @ sa.x <= c_b @ sb.x + 1e-9 * max(1.0, abs(c_b @ sb.x)):
+                for k in range(a + 1, b):
+                    solucoes[k] = sa
+                return
+        m = (a + b) // 2
+        resolver_ponto(m)
+        preencher(a, m)
+        preencher(m, b)
+
+    if len(precos):
+        resolver_ponto(0)
+        resolver_ponto(len(precos) - 1)
+        preencher(0, len(precos) - 1)
+
+    pontos = []
+    for preco, sol in zip(precos, solucoes):
+        pontos.append({
+            "preco": float(preco),
+            "status": sol.status,
+            "inclusao": round(float(sol.x[j]), 4),
+            "custo_total": round(float(custos(preco) @ sol.x), 4),
+        })
+
+    return {
+        "materia_prima": mp,
+        "pontos": pontos,
+        "resolucoes": resolucoes,
+        "tempo": round(time.perf_counter() - inicio, 6),
+    }
+
+
+# ==============================================================
+# FRONTEIRA DE PARETO (custo × nutrientes, ε-restrição)
+# ==============================================================
+
+def _objetivos_pareto(matriz, objetivos):
+    # (linha na matriz, sinal, nome, config): sinal -1 = maximizar, +1 = minimizar
+    if not 1 <= len(objetivos) <= 2:
+        raise ValueError("Informe um ou dois nutrientes objetivo.")
+    resultado = []
+    for obj in objetivos:
+        nome = obj["nutriente"]
+        i = matriz.linha(nome)
+        if i is None:
+            raise ValueError(f"Nutriente '{nome}' não encontrado na matriz.")
+        sentido = obj.get("sentido", "max")
+        if sentido not in ("max", "min"):
+            raise ValueError("sentido deve ser 'max' ou 'min'.")
+        resultado.append((i, -1.0 if sentido == "max" else 1.0, nome, obj))
+    return resultado
+
+
+def _grade_epsilon(faixas):
+    # Ordem em serpentina: pontos vizinhos na lista também são vizinhos na grade,
+    # então cada re-solve parte de uma base próxima
+    if len(faixas) == 1:
+        return [(e,) for e in faixas[0]]
+    grade = []
+    for k, e1 in enumerate(faixas[0]):
+        segunda = faixas[1] if k % 2 == 0 else faixas[1][::-1]
+        grade.extend((e1, e2) for e2 in segunda)
+    return grade
+
+
+def _resolvedor_por_epsilon(lp, m, solver):
+    # As últimas m linhas de A_ub são as ε-restrições; só o lado direito delas muda
+    if highspy is not None and (solver or SOLVER_PADRAO).lower() == "highs":
+        n = len(lp.c)
+        h = _highs_de_lp(lp)
+        linhas = np.arange(h.getNumRow() - m, h.getNumRow(), dtype=np.int32)
+        inferiores = np.full(m, -highspy.kHighsInf)
+
+        def resolver(rhs):
+            h.changeRowsBounds(m, linhas, inferiores, np.asarray(rhs, dtype=float))
+            return _highs_resolver(h, n)
+
+        return resolver
+
+    def resolver(rhs):
+        b_ub = lp.b_ub.copy()
+        b_ub[len(b_ub) - m:] = rhs
+        return resolver_lp(replace(lp, b_ub=b_ub), solver)
+
+    return resolver
+
+
+def fronteira_pareto(materias_primas, restricoes, metas, objetivos, pontos=20, solver=None, workers=4):
+    matriz = materias_primas
+    if not isinstance(matriz, MatrizNutricional):
+        matriz = MatrizNutricional.de_dataframe(materias_primas)
+
+    inicio = time.perf_counter()
+    base = montar_lp(matriz, restricoes or {}, metas or {})
+    objs = _objetivos_pareto(matriz, objetivos)
+    A_obj = np.vstack([sinal * matriz.valores[i] / 100 for i, sinal, _, _ in objs])
+
+    # Âncoras: o ótimo de custo e o melhor valor possível de cada nutriente
+    ancora = resolver_lp(base, solver)
+    if ancora.status != "Optimal":
+        resultado = {"status": ancora.status, "objetivos": [nome for _, _, nome, _ in objs], "pontos": []}
+        return _com_diagnostico(resultado, matriz, restricoes, metas, solver)
+
+    faixas = []
+    for k, (_, sinal, _, obj) in enumerate(objs):
+        melhor = resolver_lp(replace(base, c=A_obj[k]), solver)
+        de = obj.get("inicio", sinal * float(A_obj[k] @ ancora.x))
+        ate = obj.get("fim", sinal * float(A_obj[k] @ melhor.x))
+        faixas.append(np.linspace(float(de), float(ate), int(obj.get("pontos", pontos))))
+    grade = _grade_epsilon(faixas)
+
+    lp = replace(base, A_ub=np.vstack([base.A_ub, A_obj]), b_ub=np.concatenate([base.b_ub, np.zeros(len(objs))]))
+    sinais = np.array([sinal for _, sinal, _, _ in objs])
+
+    # Blocos contíguos da grade em paralelo; dentro de cada bloco o modelo é reaproveitado
+    workers = max(1, min(int(workers), len(grade)))
+    blocos = np.array_split(np.arange(len(grade)), workers)
+
+    def resolver_bloco(indices):
+        resolver = _resolvedor_por_epsilon(lp, len(objs), solver)
+        return [resolver(sinais * np.asarray(grade[k])) for k in indices]
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            solucoes = [sol for bloco in pool.map(resolver_bloco, blocos) for sol in bloco]
+    else:
+        solucoes = resolver_bloco(blocos[0])
+
+    # Custos e nutrientes objetivo de todos os pontos em um único produto
+    viaveis = np.array([sol.status == "Optimal" for sol in solucoes])
+    X = np.vstack([sol.x for sol in solucoes])
+    X[~viaveis] = 0.0
+    custos = X @ matriz.custos / 100
+    valores = X @ (A_obj * sinais[:, None]).T
+
+    # Dominância (minimizando custo e sinal·nutriente) entre os pontos viáveis
+    F = np.column_stack([custos, valores * sinais])
+    tol = 1e-6 * np.maximum(1.0, np.abs(F))
+    melhor_ou_igual = (F[None, :, :] <= F[:, None, :] + tol[:, None, :]).all(axis=2)
+    estritamente = (F[None, :, :] < F[:, None, :] - tol[:, None, :]).any(axis=2)
+    dominado = (melhor_ou_igual & estritamente & viaveis[None, :]).any(axis=1)
+
+    nomes = [nome for _, _, nome, _ in objs]
+    resultado_pontos = []
+    for k, sol in enumerate(solucoes):
+        ponto = {
+            "epsilon": {nome: round(float(e), 6) for nome, e in zip(nomes, grade[k])},
+            "status": sol.status,
+        }
+        if viaveis[k]:
+            inclusoes = np.round(X[k], 4)
+            ponto.update({
+                "custo_total": round(float(custos[k]), 4),
+                "nutrientes": {nome: round(float(v), 4) for nome, v in zip(nomes, valores[k])},
+                "inclusoes": {matriz.colunas[j]: float(inclusoes[j]) for j in np.flatnonzero(inclusoes)},
+                "dominado": bool(dominado[k]),
+            })
+        resultado_pontos.append(ponto)
+
+    return {
+        "status": "Optimal",
+        "objetivos": nomes,
+        "pontos": resultado_pontos,
+        "resolucoes": len(grade) + len(objs) + 1,
+        "solver": ancora.solver,
+        "tempo": round(time.perf_counter() - inicio, 6),
+    }
+
+
+# ==============================================================
+# MODO ROBUSTO (variabilidade dos nutrientes entre lotes)
+# ==============================================================
+
+MAX_CORTES = 50
+MAX_CENARIOS = 5000
+
+
+def _valor_lote(valor):
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return float(valor)
+    return np.nan
+
+
+def montar_variabilidade(matriz, linhas, variabilidade):
+    """Desvios e lotes históricos restritos às linhas da matriz em `linhas`.
+
+    variabilidade: {mp: {"desvios": {nutriente: dp}, "amostras": [{nutriente: valor}, ...]}}.
+    Retorna (desvios (len(linhas), n), {coluna: lotes (k, len(linhas))}); nutrientes ausentes
+    de um lote assumem a média da matriz e, havendo 2+ lotes, o desvio vem das amostras.
+    """
+    nomes = [matriz.linhas[i] for i in linhas]
+    medias = matriz.valores[linhas]
+    desvios = np.zeros((len(linhas), len(matriz.colunas)))
+    amostras = {}
+
+    for mp, dados in (variabilidade or {}).items():
+        j = matriz.coluna(mp)
+        if j is None or not dados:
+            continue
+        dp = dados.get("desvios") or {}
+        desvios[:, j] = [_valor_lote(dp.get(nome, 0.0)) for nome in nomes]
+
+        lotes = dados.get("amostras") or []
+        if lotes:
+            L = np.array([[_valor_lote(lote.get(nome)) for nome in nomes] for lote in lotes])
+            L = np.where(np.isnan(L), medias[:, j], L)
+            amostras[j] = L
+            if len(L) > 1:
+                desvios[:, j] = L.std(axis=0, ddof=1)
+
+    return np.nan_to_num(desvios), amostras
+
+
+def gerar_cenarios(matriz, linhas, desvios, amostras, quantidade, rng):
+    # (cenários, linhas, MPs): MPs com histórico sorteiam um lote inteiro (mantém a correlação
+    # entre nutrientes do mesmo lote); as demais recebem ruído normal com o desvio informado
+    medias = matriz.valores[linhas]
+    V = medias + rng.standard_normal((quantidade, *medias.shape)) * desvios
+    for j, lotes in amostras.items():
+        V[:, :, j] = lotes[rng.integers(len(lotes), size=quantidade)]
+    return np.maximum(V, 0.0)
+
+
+def _resolvedor_com_cortes(lp, solver):
+    # Retorna (resolver(), adicionar(A, b)); com highspy as linhas novas entram no mesmo modelo
+    n = len(lp.c)
+    if highspy is not None and (solver or SOLVER_PADRAO).lower() == "highs":
+        h = _highs_de_lp(lp)
+
+        def adicionar(A, b):
+            linhas, colunas = np.nonzero(A)
+            inicios = np.searchsorted(linhas, np.arange(A.shape[0])).astype(np.int32)
+            h.addRows(
+                A.shape[0], np.full(len(b), -highspy.kHighsInf), b,
+                len(linhas), inicios, colunas.astype(np.int32), A[linhas, colunas],
+            )
+
+        return (lambda: _highs_resolver(h, n)), adicionar
+
+    blocos_A, blocos_b = [lp.A_ub], [lp.b_ub]
+
+    def adicionar(A, b):
+        blocos_A.append(A)
+        blocos_b.append(b)
+
+    def resolver():
+        return resolver_lp(replace(lp, A_ub=np.vstack(blocos_A), b_ub=np.concatenate(blocos_b)), solver)
+
+    return resolver, adicionar
+
+
+def _probabilidades(nomes_linhas, probabilidades):
+    resultado = {}
+    for (nutr, lado), p in zip(nomes_linhas, probabilidades):
+        resultado.setdefault(nutr, {})[lado] = round(float(p), 4)
+    return resultado
+
+
+def _resolver_chance(lp, S, nivel, solver):
+    """Restrições de chance individuais com nutrientes normais independentes.
+
+    P(linha_k · x <= b_k) >= nivel  ⇔  μ_k·x + z·||σ_k ∘ x|| <= b_k (cônica). O termo da norma
+    é aproximado por cortes tangentes (Kelley), que só entram para as linhas violadas.
+    """
+    z = NormalDist().inv_cdf(nivel)
+    resolver, adicionar = _resolvedor_com_cortes(lp, solver)
+    media = solucao = resolver()
+    iteracoes, convergiu = 1, False
+
+    while solucao.status == "Optimal" and iteracoes <= MAX_CORTES:
+        x = solucao.x
+        norma = np.sqrt(((S * x) ** 2).sum(axis=1))
+        violacao = lp.A_ub @ x + z * norma - lp.b_ub
+        violadas = violacao > 1e-7 * np.maximum(1.0, np.abs(lp.b_ub))
+        if not violadas.any():
+            convergiu = True
+            break
+        A = lp.A_ub[violadas] + z * S[violadas] ** 2 * x / norma[violadas, None]
+        adicionar(A, lp.b_ub[violadas])
+        solucao = resolver()
+        iteracoes += 1
+
+    def probabilidades(x):
+        norma = np.sqrt(((S * x) ** 2).sum(axis=1))
+        folga = lp.b_ub - lp.A_ub @ x
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p = np.array([NormalDist().cdf(v) for v in np.where(norma > 0, folga / norma, 0.0)])
+        # Sem variabilidade a linha é determinística: mesma tolerância relativa dos cortes
+        return np.where(norma > 0, p, (folga >= -1e-7 * np.maximum(1.0, np.abs(lp.b_ub))).astype(float))
+
+    return media, solucao, probabilidades, {"nivel": nivel, "iteracoes": iteracoes, "convergiu": convergiu}
+
+
+def _resolver_cenarios(lp, cenarios, validacao, solver):
+    """Cada meta precisa valer em todos os cenários (abordagem por cenários)."""
+    resolver, adicionar = _resolvedor_com_cortes(lp, solver)
+    media = resolver()
+
+    # (cenários, linhas_ub, MPs) → (cenários · linhas_ub) linhas; linhas repetidas
+    # (nutrientes sem variabilidade) entram uma única vez
+    A = cenarios.reshape(-1, cenarios.shape[2])
+    b = np.tile(lp.b_ub, len(cenarios))
+    unicas = np.unique(np.column_stack([A, b]), axis=0)
+    solucao = media
+    if len(unicas):
+        adicionar(unicas[:, :-1], unicas[:, -1])
+        solucao = resolver()
+
+    def probabilidades(x):
+        # Estimativa fora da amostra: cenários novos, não usados no modelo
+        return ((validacao @ x) <= lp.b_ub + 1e-7 * np.maximum(1.0, np.abs(lp.b_ub))).mean(axis=0)
+
+    return media, solucao, probabilidades, {"cenarios": len(cenarios), "linhas": int(len(unicas))}
+
+
+def otimizar_formula_robusta(materias_primas, restricoes, metas, variabilidade, opcoes, solver=None):
+    """opcoes: {"modo": "chance" | "cenarios", "nivel": 0.95, "cenarios": 200, "semente": 0}."""
+    matriz = materias_primas
+    if not isinstance(matriz, MatrizNutricional):
+        matriz = MatrizNutricional.de_dataframe(materias_primas)
+
+    lp = montar_lp(matriz, restricoes or {}, metas or {})
+    # min e max do mesmo nutriente compartilham a mesma realização
+    linhas, inversa = np.unique(
+        np.array([matriz.linha(nutr) for nutr, _ in lp.linhas_ub], dtype=int), return_inverse=True
+    )
+    sinais = np.array([-1.0 if lado == "min" else 1.0 for _, lado in lp.linhas_ub])
+    desvios, amostras = montar_variabilidade(matriz, linhas, variabilidade)
+
+    modo = opcoes.get("modo", "chance")
+    if modo == "chance":
+        nivel = float(opcoes.get("nivel", 0.95))
+        if not 0.5 <= nivel < 1:
+            raise ValueError("nivel deve estar em [0.5, 1).")
+        media, solucao, probabilidades, info = _resolver_chance(lp, desvios[inversa] / 100, nivel, solver)
+    elif modo == "cenarios":
+        quantidade = int(opcoes.get("cenarios", 200))
+        if not 1 <= quantidade <= MAX_CENARIOS:
+            raise ValueError(f"cenarios deve estar entre 1 e {MAX_CENARIOS}.")
+        rng = np.random.default_rng(opcoes.get("semente"))
+
+        def sortear():
+            V = gerar_cenarios(matriz, linhas, desvios, amostras, quantidade, rng)
+            return sinais[:, None] * V[:, inversa, :] / 100
+
+        cenarios, validacao = sortear(), sortear()
+        media, solucao, probabilidades, info = _resolver_cenarios(lp, cenarios, validacao, solver)
+    else:
+        raise ValueError("modo deve ser 'chance' ou 'cenarios'.")
+
+    resultado = montar_resultado(matriz, solucao)
+    if media.status != "Optimal":
+        return _com_diagnostico(resultado, matriz, restricoes, metas, solver)
+
+    custo_medio = float(matriz.custos @ media.x / 100)
+    resultado["robusto"] = {
+        "modo": modo,
+        **info,
+        "custo_media": round(custo_medio, 4),
+        "acrescimo_custo": round(resultado["custo_total"] - custo_medio, 4) if solucao.status == "Optimal" else None,
+        "probabilidade_atendimento": _probabilidades(lp.linhas_ub, probabilidades(solucao.x))
+        if solucao.status == "Optimal" else {},
+        "probabilidade_atendimento_media": _probabilidades(lp.linhas_ub, probabilidades(media.x)),
+    }
+    return resultado
+
+
+# ==============================================================
+# CONSULTA DE FÓRMULAS (várias fórmulas em um único produto)
+# ==============================================================
+
+@metricas.etapa("avaliar_formulacoes")
+def avaliar_formulacoes(matriz, formulacoes, aliases=None):
+    indice = matriz.indice_colunas(aliases)
+    P = np.zeros((len(matriz.colunas), len(formulacoes)))
+    usadas, resolvidos, nao_encontradas = [], [], []
+
+    for k, formulacao in enumerate(formulacoes):
+        ordem, nomes_resolvidos, faltando = {}, {}, []
+        for mp, valor in formulacao.items():
+            try:
+                valor_float = float(valor)
+            except Exception:
+                continue
+            if valor_float <= 0:
+                continue
+            j, tipo = indice.resolver(mp)
+            if j is None:
+                faltando.append(mp)
+                continue
+            if tipo != "exato":
+                nomes_resolvidos[mp] = matriz.colunas[j]
+            P[j, k] += valor_float
+            ordem.setdefault(j, None)
+        usadas.append(list(ordem))
+        resolvidos.append(nomes_resolvidos)
+        nao_encontradas.append(faltando)
+
+    # Proporções normalizadas para somar 1 em cada fórmula
+    totais = P.sum(axis=0)
+    P = np.divide(P, totais, out=np.zeros_like(P), where=totais > 0)
+
+    composicao = matriz.valores @ P
+    i_custo = matriz.linha(CUSTO_ROW_NAME)
+    nutrientes = [(i, nome) for i, nome in enumerate(matriz.linhas) if i != i_custo]
+
+    resultados = []
+    for k in range(len(formulacoes)):
+        if totais[k] <= 0:
+            resultados.append({"erro": "Nenhuma MP válida foi informada."})
+            continue
+        resultados.append({
+            "status": "OK",
+            "nutrientes": [{"Nutriente": nome, "Valor Obtido": float(composicao[i, k])} for i, nome in nutrientes],
+            "custos": [
+                {"Matéria-Prima": matriz.colunas[j], "Custo": float(matriz.valores[i_custo, j] * P[j, k])}
+                for j in usadas[k]
+            ],
+            "custo_total": float(composicao[i_custo, k]),
+            "nomes_resolvidos": resolvidos[k],
+            "nao_encontradas": nao_encontradas[k],
+        })
+    return resultados
+
+
+# ==============================================================
+# RECÁLCULO DAS FÓRMULAS SALVAS (matriz de inclusões esparsa)
+# ==============================================================
+
+TOLERANCIA_METAS = 1e-6
+
+
+def preparar_formula(matriz, formulacao, aliases=None):
+    # Fórmula a salvar: nomes canônicos da matriz, inclusões em % (somam 100) e custo de referência
+    indice = matriz.indice_colunas(aliases)
+    inclusoes, nao_encontradas = {}, []
+    for mp, valor in formulacao.items():
+        try:
+            valor_float = float(valor)
+        except Exception:
+            continue
+        if valor_float <= 0:
+            continue
+        j, _ = indice.resolver(mp)
+        if j is None:
+            nao_encontradas.append(mp)
+            continue
+        inclusoes[matriz.colunas[j]] = inclusoes.get(matriz.colunas[j], 0.0) + valor_float
+
+    total = sum(inclusoes.values())
+    if total <= 0:
+        raise ValueError("Nenhuma MP válida foi informada.")
+    mps = list(inclusoes)
+    valores = np.array(list(inclusoes.values())) * 100 / total
+    custo = float(matriz.custos[[matriz.coluna(mp) for mp in mps]] @ valores / 100)
+    return {"mps": mps, "inclusoes": valores.tolist(), "custo_referencia": custo, "nao_encontradas": nao_encontradas}
+
+
+def _matriz_inclusoes(matriz, formulas):
+    # Coluna k = proporções da fórmula k (somam 1) nas linhas das MPs da matriz atual.
+    # Os nomes salvos já são os canônicos: só casamento exato (uma MP removida não é trocada
+    # por outra de nome parecido, fica em "nao_encontradas")
+    tamanhos = np.array([len(f.get("mps", [])) for f in formulas], dtype=int)
+    nomes = np.array([str(mp) for f in formulas for mp in f.get("mps", [])], dtype=object)
+    valores = np.array([float(v) for f in formulas for v in f.get("inclusoes", [])], dtype=float)
+    if len(valores) != len(nomes):
+        raise ValueError("Cada fórmula deve ter o mesmo número de 'mps' e 'inclusoes'.")
+    colunas = np.repeat(np.arange(len(formulas)), tamanhos)
+
+    # Cada nome distinto é resolvido uma única vez, não uma vez por fórmula
+    unicos, inverso = np.unique(nomes, return_inverse=True) if len(nomes) else (nomes, np.zeros(0, dtype=int))
+    j_unicos = np.array([-1 if j is None else j for j in map(matriz.coluna, unicos)], dtype=int)
+    linhas = j_unicos[inverso]
+
+    nao_encontradas = [[] for _ in formulas]
+    for posicao in np.flatnonzero(linhas < 0):
+        nao_encontradas[colunas[posicao]].append(nomes[posicao])
+
+    validos = (linhas >= 0) & (valores > 0)
+    linhas, colunas, valores = linhas[validos], colunas[validos], valores[validos]
+    totais = np.bincount(colunas, weights=valores, minlength=len(formulas))
+    P = _matriz_coo(linhas, colunas, valores / totais[colunas], (len(matriz.colunas), len(formulas)))
+    return P, totais, nao_encontradas
+
+
+def _limites_metas(matriz, formulas):
+    # Todas as metas de todas as fórmulas como vetores (fórmula, linha, mínimo, máximo)
+    k_meta, i_meta, minimos, maximos = [], [], [], []
+    for k, formula in enumerate(formulas):
+        for nutr, (min_val, max_val) in (formula.get("metas") or {}).items():
+            i = matriz.linha(nutr)
+            if i is None or (min_val is None and max_val is None):
+                continue
+            k_meta.append(k)
+            i_meta.append(i)
+            minimos.append(-np.inf if min_val is None else float(min_val))
+            maximos.append(np.inf if max_val is None else float(max_val))
+    return (
+        np.array(k_meta, dtype=int), np.array(i_meta, dtype=int),
+        np.array(minimos, dtype=float), np.array(maximos, dtype=float),
+    )
+
+
+@metricas.etapa("recalcular_formulas")
+def recalcular_formulas(matriz, formulas, limite_custo=0.05, perfis=False):
+    """Custo e perfil nutricional de todas as fórmulas em um único produto esparso.
+
+    formulas: [{"id", "nome"?, "mps": [...], "inclusoes": [...], "metas"?, "custo_referencia"?}].
+    Sinaliza as fórmulas cujo custo variou mais que limite_custo (fração do custo de referência),
+    que agora violam as próprias metas ou que usam MPs ausentes da matriz.
+    """
+    P, totais, nao_encontradas = _matriz_inclusoes(matriz, formulas)
+    composicao = np.asarray(matriz.valores @ P)  # nutrientes × fórmulas
+    i_custo = matriz.linha(CUSTO_ROW_NAME)
+    custos = composicao[i_custo]
+
+    referencias = np.array(
+        [np.nan if f.get("custo_referencia") is None else float(f["custo_referencia"]) for f in formulas],
+        dtype=float,
+    )
+    variacoes = np.divide(
+        custos - referencias, referencias,
+        out=np.full(len(formulas), np.nan), where=np.nan_to_num(referencias) > 0,
+    )
+    mudou_custo = (np.abs(np.nan_to_num(variacoes)) > limite_custo) & (totais > 0)
+
+    k_meta, i_meta, minimos, maximos = _limites_metas(matriz, formulas)
+    obtidos = composicao[i_meta, k_meta]
+    folga = TOLERANCIA_METAS * np.maximum(1.0, np.abs(np.where(np.isfinite(minimos), minimos, maximos)))
+    violadas = np.flatnonzero((obtidos < minimos - folga) | (obtidos > maximos + folga))
+    violacoes = [[] for _ in formulas]
+    for m in violadas:
+        violacoes[k_meta[m]].append({
+            "nutriente": matriz.linhas[i_meta[m]],
+            "valor": float(obtidos[m]),
+            "min": None if np.isinf(minimos[m]) else float(minimos[m]),
+            "max": None if np.isinf(maximos[m]) else float(maximos[m]),
+        })
+
+    resultados = []
+    for k, formula in enumerate(formulas):
+        motivos = []
+        if totais[k] <= 0:
+            motivos.append("sem_mps")
+        if mudou_custo[k]:
+            motivos.append("custo")
+        if violacoes[k]:
+            motivos.append("metas")
+        if nao_encontradas[k]:
+            motivos.append("mps_ausentes")
+
+        resultado = {
+            "id": formula.get("id", k),
+            "nome": formula.get("nome"),
+            "custo_referencia": None if np.isnan(referencias[k]) else float(referencias[k]),
+            "custo_atual": float(custos[k]) if totais[k] > 0 else None,
+            "variacao_custo": None if np.isnan(variacoes[k]) else round(float(variacoes[k]), 6),
+            "violacoes": violacoes[k],
+            "nao_encontradas": nao_encontradas[k],
+            "sinalizada": bool(motivos),
+            "motivos": motivos,
+        }
+        if perfis and totais[k] > 0:
+            resultado["nutrientes"] = {
+                nome: float(composicao[i, k]) for i, nome in enumerate(matriz.linhas) if i != i_custo
+            }
+        resultados.append(resultado)
+
+    return {
+        "total": len(formulas),
+        "sinalizadas": sum(r["sinalizada"] for r in resultados),
+        "formulas": resultados,
+    }
+
+
+# ==============================================================
+# OTIMIZAÇÃO CONJUNTA (várias fórmulas + estoque compartilhado)
+# ==============================================================
+
+def _matriz_coo(linhas, colunas, valores, forma):
+    if sparse is not None:
+        return sparse.csr_matrix((valores, (linhas, colunas)), shape=forma)
+    A = np.zeros(forma)
+    np.add.at(A, (linhas, colunas), valores)
+    return A
+
+
+def _blocos_diagonais(blocos, n):
+    # Empilha os blocos (densos, n colunas cada) em diagonal sem laço por variável
+    linhas, colunas, valores = [], [], []
+    deslocamento = 0
+    for f, bloco in enumerate(blocos):
+        r, c = np.nonzero(bloco)
+        linhas.append(r + deslocamento)
+        colunas.append(c + f * n)
+        valores.append(bloco[r, c])
+        deslocamento += bloco.shape[0]
+    return (
+        np.concatenate(linhas) if linhas else np.zeros(0, dtype=int),
+        np.concatenate(colunas) if colunas else np.zeros(0, dtype=int),
+        np.concatenate(valores) if valores else np.zeros(0),
+        deslocamento,
+    )
+
+
+@metricas.etapa("montar_lp_conjunto")
+def montar_lp_conjunto(matriz, formulas, estoques):
+    n = len(matriz.colunas)
+    lps = [montar_lp(matriz, f.get("restricoes") or {}, f.get("metas") or {}) for f in formulas]
+    toneladas = np.array([float(f.get("tonelagem", 1.0)) for f in formulas])
+
+    # Custo total = Σ tonelagem_f · custo_f (custo por unidade de massa da fórmula)
+    c = np.concatenate([t * lp.c for t, lp in zip(toneladas, lps)])
+    bounds = np.vstack([lp.bounds for lp in lps])
+
+    r, col, val, m_ub = _blocos_diagonais([lp.A_ub for lp in lps], n)
+    linhas_ub = [
+        (f"{f.get('id', k)}:{nutr}", lado)
+        for k, (f, lp) in enumerate(zip(formulas, lps))
+        for nutr, lado in lp.linhas_ub
+    ]
+    b_ub = [lp.b_ub for lp in lps]
+
+    # Estoque: Σ_f tonelagem_f · x_fj / 100 <= disponível_j
+    capados = [(matriz.coluna(mp), float(cap)) for mp, cap in (estoques or {}).items()
+               if matriz.coluna(mp) is not None and cap is not None]
+    if capados:
+        js = np.array([j for j, _ in capados])
+        f_idx = np.repeat(np.arange(len(formulas)), len(js))
+        r = np.concatenate([r, m_ub + np.tile(np.arange(len(js)), len(formulas))])
+        col = np.concatenate([col, f_idx * n + np.tile(js, len(formulas))])
+        val = np.concatenate([val, np.repeat(toneladas / 100, len(js))])
+        b_ub.append(np.array([cap for _, cap in capados]))
+        linhas_ub += [(f"estoque:{matriz.colunas[j]}", "max") for j, _ in capados]
+        m_ub += len(js)
+
+    r_eq, col_eq, val_eq, m_eq = _blocos_diagonais([lp.A_eq for lp in lps], n)
+
+    return ProblemaLP(
+        c=c,
+        A_ub=_matriz_coo(r, col, val, (m_ub, n * len(formulas))),
+        b_ub=np.concatenate(b_ub) if b_ub else np.zeros(0),
+        A_eq=_matriz_coo(r_eq, col_eq, val_eq, (m_eq, n * len(formulas))),
+        b_eq=np.concatenate([lp.b_eq for lp in lps]),
+        bounds=bounds,
+        linhas_ub=linhas_ub,
+    ), toneladas
+
+
+def otimizar_conjunto(materias_primas, formulas, estoques=None, solver=None):
+    matriz = materias_primas
+    if not isinstance(matriz, MatrizNutricional):
+        matriz = MatrizNutricional.de_dataframe(materias_primas)
+    if not formulas:
+        raise ValueError("Informe ao menos uma fórmula.")
+
+    lp, toneladas = montar_lp_conjunto(matriz, formulas, estoques)
+    solucao = resolver_lp(lp, solver)
+
+    n = len(matriz.colunas)
+    X = solucao.x.reshape(len(formulas), n)
+    resultados = []
+    for k, (f, t) in enumerate(zip(formulas, toneladas)):
+        resultado = montar_resultado(matriz, SolucaoLP(solucao.status, X[k], solucao.solver, solucao.tempo))
+        resultado.pop("solver")
+        resultado.pop("tempo_solver")
+        resultados.append({"id": f.get("id", k), "tonelagem": float(t), **resultado})
+
+    # Consumo de cada MP somando todas as fórmulas (mesma unidade da tonelagem)
+    consumo = toneladas @ np.round(X, 4) / 100
+    uso_estoque = {}
+    for mp, cap in (estoques or {}).items():
+        j = matriz.coluna(mp)
+        if j is not None and cap is not None:
+            uso_estoque[mp] = {
+                "disponivel": float(cap),
+                "consumido": round(float(consumo[j]), 4),
+                "folga": round(float(cap) - float(consumo[j]), 4),
+            }
+
+    return {
+        "status": solucao.status,
+        "custo_total": round(sum(r["custo_total"] * r["tonelagem"] for r in resultados), 4),
+        "formulas": resultados,
+        "consumo": {mp: round(float(v), 4) for mp, v in zip(matriz.colunas, consumo) if v > 0},
+        "estoques": uso_estoque,
+        "solver": solucao.solver,
+        "tempo_solver": round(solucao.tempo, 6),
+        "variaveis": int(len(lp.c)),
+        "restricoes": int(lp.A_ub.shape[0] + lp.A_eq.shape[0]),
+    }
+
+
+# ==============================================================
+# MODELO COMPILADO (estrutura fixa, re-solve após atualizações)
+# ==============================================================
+
+class ModeloCompilado:
+    """Mantém a estrutura do LP; metas, restrições e preços mudam só RHS, limites e custos."""
+
+    def __init__(self, materias_primas, restricoes=None, metas=None, solver=None):
+        matriz = materias_primas
+        if not isinstance(matriz, MatrizNutricional):
+            matriz = MatrizNutricional.de_dataframe(materias_primas)
+        # Cópia própria: preços alterados na sessão não afetam a matriz compartilhada
+        self.matriz = MatrizNutricional(list(matriz.linhas), list(matriz.colunas), matriz.valores.copy())
+        self.solver = solver
+
+        n = len(self.matriz.colunas)
+        self._i_custo = self.matriz.linha(CUSTO_ROW_NAME)
+        self._nutrientes = [i for i in range(len(self.matriz.linhas)) if i != self._i_custo]
+
+        # Uma linha por nutriente (sem limite = ±inf) + linha da soma = 100
+        self.A = np.vstack([np.ones((1, n)), self.matriz.valores[self._nutrientes] / 100])
+        self.linha_lo = np.concatenate([[100.0], np.full(len(self._nutrientes), -np.inf)])
+        self.linha_hi = np.concatenate([[100.0], np.full(len(self._nutrientes), np.inf)])
+        self.col_lo = np.zeros(n)
+        self.col_hi = np.full(n, 100.0)
+        self._pos_nutriente = {self.matriz.linhas[i]: k + 1 for k, i in enumerate(self._nutrientes)}
+
+        self._lock = threading.Lock()
+        self._highs = None
+        if highspy is not None and (solver or SOLVER_PADRAO).lower() == "highs":
+            self._highs = _highs_modelo(
+                self.matriz.custos / 100, self.col_lo, self.col_hi,
+                self.A, self.linha_lo, self.linha_hi,
+            )
+
+        self.atualizar(metas=metas, restricoes=restricoes)
+
+    @property
+    def tamanho(self):
+        return {"variaveis": int(self.A.shape[1]), "restricoes": int(self.A.shape[0])}
+
+    def atualizar(self, metas=None, restricoes=None, precos=None):
+        with self._lock:
+            for nutr, (min_val, max_val) in (metas or {}).items():
+                k = self._pos_nutriente.get(nutr)
+                if k is None:
+                    continue
+                self.linha_lo[k] = -np.inf if min_val is None else float(min_val)
+                self.linha_hi[k] = np.inf if max_val is None else float(max_val)
+                if self._highs is not None:
+                    inf = highspy.kHighsInf
+                    self._highs.changeRowBounds(
+                        k, max(self.linha_lo[k], -inf), min(self.linha_hi[k], inf)
+                    )
+
+            for mp, (min_val, max_val) in (restricoes or {}).items():
+                j = self.matriz.coluna(mp)
+                if j is None:
+                    continue
+                self.col_lo[j] = 0.0 if min_val is None else max(0.0, float(min_val))
+                self.col_hi[j] = 100.0 if max_val is None else min(100.0, float(max_val))
+                if self._highs is not None:
+                    self._highs.changeColBounds(j, self.col_lo[j], self.col_hi[j])
+
+            for mp, preco in (precos or {}).items():
+                j = self.matriz.coluna(mp)
+                if j is None or preco is None:
+                    continue
+                self.matriz.valores[self._i_custo, j] = float(preco)
+                if self._highs is not None:
+                    self._highs.changeColCost(j, float(preco) / 100)
+            if precos:
+                self.matriz._assinatura = None
+
+    def _problema(self):
+        # Forma padrão só com as linhas que têm limite finito
+        nutr = self.A[1:]
+        tem_min = np.isfinite(self.linha_lo[1:])
+        tem_max = np.isfinite(self.linha_hi[1:])
+        nomes = [self.matriz.linhas[i] for i in self._nutrientes]
+        return ProblemaLP(
+            c=self.matriz.custos / 100,
+            A_ub=np.vstack([-nutr[tem_min], nutr[tem_max]]),
+            b_ub=np.concatenate([-self.linha_lo[1:][tem_min], self.linha_hi[1:][tem_max]]),
+            A_eq=self.A[:1],
+            b_eq=self.linha_lo[:1],
+            bounds=np.column_stack([self.col_lo, self.col_hi]),
+            linhas_ub=[(nomes[k], "min") for k in np.flatnonzero(tem_min)]
+                      + [(nomes[k], "max") for k in np.flatnonzero(tem_max)],
+        )
+
+    def resolver(self):
+        with self._lock:
+            if self._highs is not None:
+                inicio = time.perf_counter()
+                solucao = _highs_resolver(self._highs, self.A.shape[1])
+                solucao.tempo = time.perf_counter() - inicio
+            else:
+                solucao = resolver_lp(self._problema(), self.solver)
+            return montar_resultado(self.matriz, solucao)
+
+
+def otimizar_cenario(matriz, cenario, solver=None):
+    # Ponto de entrada dos workers do lote: mesma rotina do /optimize para resultados idênticos
+    return otimizar_formula_matricial(
+        matriz,
+        restricoes=cenario.get("restricoes", {}),
+        metas=cenario.get("metas", {}),
+        solver=solver,
+    )
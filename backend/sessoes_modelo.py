@@ -0,0 +1,50 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+# ==============================================================
+# REGISTRO DE SESSÕES DE MODELOS COMPILADOS (LRU + expiração por inatividade)
+# ==============================================================
+
+class RegistroSessoes:
+    def __init__(self, max_sessoes=256, ttl_inativo=1800):
+        self.max_sessoes = max_sessoes
+        self.ttl_inativo = ttl_inativo
+        self._sessoes = OrderedDict()  # id -> (ultimo_uso, modelo)
+        self._lock = threading.Lock()
+
+    def _expirar(self):
+        limite = time.time() - self.ttl_inativo
+        while self._sessoes:
+            sessao_id, (ultimo_uso, _) = next(iter(self._sessoes.items()))
+            if ultimo_uso >= limite:
+                break
+            del self._sessoes[sessao_id]
+
+    def criar(self, modelo):
+        sessao_id = uuid.uuid4().hex
+        with self._lock:
+            self._expirar()
+            self._sessoes[sessao_id] = (time.time(), modelo)
+            while len(self._sessoes) > self.max_sessoes:
+                self._sessoes.popitem(last=False)
+        return sessao_id
+
+    def obter(self, sessao_id):
+        with self._lock:
+            self._expirar()
+            entrada = self._sessoes.get(sessao_id)
+            if entrada is None:
+                return None
+            self._sessoes[sessao_id] = (time.time(), entrada[1])
+            self._sessoes.move_to_end(sessao_id)
+            return entrada[1]
+
+    def remover(self, sessao_id):
+        with self._lock:
+            return self._sessoes.pop(sessao_id, None) is not None
+
+    def __len__(self):
+        return len(self._sessoes)
@@ -0,0 +1,170 @@
+import json
+
+import numpy as np
+
+from optimization_engine import MatrizNutricional, CUSTO_ROW_NAME
+
+try:
+    import msgpack
+except ImportError:  # msgpack é opcional: sem ele só JSON e Arrow
+    msgpack = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+except ImportError:  # pyarrow é opcional: sem ele só JSON e msgpack
+    pa = ipc = None
+
+
+# ==============================================================
+# FORMATOS E NEGOCIAÇÃO DE CONTEÚDO
+# ==============================================================
+
+MEDIA_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/x-msgpack",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+_FORMATO_POR_TIPO = {tipo: formato for formato, tipo in MEDIA_TYPES.items()}
+_FORMATO_POR_TIPO["application/msgpack"] = "msgpack"
+
+
+class FormatoNaoSuportado(ValueError):
+    pass
+
+
+def formatos_disponiveis():
+    formatos = ["json"]
+    if msgpack is not None:
+        formatos.append("msgpack")
+    if ipc is not None:
+        formatos.append("arrow")
+    return formatos
+
+
+def negociar(accept, permitidos=("json", "msgpack", "arrow")):
+    """Formato de resposta pelo cabeçalho Accept (q e ordem); JSON quando nada casar."""
+    disponiveis = [f for f in formatos_disponiveis() if f in permitidos]
+    candidatos = []
+    for posicao, parte in enumerate((accept or "").split(",")):
+        tipo, *parametros = [p.strip() for p in parte.split(";")]
+        q = 1.0
+        for p in parametros:
+            if p.startswith("q="):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0.0
+        formato = _FORMATO_POR_TIPO.get(tipo.lower())
+        if formato in disponiveis and q > 0:
+            candidatos.append((-q, posicao, formato))
+    return min(candidatos)[2] if candidatos else "json"
+
+
+def formato_do_conteudo(content_type):
+    tipo = (content_type or "").split(";")[0].strip().lower()
+    return _FORMATO_POR_TIPO.get(tipo, "json")
+
+
+# ==============================================================
+# MATRIZ COMPACTA (nomes + valores densos, sem dict aninhado)
+# ==============================================================
+
+def eh_compacta(dados):
+    return isinstance(dados, dict) and {"linhas", "colunas", "valores"} <= dados.keys()
+
+
+def matriz_compacta(matriz, binario=False):
+    # binario=True: valores como float64 little-endian (msgpack); senão listas (JSON)
+    valores = np.ascontiguousarray(matriz.valores, dtype="<f8")
+    return {
+        "linhas": list(matriz.linhas),
+        "colunas": list(matriz.colunas),
+        "forma": list(valores.shape),
+        "valores": valores.tobytes() if binario else valores.tolist(),
+    }
+
+
+def _montar_matriz(linhas, colunas, valores):
+    # Mesmas garantias do de_dataframe: NaN → 0 e linha de Custo sempre presente
+    valores = np.nan_to_num(np.array(valores, dtype=float).reshape(len(linhas), len(colunas)))
+    if CUSTO_ROW_NAME not in linhas:
+        linhas = linhas + [CUSTO_ROW_NAME]
+        valores = np.vstack([valores, np.zeros((1, len(colunas)))])
+    return MatrizNutricional(linhas, colunas, valores)
+
+
+def matriz_de_compacta(dados):
+    linhas, colunas = [str(n) for n in dados["linhas"]], [str(n) for n in dados["colunas"]]
+    valores = dados["valores"]
+    if isinstance(valores, (bytes, bytearray, memoryview)):
+        valores = np.frombuffer(valores, dtype="<f8")
+    try:
+        return _montar_matriz(linhas, colunas, valores)
+    except ValueError:
+        raise ValueError("Matriz compacta inconsistente: 'valores' deve ter len(linhas) × len(colunas) elementos.")
+
+
+# ==============================================================
+# CODIFICAÇÃO / DECODIFICAÇÃO
+# ==============================================================
+
+def _tabela_arrow(matriz):
+    # Orientado a colunas: uma coluna float64 por MP, uma linha por nutriente (inclui Custo)
+    return pa.table(
+        [pa.array(matriz.linhas, type=pa.string())]
+        + [pa.array(matriz.valores[:, j], type=pa.float64()) for j in range(len(matriz.colunas))],
+        names=["nome"] + list(matriz.colunas),
+    )
+
+
+def _msgpack_padrao(valor):
+    # Escalares/arrays numpy que sobram nos resultados do motor
+    if isinstance(valor, np.generic):
+        return valor.item()
+    if isinstance(valor, np.ndarray):
+        return valor.tolist()
+    raise TypeError(f"Tipo não serializável em msgpack: {type(valor).__name__}")
+
+
+def codificar(formato, conteudo, matriz=None):
+    """conteudo: dict serializável; matriz (opcional) vai no campo "matriz" em forma compacta."""
+    if formato == "msgpack" and msgpack is not None:
+        if matriz is not None:
+            conteudo = {**conteudo, "matriz": matriz_compacta(matriz, binario=True)}
+        return msgpack.packb(conteudo, use_bin_type=True, default=_msgpack_padrao)
+
+    if formato == "arrow" and ipc is not None:
+        if matriz is None:
+            raise FormatoNaoSuportado("Arrow só transporta matrizes.")
+        # Demais campos seguem como JSON nos metadados do schema
+        tabela = _tabela_arrow(matriz)
+        tabela = tabela.replace_schema_metadata({"corpo": json.dumps(conteudo, ensure_ascii=False)})
+        destino = pa.BufferOutputStream()
+        with ipc.new_stream(destino, tabela.schema) as escritor:
+            escritor.write_table(tabela)
+        return destino.getvalue().to_pybytes()
+
+    raise FormatoNaoSuportado(f"Formato '{formato}' indisponível.")
+
+
+def decodificar(formato, dados):
+    """Corpo de requisição binário → dict; "matriz" já vem como MatrizNutricional."""
+    if formato == "msgpack" and msgpack is not None:
+        corpo = msgpack.unpackb(dados, raw=False)
+        if eh_compacta(corpo.get("matriz")):
+            corpo["matriz"] = matriz_de_compacta(corpo["matriz"])
+        return corpo
+
+    if formato == "arrow" and ipc is not None:
+        tabela = ipc.open_stream(pa.py_buffer(dados)).read_all()
+        metadados = tabela.schema.metadata or {}
+        corpo = json.loads(metadados.get(b"corpo", b"{}"))
+        colunas = tabela.column_names[1:]
+        valores = np.empty((tabela.num_rows, len(colunas)))
+        for j, c in enumerate(colunas):
+            valores[:, j] = tabela.column(c).to_numpy(zero_copy_only=False)
+        corpo["matriz"] = _montar_matriz(tabela.column(0).to_pylist(), colunas, valores)
+        return corpo
+
+    raise FormatoNaoSuportado(f"Formato '{formato}' indisponível.")